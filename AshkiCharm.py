@@ -1,30 +1,77 @@
 # ======================= ИМПОРТЫ И НАСТРОЙКИ ======================= #
+import sys
+import time
+
+# --profile-startup: время импорта каждого модуля и этапов запуска, без старта бота
+PROFILE_STARTUP = __name__ == "__main__" and "--profile-startup" in sys.argv
+STARTUP_BEGAN = time.perf_counter()
+import_times = {}
+
+if PROFILE_STARTUP:
+    import builtins
+
+    _original_import = builtins.__import__
+
+    def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if level and globals:
+            # Относительный импорт внутри пакета: приводим к полному имени модуля
+            package = globals.get("__package__") or ""
+            base = package.rsplit(".", level - 1)[0] if level > 1 else package
+            name_key = f"{base}.{name}" if name else base
+        else:
+            name_key = name
+        if name_key in sys.modules:
+            return _original_import(name, globals, locals, fromlist, level)
+        started = time.perf_counter()
+        try:
+            return _original_import(name, globals, locals, fromlist, level)
+        finally:
+            # Время включает вложенные импорты модуля
+            import_times.setdefault(name_key, time.perf_counter() - started)
+
+    builtins.__import__ = _timed_import
+
 import os
+import asyncio
+import collections
+import functools
+import hashlib
+import io
+import json
 import logging
+import pathlib
 import re
-import pandas as pd
+import shutil
+import tempfile
+import threading
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import EditMessageText
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, Boolean
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, Float, ForeignKey, Date, DateTime, Boolean, Index, and_, bindparam, case, delete, insert, inspect, update
+from sqlalchemy.dialects import postgresql as postgresql_dialect, sqlite as sqlite_dialect
 from sqlalchemy.orm import declarative_base, Session, sessionmaker, relationship
 from sqlalchemy.sql import func
+from sqlalchemy.exc import DBAPIError, IntegrityError
 import datetime
-import io
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from reports import (
+    EXPORT_FORMATS, PARQUET_AVAILABLE, iter_products_table_rows, pack_export, render_month_report_xlsx,
+    spool_rows, start_report_pool, warm_up, write_customers_month_xlsx, write_products_table_xlsx, write_rows_csv,
+    write_rows_parquet, write_rows_xlsx, write_spooled
+)
 load_dotenv()  # Загрузка переменных окружения
-
-print("Текущая директория:", os.getcwd())
-print("Содержимое текущей директории:", os.listdir())
-
-
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-print(f"Загруженный токен: {BOT_TOKEN}")
-
+startup_stages = [("импорты", time.perf_counter() - STARTUP_BEGAN)]
 
 
 # ======================= НАСТРОЙКА ЛОГГЕРА ======================= #
@@ -45,7 +92,164 @@ bot = Bot(
     token=BOT_TOKEN,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-dp = Dispatcher(storage=MemoryStorage())
+
+# ======================= ИСХОДЯЩИЕ СООБЩЕНИЯ ======================= #
+# Все запросы бота к чатам (answer, edit_text, answer_document, рассылки) проходят
+# через планировщик: общий лимит и лимит на чат, ожидание retry_after при 429 и
+# склейка повторных edit_text одного сообщения — отправляется только последний.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))      # сообщений в секунду
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))           # в личном чате
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", str(20 / 60)))  # в группе/канале
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "5"))
+OUTBOUND_MAX_RETRIES = 3
+
+
+class TokenBucket:
+    """Ведро токенов; ожидающие получают токены в порядке очереди"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def refund(self):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def block(self, seconds: float):
+        """Пауза после 429: Telegram просит не отправлять retry_after секунд"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return not self.lock.locked() and self.tokens >= self.capacity
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Middleware сессии бота с лимитами отправки и метриками"""
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.latest_edits = {}  # (chat_id, message_id) -> задача последнего edit_text
+        self.sent = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.waiting = 0
+        self.sent_times = collections.deque(maxlen=1000)
+        self.queue_latencies = collections.deque(maxlen=200)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                self.chat_buckets = {key: b for key, b in self.chat_buckets.items() if not b.idle}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = OUTBOUND_GROUP_RATE if is_group else OUTBOUND_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, OUTBOUND_CHAT_BURST)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery и т.п. не ограничиваем, только повторяем при 429
+            return await self._send(make_request, bot, method, ())
+        if not isinstance(method, EditMessageText) or method.message_id is None:
+            return await self._schedule(make_request, bot, method, chat_id)
+
+        # Изменение сообщения отправляется отдельной задачей: её результата ждут более
+        # старые изменения того же сообщения, поэтому отмена вызвавшего (например,
+        # пока он ждёт очереди) не оставляет их висеть — задача всё равно завершится
+        edit_key = (chat_id, method.message_id)
+        task = asyncio.ensure_future(self._schedule(make_request, bot, method, chat_id, edit_key))
+        self.latest_edits[edit_key] = task
+        task.add_done_callback(functools.partial(self._forget_edit, edit_key))
+        return await asyncio.shield(task)
+
+    def _forget_edit(self, edit_key, task):
+        if self.latest_edits.get(edit_key) is task:
+            del self.latest_edits[edit_key]
+        if not task.cancelled():
+            task.exception()  # ошибку получит вызвавший, не логируем её как забытую
+
+    async def _schedule(self, make_request, bot, method, chat_id, edit_key=None):
+        queued_at = time.monotonic()
+        chat_bucket = self._chat_bucket(chat_id)
+        self.waiting += 1
+        try:
+            await chat_bucket.acquire()
+            newer = self.latest_edits.get(edit_key) if edit_key else None
+            superseded = newer is not None and newer is not asyncio.current_task()
+            if superseded:
+                # Пока ждали очереди, пришло более новое изменение этого сообщения
+                chat_bucket.refund()
+                self.coalesced += 1
+            else:
+                await self.global_bucket.acquire()
+        finally:
+            self.waiting -= 1
+
+        if superseded:
+            return await newer
+        self.queue_latencies.append(time.monotonic() - queued_at)
+        return await self._send(make_request, bot, method, (chat_bucket, self.global_bucket))
+
+    async def _send(self, make_request, bot, method, buckets):
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                self.retries += 1
+                logger.warning(f"429 на {type(method).__name__}: ждём {e.retry_after} с")
+                for bucket in buckets:
+                    bucket.block(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+                continue
+            if buckets:
+                self.sent += 1
+                self.sent_times.append(time.monotonic())
+            return response
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        latencies = list(self.queue_latencies)
+        return {
+            "sent": self.sent,
+            "per_minute": sum(1 for sent_at in self.sent_times if now - sent_at <= 60),
+            "waiting": self.waiting,
+            "retries": self.retries,
+            "coalesced": self.coalesced,
+            "avg_wait_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            "max_wait_ms": max(latencies) * 1000 if latencies else 0.0,
+        }
+
+
+outbound = OutboundScheduler()
+bot.session.middleware(outbound)
 
 # ======================= БАЗА ДАННЫХ ======================= #
 Base = declarative_base()
@@ -85,6 +289,10 @@ class Flavor(Base):
     product = relationship("Product", back_populates="flavors")
     sales = relationship("Sale", back_populates="flavor")
 
+    __table_args__ = (
+        Index("ix_flavors_product_id_name", "product_id", "name"),
+    )
+
 class EditSaleState(StatesGroup):
     select_customer = State()
     select_sale = State()
@@ -98,7 +306,7 @@ class Customer(Base):
     __tablename__ = "customers"
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False, unique=True)
-    date = Column(DateTime, default=datetime.datetime.now)  # Добавлено!
+    date = Column(DateTime, default=datetime.datetime.now, index=True)  # Добавлено!
     sales = relationship("Sale", back_populates="customer")
 
 
@@ -107,25 +315,1078 @@ class Sale(Base):
     id = Column(Integer, primary_key=True)
     product_id = Column(Integer, ForeignKey("products.id"))
     flavor_id = Column(Integer, ForeignKey("flavors.id"))
-    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True)  # Связь с покупателем
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True, index=True)  # Связь с покупателем
     quantity = Column(Integer)
     purchase_price = Column(Float)
     sale_price = Column(Float)
-    date = Column(DateTime, default=datetime.datetime.now)
+    date = Column(DateTime, default=datetime.datetime.now, index=True)
 
     product = relationship("Product", back_populates="sales")
     flavor = relationship("Flavor", back_populates="sales")
     customer = relationship("Customer", back_populates="sales")
 
+    __table_args__ = (
+        # Поиск брака: product_id + customer_id IS NULL
+        Index("ix_sales_product_id_customer_id", "product_id", "customer_id"),
+    )
+
 class WorkerIncome(Base):
     __tablename__ = "worker_income"
     id = Column(Integer, primary_key=True)
-    week_start = Column(DateTime)
+    week_start = Column(DateTime, index=True)
     income = Column(Float)
     is_current = Column(Boolean, default=True)
 
+def migrate_schema(engine):
+    """Досоздаёт индексы, которых нет в уже существующей базе.
+
+    create_all не трогает существующие таблицы, поэтому индексы,
+    добавленные в модели позже, создаются здесь отдельно (checkfirst).
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+    # sent_documents хранит только file_id, которые можно получить заново:
+    # таблицу прежнего формата (ключ — хэш содержимого) проще пересоздать
+    if "content_hash" in {column["name"] for column in inspect(engine).get_columns("sent_documents")}:
+        SentDocument.__table__.drop(engine)
+        SentDocument.__table__.create(engine)
+
+
+class DailySalesRollup(Base):
+    """Итоги продаж по дням и товарам, обновляются вместе с записями Sale"""
+    __tablename__ = "daily_sales_rollup"
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    sales_count = Column(Integer, default=0, nullable=False)
+    quantity = Column(Integer, default=0, nullable=False)
+    revenue = Column(Float, default=0.0, nullable=False)
+    profit = Column(Float, default=0.0, nullable=False)
+
+
+# product_id в итогах для продаж удалённых товаров: при session.delete(product)
+# SQLAlchemy обнуляет Sale.product_id, а ключ итогов NULL не допускает
+NO_PRODUCT_ID = 0
+
+
+class FsmRecord(Base):
+    """Состояние FSM и данные диалога (корзина, редактирование, авторизация)"""
+    __tablename__ = "fsm_states"
+    key = Column(String(255), primary_key=True)
+    state = Column(String(255))
+    data = Column(Text, default="{}", nullable=False)
+    updated_at = Column(DateTime, default=datetime.datetime.now, nullable=False, index=True)
+
+
+class ChannelPost(Base):
+    """Сообщение с товаром на доске прайса в канале"""
+    __tablename__ = "channel_posts"
+    product_id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, nullable=False)
+    text_hash = Column(String(40), nullable=False)
+
+
+class LeaderLease(Base):
+    """Аренда фоновой задачи, которую должен выполнять только один процесс бота"""
+    __tablename__ = "leader_leases"
+    name = Column(String(32), primary_key=True)
+    owner = Column(String(64), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class SentDocument(Base):
+    """file_id, который Telegram вернул за загруженный отчёт (ключ — ключ кэша отчёта и имя файла)"""
+    __tablename__ = "sent_documents"
+    document_key = Column(String(255), primary_key=True)
+    file_id = Column(String(255), nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.now, nullable=False)
+
+
+class DataVersion(Base):
+    """Счётчик изменений данных для ключей кэша отчётов и кэша каталога, общий для всех процессов бота"""
+    __tablename__ = "data_versions"
+    name = Column(String(32), primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+
+
+def insert_or_add(session, model, rows, key_columns, add_columns, **execution_options):
+    """Вставляет строки, а для уже существующих ключей прибавляет значения add_columns.
+
+    Прибавление выполняет сама БД (INSERT … ON CONFLICT DO UPDATE SET x = x + excluded.x),
+    поэтому параллельные транзакции не теряют изменения друг друга. Ключи в rows
+    не должны повторяться.
+    """
+    if not rows:
+        return
+    dialect_inserts = {"sqlite": sqlite_dialect.insert, "postgresql": postgresql_dialect.insert}
+    dialect_insert = dialect_inserts.get(session.get_bind().dialect.name)
+    if dialect_insert is not None:
+        statement = dialect_insert(model).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={column: getattr(model, column) + getattr(statement.excluded, column) for column in add_columns}
+        )
+        session.execute(statement.execution_options(**execution_options))
+        return
+    # Остальные СУБД: UPDATE с прибавлением, INSERT — только для отсутствующих ключей
+    for row in rows:
+        result = session.execute(
+            update(model)
+            .where(*(getattr(model, column) == row[column] for column in key_columns))
+            .values({column: getattr(model, column) + row[column] for column in add_columns})
+            .execution_options(synchronize_session=False, **execution_options)
+        )
+        if not result.rowcount:
+            session.execute(insert(model).values(row).execution_options(**execution_options))
+
+
+def _apply_rollup_deltas(session, deltas):
+    """Прибавляет к daily_sales_rollup {(день, товар): [продаж, штук, выручка, прибыль]} одним запросом"""
+    months = {day.strftime("%Y-%m") for day, _ in deltas}
+    insert_or_add(
+        session,
+        DailySalesRollup,
+        [
+            {"day": day, "product_id": product_id, "sales_count": sales_count,
+             "quantity": quantity, "revenue": revenue, "profit": profit}
+            for (day, product_id), (sales_count, quantity, revenue, profit) in deltas.items()
+        ],
+        ["day", "product_id"],
+        ["sales_count", "quantity", "revenue", "profit"],
+        # Затронутые месяцы известны — версии отчётов за остальные месяцы не меняются
+        report_months=months
+    )
+    return months
+
+
+def add_sale_to_rollup(session, sale, sign=1):
+    """Учитывает продажу в daily_sales_rollup (sign=-1 — отменяет учёт).
+
+    Вызывается в той же сессии, что и изменение Sale, поэтому итоги
+    фиксируются тем же commit.
+    """
+    if sale.date is None:
+        sale.date = datetime.datetime.now()
+    product_id = sale.product.id if sale.product is not None else sale.product_id
+    if product_id is None:
+        session.flush()
+        product_id = sale.product_id if sale.product_id is not None else NO_PRODUCT_ID
+
+    day = sale.date.date()
+    months = _apply_rollup_deltas(session, {(day, product_id): [
+        sign,
+        sign * sale.quantity,
+        sign * sale.sale_price * sale.quantity,
+        sign * (sale.sale_price - sale.purchase_price) * sale.quantity
+    ]})
+
+    # День без продаж не храним — так же, как его не вернёт rebuild_daily_rollup
+    if sign < 0:
+        session.execute(
+            delete(DailySalesRollup)
+            .where(DailySalesRollup.day == day, DailySalesRollup.product_id == product_id,
+                   DailySalesRollup.sales_count <= 0)
+            .execution_options(synchronize_session=False, report_months=months)
+        )
+
+
+def add_sales_to_rollup(session, sales):
+    """Учитывает сразу несколько новых продаж в daily_sales_rollup.
+
+    Продажи складываются по (день, товар) в памяти и попадают в итоги одним
+    INSERT … ON CONFLICT. У продаж должны быть заданы date и product_id.
+    """
+    deltas = {}
+    for sale in sales:
+        delta = deltas.setdefault((sale.date.date(), sale.product_id), [0, 0, 0.0, 0.0])
+        delta[0] += 1
+        delta[1] += sale.quantity
+        delta[2] += sale.sale_price * sale.quantity
+        delta[3] += (sale.sale_price - sale.purchase_price) * sale.quantity
+    if deltas:
+        _apply_rollup_deltas(session, deltas)
+
+
+def credit_worker_income(session, amount):
+    """Начисляет (amount < 0 — вычитает) доход рабочего за текущую неделю.
+
+    Неделя ищется по индексу week_start; прошлые недели снимаются с
+    is_current только когда заводится запись новой недели.
+    """
+    today = datetime.datetime.now().date()
+    current_week_start = datetime.datetime.combine(
+        today - datetime.timedelta(days=today.weekday()),
+        datetime.time.min
+    )
+    income_record = session.query(WorkerIncome).filter(
+        WorkerIncome.week_start == current_week_start
+    ).first()
+    if not income_record:
+        session.query(WorkerIncome).filter(
+            WorkerIncome.is_current.is_(True)
+        ).update({WorkerIncome.is_current: False}, synchronize_session=False)
+        income_record = WorkerIncome(
+            week_start=current_week_start,
+            income=0.0,
+            is_current=True
+        )
+        session.add(income_record)
+    income_record.income += amount
+    return income_record
+
+
+def move_rollups_to_no_product(session, product_ids):
+    """Переносит итоги удаляемых товаров на NO_PRODUCT_ID — туда же, куда их
+    положит rebuild_daily_rollup после того, как у продаж обнулится product_id"""
+    rows = session.query(
+        DailySalesRollup.day, DailySalesRollup.sales_count, DailySalesRollup.quantity,
+        DailySalesRollup.revenue, DailySalesRollup.profit
+    ).filter(DailySalesRollup.product_id.in_(product_ids)).all()
+    if not rows:
+        return
+    deltas = {}
+    for day, sales_count, quantity, revenue, profit in rows:
+        delta = deltas.setdefault((day, NO_PRODUCT_ID), [0, 0, 0.0, 0.0])
+        delta[0] += sales_count
+        delta[1] += quantity
+        delta[2] += revenue
+        delta[3] += profit
+    session.execute(
+        delete(DailySalesRollup)
+        .where(DailySalesRollup.product_id.in_(product_ids))
+        .execution_options(synchronize_session=False, report_months={day.strftime("%Y-%m") for day, _ in deltas})
+    )
+    _apply_rollup_deltas(session, deltas)
+
+
+@event.listens_for(Session, "before_flush")
+def move_rollups_of_deleted_products(session, flush_context, instances):
+    product_ids = [obj.id for obj in session.deleted if isinstance(obj, Product)]
+    if product_ids:
+        move_rollups_to_no_product(session, product_ids)
+
+
+def rebuild_daily_rollup(session):
+    """Полностью пересобирает daily_sales_rollup из истории продаж"""
+    day = func.date(Sale.date)
+    rows = session.query(
+        day,
+        func.coalesce(Sale.product_id, NO_PRODUCT_ID),
+        func.count(Sale.id),
+        func.coalesce(func.sum(Sale.quantity), 0),
+        func.coalesce(func.sum(Sale.sale_price * Sale.quantity), 0.0),
+        func.coalesce(func.sum((Sale.sale_price - Sale.purchase_price) * Sale.quantity), 0.0)
+    ).filter(Sale.date.isnot(None)).group_by(day, func.coalesce(Sale.product_id, NO_PRODUCT_ID)).all()
+
+    session.query(DailySalesRollup).delete()
+    session.bulk_insert_mappings(DailySalesRollup, [
+        {
+            "day": _as_date(row[0]),
+            "product_id": row[1],
+            "sales_count": row[2],
+            "quantity": row[3],
+            "revenue": row[4],
+            "profit": row[5]
+        }
+        for row in rows
+    ])
+    session.commit()
+    return len(rows)
+
+
 # === Создаём таблицы только один раз ===
-Base.metadata.create_all(engine)  # Теперь вызываем здесь
+# Увеличивать при каждом изменении моделей, таблиц или индексов
+SCHEMA_VERSION = 7
+
+
+class SchemaInfo(Base):
+    """Версия схемы, для которой уже выполнены create_all и migrate_schema"""
+    __tablename__ = "schema_info"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+def ensure_schema(engine):
+    """Создаёт таблицы и индексы, только если версия схемы в БД отличается"""
+    try:
+        with Session() as session:
+            current = session.query(SchemaInfo.version).scalar()
+    except DBAPIError:
+        current = None  # таблицы schema_info ещё нет
+    if current == SCHEMA_VERSION:
+        return False
+
+    Base.metadata.create_all(engine)
+    migrate_schema(engine)
+    with Session() as session:
+        session.merge(SchemaInfo(id=1, version=SCHEMA_VERSION))
+        session.commit()
+    logger.info(f"Схема БД обновлена до версии {SCHEMA_VERSION}")
+    return True
+
+
+stage_started = time.perf_counter()
+ensure_schema(engine)
+startup_stages.append(("схема БД", time.perf_counter() - stage_started))
+
+
+# ======================= ДОСТУП К БД ======================= #
+# Синхронные запросы SQLAlchemy выполняются в ограниченном пуле потоков,
+# чтобы долгий отчёт не останавливал обработку обновлений остальных пользователей.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+
+async def run_db(work, *args):
+    """Выполняет work(session, *args) в пуле потоков с отдельной сессией и возвращает результат"""
+    def call():
+        with Session() as session:
+            return work(session, *args)
+    return await asyncio.get_running_loop().run_in_executor(db_executor, call)
+
+
+# ======================= КЭШ КАТАЛОГА ======================= #
+# Товары, вкусы и остатки для меню выбора читаются из памяти. Снимок помечен
+# версией catalog из data_versions, которую увеличивает каждый commit, изменивший
+# Product/Flavor (в том числе UPDATE остатков), в любом процессе бота. Перед
+# выдачей снимка версия сверяется одним запросом, и при расхождении каталог
+# перечитывается двумя запросами.
+
+CatalogFlavor = collections.namedtuple("CatalogFlavor", "id name quantity product_id")
+CatalogProduct = collections.namedtuple(
+    "CatalogProduct", "id name purchase_price sale_price sale_price_2 flavors"
+)
+
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога: товары в порядке id и вкусы по id"""
+
+    def __init__(self, products):
+        self.version = None  # версия catalog из data_versions, прочитанная до загрузки
+        self.products = products
+        self.products_by_id = {product.id: product for product in products}
+        self.flavors_by_id = {
+            flavor.id: flavor for product in products for flavor in product.flavors
+        }
+
+    def product(self, product_id):
+        return self.products_by_id.get(product_id)
+
+    def flavor(self, flavor_id):
+        return self.flavors_by_id.get(flavor_id)
+
+
+def load_catalog_if_changed(session, cached_version):
+    """Новый снимок каталога или None, если версия в БД равна cached_version"""
+    version, = data_versions(session, CATALOG_VERSION)
+    if version == cached_version:
+        return None
+    # Версия читается до выборки: снимок не старее своей версии
+    snapshot = load_catalog(session)
+    snapshot.version = version
+    return snapshot
+
+
+def load_catalog(session) -> CatalogSnapshot:
+    flavors = collections.defaultdict(list)
+    for flavor in session.query(Flavor.id, Flavor.name, Flavor.quantity, Flavor.product_id).order_by(Flavor.id):
+        flavors[flavor.product_id].append(CatalogFlavor(*flavor))
+    products = [
+        CatalogProduct(p.id, p.name, p.purchase_price, p.sale_price, p.sale_price_2, tuple(flavors[p.id]))
+        for p in session.query(
+            Product.id, Product.name, Product.purchase_price, Product.sale_price, Product.sale_price_2
+        ).order_by(Product.id)
+    ]
+    return CatalogSnapshot(products)
+
+
+class CatalogCache:
+    def __init__(self):
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._snapshot = None
+        self.listeners = []  # вызываются при каждом сбросе, в том числе из потоков пула БД
+
+    async def get(self) -> CatalogSnapshot:
+        cached = self._snapshot
+        snapshot = await run_db(load_catalog_if_changed, cached.version if cached else None)
+        if snapshot is None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        if self._snapshot is not None and self._snapshot is cached:
+            # Каталог изменил другой процесс бота: наш commit сбросил бы снимок сам
+            self._notify()
+        if self._snapshot is None or self._snapshot.version < snapshot.version:
+            self._snapshot, self.version = snapshot, snapshot.version
+        return snapshot
+
+    def invalidate(self):
+        self._snapshot = None
+        self._notify()
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener()
+
+
+catalog = CatalogCache()
+CATALOG_MODELS = (Product, Flavor)
+
+
+@event.listens_for(Session, "after_flush")
+def mark_catalog_changed_on_flush(session, flush_context):
+    if any(isinstance(obj, CATALOG_MODELS) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info["catalog_changed"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def mark_catalog_changed_on_bulk(orm_execute_state):
+    # Массовые INSERT/UPDATE/DELETE (reserve_stock, add_stock, загрузка таблицы) не проходят через flush
+    if (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete) and any(
+        mapper.class_ in CATALOG_MODELS for mapper in orm_execute_state.all_mappers
+    ):
+        orm_execute_state.session.info["catalog_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_catalog_after_commit(session):
+    if session.info.pop("catalog_changed", False):
+        catalog.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_catalog_changes(session):
+    session.info.pop("catalog_changed", None)
+
+
+# ======================= КЛАВИАТУРЫ ВЫБОРА ТОВАРА И ВКУСА ======================= #
+# Готовые клавиатуры запоминаются по (версия каталога, экран, страница/товар,
+# исключённые вкусы) и сбрасываются вместе с кэшем каталога.
+PICKER_PAGE_SIZE = int(os.getenv("PICKER_PAGE_SIZE", "50"))  # Telegram допускает до 100 кнопок
+
+PickerScreen = collections.namedtuple("PickerScreen", "prefix label back_text back_data in_stock_only")
+
+PRODUCT_PICKERS = {
+    "sale": PickerScreen("product_", "{name}", "🔙 Назад", "back_to_main_menu", False),
+    "defect": PickerScreen("defect_product_", "{name}", "🔙 Назад", "back_to_main_menu", False),
+    "add_to_sale": PickerScreen("add_product_", "{name}", "🔙 Назад", "back_to_sale_actions", False),
+    "edit_sale": PickerScreen("edit_product_", "{name}", "🔙 Назад", "back_to_sale_actions", False),
+}
+
+FLAVOR_PICKERS = {
+    "sale": PickerScreen("flavor_", "{name} ({quantity})", "🔙 Назад", "back_to_products", False),
+    "defect": PickerScreen("defect_flavor_", "{name} ({quantity})", "🔙 Назад", "back_to_defect_list", True),
+    "add_to_sale": PickerScreen("add_flavor_", "{name} ({quantity} шт.)", "🔙 Назад", "back_to_products_list", True),
+    "edit_sale": PickerScreen("edit_flavor_", "{name} ({quantity} шт.)", "🔙 Назад", "back_to_products_list", True),
+}
+
+
+class KeyboardCache:
+    def __init__(self):
+        self.snapshot = None
+        self.markups = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, snapshot: CatalogSnapshot, key, build):
+        # Сравниваем сам снимок: после каждой перезагрузки каталога он новый
+        if snapshot is not self.snapshot:
+            self.snapshot = snapshot
+            self.markups.clear()
+        markup = self.markups.get(key)
+        if markup is None:
+            self.misses += 1
+            markup = self.markups[key] = build()
+        else:
+            self.hits += 1
+        return markup
+
+
+keyboards = KeyboardCache()
+
+
+def build_product_picker(snapshot: CatalogSnapshot, screen: str, page: int):
+    spec = PRODUCT_PICKERS[screen]
+    pages = max(1, -(-len(snapshot.products) // PICKER_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    rows = [
+        [types.InlineKeyboardButton(text=spec.label.format(name=p.name), callback_data=f"{spec.prefix}{p.id}")]
+        for p in snapshot.products[page * PICKER_PAGE_SIZE:(page + 1) * PICKER_PAGE_SIZE]
+    ]
+    if pages > 1:
+        rows.append([
+            types.InlineKeyboardButton(text="◀️", callback_data=f"picker_page:{screen}:{(page - 1) % pages}"),
+            types.InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="picker_noop"),
+            types.InlineKeyboardButton(text="▶️", callback_data=f"picker_page:{screen}:{(page + 1) % pages}"),
+        ])
+    rows.append([types.InlineKeyboardButton(text=spec.back_text, callback_data=spec.back_data)])
+    return types.InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def product_picker(snapshot: CatalogSnapshot, screen: str, page: int = 0):
+    """Клавиатура выбора товара для экрана screen (страница page)"""
+    return keyboards.get(snapshot, ("products", screen, page),
+                         lambda: build_product_picker(snapshot, screen, page))
+
+
+def build_flavor_picker(snapshot: CatalogSnapshot, screen: str, product_id: int, exclude: frozenset):
+    spec = FLAVOR_PICKERS[screen]
+    product = snapshot.product(product_id)
+    flavors = [
+        flavor for flavor in (product.flavors if product else ())
+        if flavor.name not in exclude and (flavor.quantity > 0 or not spec.in_stock_only)
+    ]
+    if not flavors:
+        return None
+    rows = [
+        [types.InlineKeyboardButton(text=spec.label.format(name=f.name, quantity=f.quantity),
+                                    callback_data=f"{spec.prefix}{f.id}")]
+        for f in flavors
+    ]
+    rows.append([types.InlineKeyboardButton(text=spec.back_text, callback_data=spec.back_data)])
+    return types.InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def flavor_picker(snapshot: CatalogSnapshot, screen: str, product_id: int, exclude=()):
+    """Клавиатура выбора вкуса товара; None, если выбирать нечего"""
+    exclude = frozenset(exclude)
+    key = ("flavors", screen, product_id, exclude)
+    # Пустой результат кэшируется как False: None в кэше означает промах
+    markup = keyboards.get(snapshot, key, lambda: build_flavor_picker(snapshot, screen, product_id, exclude) or False)
+    return markup or None
+
+
+# ======================= ХРАНИЛИЩЕ СОСТОЯНИЙ FSM ======================= #
+# Корзины, редактирование и авторизация хранятся в таблице fsm_states, поэтому
+# переживают перезапуск и доступны нескольким процессам бота с общей БД.
+FSM_STORAGE = os.getenv("FSM_STORAGE", "db")                           # db | memory
+FSM_STATE_TTL = datetime.timedelta(hours=float(os.getenv("FSM_STATE_TTL_HOURS", "168")))
+FSM_CLEANUP_INTERVAL = 600                                              # секунды
+
+
+def write_fsm_record(session, key: str, fields: dict, now: datetime.datetime):
+    """Записывает поля state/data для ключа: UPDATE, а для нового ключа INSERT"""
+    values = {**fields, "updated_at": now}
+    updated = session.execute(update(FsmRecord).where(FsmRecord.key == key).values(values)).rowcount
+    if not updated:
+        try:
+            session.execute(insert(FsmRecord).values({"key": key, "state": None, "data": "{}", **values}))
+        except IntegrityError:
+            # Запись для этого ключа только что создал другой процесс
+            session.rollback()
+            session.execute(update(FsmRecord).where(FsmRecord.key == key).values(values))
+    session.commit()
+
+
+def read_fsm_record(session, key: str, expire_before: datetime.datetime):
+    """(state, data_json) для ключа; устаревшие записи считаются пустыми"""
+    row = session.query(FsmRecord.state, FsmRecord.data, FsmRecord.updated_at).filter(
+        FsmRecord.key == key
+    ).first()
+    if row is None or row.updated_at < expire_before:
+        return None, "{}"
+    return row.state, row.data
+
+
+def delete_expired_fsm_records(session, expire_before: datetime.datetime) -> int:
+    deleted = session.query(FsmRecord).filter(FsmRecord.updated_at < expire_before).delete()
+    session.commit()
+    return deleted
+
+
+class DatabaseStorage(BaseStorage):
+    """FSM-хранилище в БД.
+
+    set_state/set_data записываются сразу (write-through), чтение всегда идёт в БД:
+    следующее обновление пользователя видит состояние, даже если его обрабатывает
+    другой процесс бота. Устаревшие записи удаляются раз в FSM_CLEANUP_INTERVAL.
+    """
+
+    def __init__(self, ttl: datetime.timedelta):
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self._last_cleanup = time.monotonic()
+
+    async def _write(self, key: StorageKey, field: str, value):
+        await run_db(write_fsm_record, self.key_builder.build(key), {field: value}, datetime.datetime.now())
+        if time.monotonic() - self._last_cleanup > FSM_CLEANUP_INTERVAL:
+            self._last_cleanup = time.monotonic()
+            deleted = await run_db(delete_expired_fsm_records, datetime.datetime.now() - self.ttl)
+            if deleted:
+                logger.info(f"Удалено устаревших состояний FSM: {deleted}")
+
+    async def _read(self, key: StorageKey, field: str):
+        state, data = await run_db(read_fsm_record, self.key_builder.build(key), datetime.datetime.now() - self.ttl)
+        return state if field == "state" else data
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        await self._write(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey):
+        return await self._read(key, "state")
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        await self._write(key, "data", json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return json.loads(await self._read(key, "data"))
+
+    async def close(self) -> None:
+        pass
+
+
+def create_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return DatabaseStorage(FSM_STATE_TTL)
+
+
+dp = Dispatcher(storage=create_fsm_storage())
+
+
+# ======================= ПОВТОРНАЯ ОТПРАВКА ФАЙЛОВ ======================= #
+# Telegram возвращает file_id загруженного документа; тот же файл можно отправить
+# снова по этому id без повторной загрузки. Готовые отчёты с одинаковым ключом
+# кэша (отчёт, период, версии данных) совпадают по содержанию, хотя байты файла
+# каждый раз разные (время создания в xlsx). Поэтому file_id хранятся в
+# sent_documents по ключу кэша и имени файла и переживают перезапуск бота.
+# Выгрузки без ключа кэша всегда загружаются заново.
+def document_key(cache_key, filename: str) -> str:
+    return "/".join(str(part) for part in (*cache_key, filename))
+
+
+class DocumentRegistry:
+    """file_id отправленных отчётов: в памяти и в таблице sent_documents"""
+
+    def __init__(self):
+        self.file_ids = {}  # ключ документа -> file_id или None, дополняется из БД по запросу
+        self.uploads = 0
+        self.reused = 0
+
+    async def get(self, key: str):
+        if key not in self.file_ids:
+            record = await run_db(lambda session: session.get(SentDocument, key))
+            self.file_ids[key] = record.file_id if record else None
+        return self.file_ids[key]
+
+    async def remember(self, key: str, file_id: str, period_prefix: str):
+        """Запоминает file_id; id прежних версий того же отчёта за тот же период удаляются"""
+        for old_key in [old_key for old_key in self.file_ids if old_key.startswith(period_prefix)]:
+            del self.file_ids[old_key]
+        self.file_ids[key] = file_id
+
+        def save(session):
+            session.query(SentDocument).filter(
+                SentDocument.document_key.startswith(period_prefix, autoescape=True),
+                SentDocument.document_key != key
+            ).delete(synchronize_session=False)
+            session.merge(SentDocument(document_key=key, file_id=file_id, created_at=datetime.datetime.now()))
+            session.commit()
+        await run_db(save)
+
+    async def forget(self, key: str):
+        self.file_ids[key] = None
+
+        def delete_record(session):
+            session.query(SentDocument).filter_by(document_key=key).delete()
+            session.commit()
+        await run_db(delete_record)
+
+
+documents = DocumentRegistry()
+
+
+async def send_document(message: types.Message, filename: str, caption: str, content: bytes = None,
+                        path: str = None, cache_key=None):
+    """Отправляет документ из памяти (content) или с диска (path).
+
+    С cache_key отчёта, который уже отправлялся, файл уходит по file_id без загрузки.
+    """
+    key = document_key(cache_key, filename) if cache_key is not None else None
+    file_id = await documents.get(key) if key is not None else None
+    if file_id:
+        try:
+            await message.answer_document(file_id, caption=caption)
+            documents.reused += 1
+            return
+        except TelegramBadRequest as e:
+            # file_id больше не принимается (например, сменился токен бота) — загружаем заново
+            logger.warning(f"file_id для {filename} не принят: {e}")
+            await documents.forget(key)
+
+    if content is not None:
+        document = types.BufferedInputFile(content, filename=filename)
+    else:
+        document = types.FSInputFile(path, filename=filename)
+    sent = await message.answer_document(document, caption=caption)
+    documents.uploads += 1
+    if key is not None and sent.document is not None:
+        await documents.remember(key, sent.document.file_id, document_key(cache_key[:2], ""))
+
+
+# ======================= КЭШ ГОТОВЫХ ОТЧЕТОВ ======================= #
+# Готовый файл отчёта отдаётся повторно, пока не изменились его данные. Ключ —
+# (отчёт, период, версии данных). Версии хранятся в таблице data_versions и
+# увеличиваются тем же commit, что меняет данные: sales:ГГГГ-ММ — продажи,
+# покупатели или итоги по дням за месяц, sales:* — массовые изменения без
+# известного месяца, catalog — товары и остатки. Поэтому ключ учитывает изменения
+# из всех процессов бота и после перезапуска. Отчёты за закрытые месяцы хранятся
+# ещё и на диске (LRU по размеру папки); файл прежней версии удаляется при записи новой.
+REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR", "report_cache")
+REPORT_CACHE_MAX_MB = float(os.getenv("REPORT_CACHE_MAX_MB", "200"))
+REPORT_CACHE_MEMORY_ITEMS = int(os.getenv("REPORT_CACHE_MEMORY_ITEMS", "16"))
+
+SALES_MODELS = (Sale, Customer, DailySalesRollup)
+ALL_MONTHS = "*"
+CATALOG_VERSION = "catalog"
+
+
+class ReportCache:
+    """Готовые файлы отчётов: последние — в памяти, закрытые месяцы — ещё и на диске"""
+
+    def __init__(self, directory: str, max_bytes: int, memory_items: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Запись идёт из пула потоков по умолчанию, чтение — из event loop и других потоков
+        self.lock = threading.Lock()
+        self._disk = None  # имя файла -> размер в порядке LRU, читается с диска при первом обращении
+
+    def _disk_index(self):
+        if self._disk is None:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+            self._disk = collections.OrderedDict((name, size) for _, name, size in sorted(entries))
+        return self._disk
+
+    @staticmethod
+    def _file_name(key) -> str:
+        return "_".join(str(part) for part in key)
+
+    def get(self, key, persistent: bool = False):
+        """Содержимое файла или None. Для закрытых месяцев — одно чтение файла с диска"""
+        with self.lock:
+            content = self.memory.get(key)
+            if persistent:
+                disk = self._disk_index()
+                name = self._file_name(key)
+                if name in disk:
+                    path = os.path.join(self.directory, name)
+                    if content is None:
+                        with open(path, "rb") as file:
+                            content = file.read()
+                        self._remember(key, content)
+                    # mtime — порядок LRU после перезапуска
+                    os.utime(path)
+                    disk.move_to_end(name)
+            if content is None:
+                self.misses += 1
+                return None
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return content
+
+    def put(self, key, content: bytes, persistent: bool = False):
+        """Сохраняет файл. Версии ключа читаются до выборки данных, поэтому файл
+        не старее своего ключа. Файлы того же отчёта за тот же период с другими
+        версиями удаляются: их больше никто не запросит"""
+        with self.lock:
+            for old_key in [old_key for old_key in self.memory if old_key[:2] == key[:2] and old_key != key]:
+                del self.memory[old_key]
+            self._remember(key, content)
+            if not persistent:
+                return
+            disk = self._disk_index()
+            name = self._file_name(key)
+            prefix = self._file_name(key[:2])
+            for old_name in [old_name for old_name in disk if old_name != name and (
+                    old_name == prefix or old_name.startswith(prefix + "_"))]:
+                del disk[old_name]
+                os.remove(os.path.join(self.directory, old_name))
+            path = os.path.join(self.directory, name)
+            with open(path + ".tmp", "wb") as file:
+                file.write(content)
+            os.replace(path + ".tmp", path)
+            disk[name] = len(content)
+            disk.move_to_end(name)
+            # Вытесняем давно не запрашивавшиеся файлы, пока папка больше лимита
+            while sum(disk.values()) > self.max_bytes and len(disk) > 1:
+                old_name, _ = disk.popitem(last=False)
+                os.remove(os.path.join(self.directory, old_name))
+
+    def _remember(self, key, content: bytes):
+        self.memory[key] = content
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            disk = self._disk_index()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_items": len(self.memory),
+                "disk_files": len(disk),
+                "disk_bytes": sum(disk.values()),
+            }
+
+
+report_cache = ReportCache(REPORT_CACHE_DIR, int(REPORT_CACHE_MAX_MB * 1024 * 1024), REPORT_CACHE_MEMORY_ITEMS)
+
+
+def data_versions(session, *names) -> tuple:
+    """Текущие значения счётчиков data_versions (0 — данные ещё не менялись)"""
+    versions = dict(session.query(DataVersion.name, DataVersion.version).filter(DataVersion.name.in_(names)))
+    return tuple(versions.get(name, 0) for name in names)
+
+
+def report_cache_key(session, report: str, first_day: datetime.date):
+    """Ключ кэша месячного отчёта и признак закрытого месяца (хранится на диске)"""
+    period = first_day.strftime("%Y-%m")
+    versions = data_versions(session, f"sales:{period}", f"sales:{ALL_MONTHS}")
+    return (report, period, *versions), month_bounds(first_day)[1] < datetime.date.today()
+
+
+def products_table_cache_key(session):
+    return ("products_table", "all", *data_versions(session, CATALOG_VERSION)), False
+
+
+def _report_month(value):
+    return value.strftime("%Y-%m") if value is not None else ALL_MONTHS
+
+
+@event.listens_for(Session, "after_flush")
+def collect_report_months_on_flush(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, DailySalesRollup):
+            month = _report_month(obj.day)
+        elif isinstance(obj, (Sale, Customer)):
+            month = _report_month(obj.date)
+        else:
+            continue
+        session.info.setdefault("report_months", set()).add(month)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def collect_report_months_on_bulk(orm_execute_state):
+    # По массовому запросу месяцы не узнать, если их не передали в execution_options(report_months=...)
+    if (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete) and any(
+        mapper.class_ in SALES_MODELS for mapper in orm_execute_state.all_mappers
+    ):
+        months = orm_execute_state.execution_options.get("report_months") or {ALL_MONTHS}
+        orm_execute_state.session.info.setdefault("report_months", set()).update(months)
+
+
+@event.listens_for(Session, "before_commit")
+def bump_data_versions_before_commit(session):
+    # flush здесь, а не внутри commit: его изменения тоже должны попасть в версии
+    session.flush()
+    names = {f"sales:{month}" for month in session.info.pop("report_months", ())}
+    if session.info.get("catalog_changed"):
+        names.add(CATALOG_VERSION)
+    insert_or_add(
+        session, DataVersion, [{"name": name, "version": 1} for name in sorted(names)], ["name"], ["version"]
+    )
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_report_changes(session):
+    session.info.pop("report_months", None)
+
+
+# ======================= ОЧЕРЕДЬ ОТЧЕТОВ ======================= #
+# xlsx-файлы строятся в отдельных процессах: пользователь сразу получает ответ
+# «отчёт готовится», а файл приходит, когда задача из очереди будет выполнена.
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+REPORT_QUEUE_SIZE = int(os.getenv("REPORT_QUEUE_SIZE", "20"))
+# Telegram принимает от бота документы до 50 МБ; выгрузки больше режутся на части
+EXPORT_PART_SIZE = int(os.getenv("EXPORT_PART_SIZE", str(49 * 1024 * 1024)))
+
+
+class ReportJobQueue:
+    """Ограниченная очередь задач на генерацию отчётов с пулом процессов"""
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.executor = None
+        self.tasks = []
+        self.in_progress = 0
+        self.completed = 0
+        self.failed = 0
+        self.render_times = collections.deque(maxlen=100)
+
+    def start(self):
+        # spawn вместо fork: пул создаётся при работающих потоках БД и event loop.
+        # Процессы поднимаются сразу, чтобы первый отчёт не ждал их запуска
+        self.executor = start_report_pool(self.workers)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def submit(self, message: types.Message, fetch, render, filename: str, caption: str,
+               empty_text: str = "📭 Нет данных для отчёта.", cache=None, export=False) -> bool:
+        """Ставит отчёт в очередь. fetch(session) выполняется в пуле потоков БД,
+        render(data) -> bytes | None — в пуле процессов. cache — (ключ, persistent)
+        для report_cache. False, если очередь заполнена."""
+        try:
+            self.queue.put_nowait((message, fetch, render, filename, caption, empty_text, cache, export))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def submit_export(self, message: types.Message, fetch_rows, writer, filename: str, caption: str,
+                      empty_text: str = "📭 Нет данных для выгрузки.", cache=None) -> bool:
+        """Ставит выгрузку в очередь. fetch_rows(session) -> итератор строк читается
+        в пуле потоков БД, writer(rows, path) -> число строк пишет файл (или папку)
+        path в пуле процессов. cache — (ключ, persistent) для report_cache, если
+        выгрузка умещается в один файл. False, если очередь заполнена."""
+        return self.submit(message, fetch_rows, writer, filename, caption, empty_text, cache=cache, export=True)
+
+    async def _export(self, message: types.Message, fetch_rows, writer, filename: str, caption: str, empty_text: str,
+                      cache=None):
+        loop = asyncio.get_running_loop()
+        directory = tempfile.mkdtemp(prefix="export_")
+        try:
+            started = time.perf_counter()
+            path = os.path.join(directory, filename)
+            spool_path = os.path.join(directory, "rows.spool")
+            # Поток БД только выбирает строки; форматирование, запись и zip — в пуле процессов
+            count = await run_db(lambda session: spool_rows(fetch_rows(session), spool_path))
+            if not count:
+                await message.answer(empty_text)
+                return
+            await loop.run_in_executor(self.executor, write_spooled, writer, spool_path, path)
+            files = await loop.run_in_executor(self.executor, pack_export, path, EXPORT_PART_SIZE)
+            elapsed = time.perf_counter() - started
+            self.render_times.append(elapsed)
+            logger.info(f"Выгрузка {filename} ({count} строк, файлов: {len(files)}) сформирована за {elapsed * 1000:.0f} мс")
+
+            if cache is not None and len(files) == 1:
+                key, persistent = cache
+                content = await loop.run_in_executor(None, pathlib.Path(files[0]).read_bytes)
+                await loop.run_in_executor(None, report_cache.put, key, content, persistent)
+                await send_document(message, os.path.basename(files[0]), caption, content=content, cache_key=key)
+                return
+
+            for number, file_path in enumerate(files, start=1):
+                part_caption = caption if len(files) == 1 else f"{caption} (часть {number} из {len(files)})"
+                await send_document(message, os.path.basename(file_path), part_caption, path=file_path)
+        finally:
+            await loop.run_in_executor(None, shutil.rmtree, directory, True)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message, fetch, render, filename, caption, empty_text, cache, export = await self.queue.get()
+            self.in_progress += 1
+            try:
+                if export:
+                    await self._export(message, fetch, render, filename, caption, empty_text, cache)
+                    self.completed += 1
+                    continue
+
+                data = await run_db(fetch)
+                started = time.perf_counter()
+                content = await loop.run_in_executor(self.executor, render, data)
+                elapsed = time.perf_counter() - started
+                self.render_times.append(elapsed)
+                logger.info(f"Отчёт {filename} сформирован за {elapsed * 1000:.0f} мс, в очереди: {self.queue.qsize()}")
+
+                if content is None:
+                    await message.answer(empty_text)
+                else:
+                    if cache is not None:
+                        key, persistent = cache
+                        await loop.run_in_executor(None, report_cache.put, key, content, persistent)
+                    await send_document(message, filename, caption, content=content,
+                                        cache_key=cache[0] if cache is not None else None)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка генерации отчета {filename}: {str(e)}")
+                await message.answer("❌ Ошибка при генерации отчета")
+            finally:
+                self.in_progress -= 1
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        times = list(self.render_times)
+        return {
+            "queued": self.queue.qsize(),
+            "in_progress": self.in_progress,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_render_ms": sum(times) / len(times) * 1000 if times else 0.0,
+            "max_render_ms": max(times) * 1000 if times else 0.0,
+        }
+
+
+report_jobs = ReportJobQueue(REPORT_WORKERS, REPORT_QUEUE_SIZE)
+
+
+async def enqueue_report(message: types.Message, fetch, render, filename: str, caption: str, **kwargs):
+    """Ставит отчёт в очередь и сразу отвечает пользователю.
+
+    С cache=(ключ, persistent) файл сначала ищется в report_cache и при
+    попадании отправляется сразу, без очереди.
+    """
+    cache = kwargs.get("cache")
+    if cache is not None:
+        content = await asyncio.get_running_loop().run_in_executor(None, report_cache.get, *cache)
+        if content is not None:
+            await send_document(message, filename, caption, content=content, cache_key=cache[0])
+            return
+    if not report_jobs.submit(message, fetch, render, filename, caption, **kwargs):
+        await message.answer("⏳ Сейчас формируется слишком много отчётов. Попробуйте через минуту.")
+        return
+    await message.answer(f"⏳ Отчёт готовится (в очереди: {report_jobs.queue.qsize()}). Файл придёт отдельным сообщением.")
+
+
+async def enqueue_export(message: types.Message, fetch_rows, writer, filename: str, caption: str, **kwargs):
+    """Ставит выгрузку в файл в очередь и сразу отвечает пользователю.
+
+    С cache=(ключ, persistent) файл сначала ищется в report_cache, как в enqueue_report.
+    """
+    cache = kwargs.get("cache")
+    if cache is not None:
+        content = await asyncio.get_running_loop().run_in_executor(None, report_cache.get, *cache)
+        if content is not None:
+            await send_document(message, filename, caption, content=content, cache_key=cache[0])
+            return
+    if not report_jobs.submit_export(message, fetch_rows, writer, filename, caption, **kwargs):
+        await message.answer("⏳ Сейчас формируется слишком много отчётов. Попробуйте через минуту.")
+        return
+    await message.answer(f"⏳ Выгрузка готовится (в очереди: {report_jobs.queue.qsize()}). Файлы придут отдельными сообщениями.")
+
+
+@dp.startup()
+async def start_report_jobs():
+    report_jobs.start()
+
+
+@dp.shutdown()
+async def stop_report_jobs():
+    await report_jobs.stop()
 
 class RecordSaleState(StatesGroup):
     select_product = State()
@@ -137,10 +1398,6 @@ class RecordSaleState(StatesGroup):
 
 
 
-
-
-
-
 # ======================= СОСТОЯНИЯ FSM ======================= #
 class AddProductState(StatesGroup):
     enter_name = State()
@@ -177,6 +1434,236 @@ def parse_flavor_line(line: str):
         raise ValueError(f"Ошибка в строке: {line}")
 
 
+TELEGRAM_TEXT_LIMIT = 4096
+
+
+def pack_text_blocks(blocks, limit: int = TELEGRAM_TEXT_LIMIT, separator: str = "\n"):
+    """Собирает блоки текста в сообщения не длиннее limit символов.
+
+    Блоки не разрываются между сообщениями; блок длиннее limit делится по строкам.
+    """
+    pages, current = [], ""
+    for block in blocks:
+        parts = [block]
+        if len(block) > limit:
+            parts, piece = [], ""
+            for line in block.split("\n"):
+                if piece and len(piece) + 1 + len(line) > limit:
+                    parts.append(piece)
+                    piece = ""
+                piece = f"{piece}\n{line}" if piece else line[:limit]
+            parts.append(piece)
+        for part in parts:
+            if current and len(current) + len(separator) + len(part) > limit:
+                pages.append(current)
+                current = ""
+            current = f"{current}{separator}{part}" if current else part
+    if current:
+        pages.append(current)
+    return pages
+
+
+def month_bounds(day: datetime.date):
+    """Первый и последний день месяца, в который попадает day"""
+    first_day = datetime.date(day.year, day.month, 1)
+    last_day = datetime.date(
+        day.year + (day.month // 12),
+        (day.month % 12) + 1, 1
+    ) - datetime.timedelta(days=1)
+    return first_day, last_day
+
+
+def date_range_bounds(first_day: datetime.date, last_day: datetime.date = None):
+    """Полуоткрытый интервал [first_day 00:00, last_day + 1 день 00:00) для фильтрации по дате.
+
+    В отличие от func.date(column) == day такие условия используют индекс по колонке даты.
+    """
+    last_day = last_day or first_day
+    return (
+        datetime.datetime.combine(first_day, datetime.time.min),
+        datetime.datetime.combine(last_day + datetime.timedelta(days=1), datetime.time.min)
+    )
+
+
+def _as_date(value):
+    """func.date() в SQLite возвращает строку, в PostgreSQL — date"""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+
+def get_daily_sales_stats(session, first_day: datetime.date, last_day: datetime.date):
+    """Подневная статистика продаж из daily_sales_rollup одним GROUP BY запросом.
+
+    Возвращает список словарей по каждому дню периода (включая дни без продаж):
+    количество продаж, выручка, прибыль и доход Лёни (30% прибыли).
+    """
+    rows = session.query(
+        DailySalesRollup.day,
+        func.sum(DailySalesRollup.sales_count),
+        func.coalesce(func.sum(DailySalesRollup.revenue), 0.0),
+        func.coalesce(func.sum(DailySalesRollup.profit), 0.0)
+    ).filter(
+        DailySalesRollup.day >= first_day,
+        DailySalesRollup.day <= last_day
+    ).group_by(DailySalesRollup.day).all()
+
+    totals = {_as_date(row[0]): row[1:] for row in rows}
+
+    stats = []
+    current = first_day
+    while current <= last_day:
+        count, revenue, profit = totals.get(current, (0, 0.0, 0.0))
+        stats.append({
+            "date": current,
+            "count": count,
+            "revenue": revenue,
+            "profit": profit,
+            "lena_income": profit * 0.3
+        })
+        current += datetime.timedelta(days=1)
+    return stats
+
+
+def get_period_sales_stats(session, periods: dict):
+    """Выручка, прибыль и доход Лёни сразу за несколько периодов одним запросом.
+
+    periods: {"ключ": (начало, конец)} — полуоткрытые интервалы [начало, конец),
+    границы выровнены по суткам (как у date_range_bounds). Считается по daily_sales_rollup.
+    """
+    day = DailySalesRollup.day
+
+    columns = []
+    for start, end in periods.values():
+        in_period = and_(day >= _as_date(start), day < _as_date(end))
+        columns.append(func.coalesce(func.sum(case((in_period, DailySalesRollup.revenue), else_=0.0)), 0.0))
+        columns.append(func.coalesce(func.sum(case((in_period, DailySalesRollup.profit), else_=0.0)), 0.0))
+
+    row = session.query(*columns).filter(
+        day >= _as_date(min(start for start, _ in periods.values())),
+        day < _as_date(max(end for _, end in periods.values()))
+    ).one()
+
+    stats = {}
+    for i, key in enumerate(periods):
+        period_revenue, period_profit = row[2 * i], row[2 * i + 1]
+        stats[key] = (period_revenue, period_profit, period_profit * 0.3)
+    return stats
+
+
+def reserve_stock(session, quantities: dict) -> bool:
+    """Списывает остатки сразу по нескольким вкусам одним UPDATE.
+
+    quantities: {flavor_id: количество}. Строка обновляется, только если
+    quantity >= списываемого количества. Если хотя бы одному вкусу не хватило,
+    возвращается False — вызывающий код должен сделать session.rollback().
+    """
+    if not quantities:
+        return True
+    amount = case(quantities, value=Flavor.id, else_=0)
+    result = session.execute(
+        update(Flavor)
+        .where(Flavor.id.in_(list(quantities)), Flavor.quantity >= amount)
+        .values(quantity=Flavor.quantity - amount)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == len(quantities)
+
+
+def add_stock(session, quantities: dict):
+    """Возвращает/добавляет остатки по нескольким вкусам одним UPDATE (quantity = quantity + n).
+
+    В отличие от flavor.quantity += n в Python не затирает параллельные списания.
+    """
+    if not quantities:
+        return
+    amount = case(quantities, value=Flavor.id, else_=0)
+    session.execute(
+        update(Flavor)
+        .where(Flavor.id.in_(list(quantities)))
+        .values(quantity=Flavor.quantity + amount)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def iter_customer_sales_rows(session, first_day: datetime.date, last_day: datetime.date):
+    """Продажи покупателей за период одним JOIN-запросом, только нужные колонки"""
+    start, end = date_range_bounds(first_day, last_day)
+    return session.query(
+        Customer.date,
+        Customer.name,
+        Product.name,
+        Flavor.name,
+        Sale.quantity,
+        Sale.sale_price
+    ).select_from(Customer).join(
+        Sale, Sale.customer_id == Customer.id
+    ).outerjoin(
+        Product, Product.id == Sale.product_id
+    ).outerjoin(
+        Flavor, Flavor.id == Sale.flavor_id
+    ).filter(
+        Customer.date >= start,
+        Customer.date < end
+    ).order_by(Customer.date, Customer.id, Sale.id).yield_per(500)
+
+
+SALES_JOURNAL_COLUMNS = (
+    "Дата", "Покупатель", "Товар", "Вкус", "Количество",
+    "Закупочная цена", "Цена продажи", "Выручка", "Прибыль", "ID продажи"
+)
+CUSTOMERS_MONTH_COLUMNS = ("Дата", "Покупатель", "Товар", "Вкус", "Количество", "Цена продажи", "Выручка")
+
+
+def iter_customers_month_rows(session, first_day: datetime.date, last_day: datetime.date):
+    """Строки таблицы покупателей за период (колонки CUSTOMERS_MONTH_COLUMNS)"""
+    for customer_date, customer_name, product_name, flavor_name, quantity, sale_price in \
+            iter_customer_sales_rows(session, first_day, last_day):
+        yield (
+            customer_date.strftime("%d.%m.%Y"), customer_name, product_name or "—",
+            flavor_name or "—", quantity, sale_price, quantity * sale_price
+        )
+
+
+def iter_sales_journal_rows(session):
+    """Полный журнал продаж (включая брак) одним JOIN-запросом, построчно через yield_per"""
+    rows = session.query(
+        Sale.date,
+        Customer.name,
+        Product.name,
+        Flavor.name,
+        Sale.quantity,
+        Sale.purchase_price,
+        Sale.sale_price,
+        Sale.id
+    ).select_from(Sale).outerjoin(
+        Customer, Customer.id == Sale.customer_id
+    ).outerjoin(
+        Product, Product.id == Sale.product_id
+    ).outerjoin(
+        Flavor, Flavor.id == Sale.flavor_id
+    ).filter(Sale.date.isnot(None)).order_by(Sale.date, Sale.id).yield_per(1000)
+
+    for date, customer_name, product_name, flavor_name, quantity, purchase_price, sale_price, sale_id in rows:
+        yield (
+            date, customer_name or "", product_name or "—", flavor_name or "—", quantity,
+            purchase_price, sale_price, quantity * sale_price, (sale_price - purchase_price) * quantity, sale_id
+        )
+
+
+def export_writer(export_format, columns):
+    """writer(rows, path) для выгрузки в выбранном формате (для parquet path — папка).
+    functools.partial, а не lambda: writer передаётся в пул процессов."""
+    writers = {"csv": write_rows_csv, "xlsx": write_rows_xlsx, "parquet": write_rows_parquet}
+    return functools.partial(writers[export_format], columns=columns)
+
+
+def export_file_name(name: str, export_format: str) -> str:
+    # Parquet пишется папкой с разбиением по месяцам и уходит в zip
+    return name if export_format == "parquet" else f"{name}.{export_format}"
+
 
 # ======================= ОБРАБОТЧИКИ ======================= #
 
@@ -225,6 +1712,114 @@ async def send_main_menu(message: types.Message):
     )
     await message.answer("🏪 <b>Система управления товарами</b>\nВыберите действие:", reply_markup=markup)
 
+def checkout_cart(session, sales_list, customer_name):
+    """Оформляет корзину одной транзакцией. Возвращает (успех, текст ответа)"""
+    # Суммарное количество по каждому вкусу в корзине
+    requested = {}
+    for sale in sales_list:
+        requested[sale["flavor_id"]] = requested.get(sale["flavor_id"], 0) + sale["quantity"]
+
+    # 🔹 **Шаг 1: Одним запросом получаем все вкусы корзины вместе с товарами**
+    rows = session.query(Flavor, Product).join(
+        Product, Flavor.product_id == Product.id
+    ).filter(Flavor.id.in_(list(requested))).all()
+    cart = {flavor.id: (flavor, product) for flavor, product in rows}
+
+    insufficient_stock = []
+    for sale in sales_list:
+        if sale["flavor_id"] not in cart:
+            insufficient_stock.append(f"❌ {sale['flavor_name']} (нет в наличии)")
+            continue
+        flavor, _ = cart[sale["flavor_id"]]
+        if flavor.quantity < requested[sale["flavor_id"]]:
+            insufficient_stock.append(f"❌ {sale['flavor_name']} (в наличии: {flavor.quantity})")
+
+    # Если товара не хватает, сообщаем об этом пользователю и прерываем продажу
+    if insufficient_stock:
+        return False, "❌ Ошибка: недостаточно товара!\n" + "\n".join(insufficient_stock)
+
+    # 🔹 **Шаг 2: Списываем остатки одним UPDATE ... WHERE quantity >= n**
+    if not reserve_stock(session, requested):
+        session.rollback()
+        return False, "❌ Ошибка: остатки изменились во время оформления. Попробуйте ещё раз."
+
+    # Проверяем, есть ли уже покупатель в БД
+    customer = session.query(Customer).filter_by(name=customer_name).first()
+    if not customer:
+        customer = Customer(name=customer_name, date=datetime.datetime.now())
+        session.add(customer)
+        session.flush()  # нужен customer.id для пакетной вставки продаж
+
+    total_revenue = 0
+    total_profit = 0
+    sale_texts = []
+
+    # Вычисляем общие количества для каждого товара (суммируем по всем вкусам)
+    product_totals = {}
+    for sale in sales_list:
+        _, product = cart[sale["flavor_id"]]
+        product_totals[product.id] = product_totals.get(product.id, 0) + sale["quantity"]
+
+    # 🔹 **Шаг 3: Записываем продажи**
+    now = datetime.datetime.now()
+    sale_records = []
+    for sale in sales_list:
+        flavor, product = cart[sale["flavor_id"]]
+
+        # Выбираем цену в зависимости от общего количества проданного товара данного вида
+        if product_totals[product.id] >= 2:
+            sale_price = product.sale_price_2  # Цена за 2 шт
+        else:
+            sale_price = product.sale_price  # Цена за 1 шт
+
+        # Создаем запись о продаже
+        sale_record = Sale(
+            product_id=product.id,
+            flavor_id=flavor.id,
+            customer_id=customer.id,
+            quantity=sale["quantity"],
+            purchase_price=product.purchase_price,
+            sale_price=sale_price,  # Используем выбранную цену
+            date=now
+        )
+        sale_records.append(sale_record)
+
+        # Рассчитываем выручку и прибыль
+        revenue = sale["quantity"] * sale_price
+        profit = (sale_price - product.purchase_price) * sale["quantity"]
+        total_revenue += revenue
+        total_profit += profit
+
+        # Добавляем информацию о продаже в итоговое сообщение
+        sale_texts.append(
+            f"📦 <b>{sale['product_name']}</b> - {sale['flavor_name']} - {sale['quantity']} шт. ({sale_price} ₽/шт)")
+
+    # Одна пакетная вставка вместо INSERT на каждую строку корзины
+    session.bulk_save_objects(sale_records)
+    add_sales_to_rollup(session, sale_records)
+
+    # 30% прибыли — доход рабочего за текущую неделю
+    lena_income = total_profit * 0.3
+    credit_worker_income(session, lena_income)
+
+    # ✅ Сохраняем изменения в БД **одним коммитом**
+    session.commit()
+
+    sale_lines = '\n'.join(sale_texts)
+
+    # ✅ Формируем итоговое сообщение
+    response_text = (
+        f"✅ <b>Продажа завершена!</b>\n"
+        f"📅 <b>Дата:</b> {now.strftime('%d.%m.%Y %H:%M')}\n"
+        f"👤 <b>Покупатель:</b> {customer_name}\n\n"
+        f"{sale_lines}\n"
+        f"💰 <b>Общая выручка:</b> {total_revenue:.2f} ₽\n"
+        f"📊 <b>Прибыль:</b> {total_profit:.2f} ₽\n"
+        f"👨💼 <b>Доход Лёни:</b> {lena_income:.2f} ₽"
+    )
+    return True, response_text
+
+
 async def save_sale(message: types.Message, state: FSMContext):
     """Сохранение продажи с привязкой к покупателю и корректным обновлением количества товара"""
 
@@ -240,150 +1835,70 @@ async def save_sale(message: types.Message, state: FSMContext):
     # Извлекаем имя покупателя из состояния
     customer_name = data.get("customer_name", "Покупатель 1")  # По умолчанию, если имя не указано
 
-    with Session() as session:
-        # Проверяем, есть ли уже покупатель в БД
-        customer = session.query(Customer).filter_by(name=customer_name).first()
-        if not customer:
-            customer = Customer(name=customer_name, date=datetime.datetime.now())
-            session.add(customer)
-            session.commit()
-
-        total_revenue = 0
-        total_profit = 0
-        sale_texts = []
-        insufficient_stock = []
-
-        # 🔹 **Шаг 1: Проверяем, хватает ли товаров (без уменьшения количества)**
-        for sale in data["sales_list"]:
-            product = session.query(Product).filter_by(name=sale["product_name"]).first()
-            flavor = session.query(Flavor).filter_by(name=sale["flavor_name"], product_id=product.id).first()
-
-            if not flavor:
-                insufficient_stock.append(f"❌ {sale['flavor_name']} (нет в наличии)")
-                continue
-
-            session.refresh(flavor)  # Обновляем данные из БД
-            if flavor.quantity < sale["quantity"]:
-                insufficient_stock.append(f"❌ {sale['flavor_name']} (в наличии: {flavor.quantity})")
-
-        # Если товара не хватает, сообщаем об этом пользователю и прерываем продажу
-        if insufficient_stock:
-            await message.answer("❌ Ошибка: недостаточно товара!\n" + "\n".join(insufficient_stock))
-            return
-
-        # Вычисляем общие количества для каждого товара (суммируем по всем вкусам)
-        product_totals = {}
-        for sale in data["sales_list"]:
-            product_totals[sale["product_name"]] = product_totals.get(sale["product_name"], 0) + sale["quantity"]
-
-        # 🔹 **Шаг 2: Уменьшаем количество товаров и записываем продажу**
-        for sale in data["sales_list"]:
-            product = session.query(Product).filter_by(name=sale["product_name"]).first()
-            flavor = session.query(Flavor).filter_by(name=sale["flavor_name"], product_id=product.id).first()
-
-            # Проверяем, достаточно ли товара на складе
-            if flavor.quantity < sale["quantity"]:
-                insufficient_stock.append(f"❌ {sale['flavor_name']} (в наличии: {flavor.quantity})")
-                continue
-
-            # Выбираем цену в зависимости от общего количества проданного товара данного вида
-            if product_totals[sale["product_name"]] >= 2:
-                sale_price = product.sale_price_2  # Цена за 2 шт
-            else:
-                sale_price = product.sale_price  # Цена за 1 шт
-
-            # Уменьшаем количество на складе
-            new_quantity = flavor.quantity - sale["quantity"]
-            session.query(Flavor).filter_by(id=flavor.id).update({"quantity": new_quantity})
-
-            # Создаем запись о продаже
-            sale_record = Sale(
-                product=product,
-                flavor=flavor,
-                customer=customer,
-                quantity=sale["quantity"],
-                purchase_price=product.purchase_price,
-                sale_price=sale_price  # Используем выбранную цену
-            )
-            session.add(sale_record)
-
-            # Рассчитываем выручку и прибыль
-            revenue = sale["quantity"] * sale_price
-            profit = (sale_price - product.purchase_price) * sale["quantity"]
-            total_revenue += revenue
-            total_profit += profit
-
-            # Добавляем информацию о продаже в итоговое сообщение
-            sale_texts.append(
-                f"📦 <b>{sale['product_name']}</b> - {sale['flavor_name']} - {sale['quantity']} шт. ({sale_price} ₽/шт)")
-
-        # ✅ Сохраняем изменения в БД **одним коммитом**
-        session.commit()
-
-        sale_lines = '\n'.join(sale_texts)
+    # Вся работа с БД выполняется в пуле потоков, не блокируя остальных пользователей
+    ok, response_text = await run_db(checkout_cart, data["sales_list"], customer_name)
+    await message.answer(response_text, parse_mode="HTML")
+    if not ok:
+        return
 
-        # ✅ Формируем итоговое сообщение
-        response_text = (
-            f"✅ <b>Продажа завершена!</b>\n"
-            f"📅 <b>Дата:</b> {datetime.datetime.now().strftime('%d.%m.%Y %H:%M')}\n"
-            f"👤 <b>Покупатель:</b> {customer_name}\n\n"
-            f"{sale_lines}\n"
-            f"💰 <b>Общая выручка:</b> {total_revenue:.2f} ₽\n"
-            f"📊 <b>Прибыль:</b> {total_profit:.2f} ₽"
-        )
+    await state.clear()  # ✅ Очищаем состояние, чтобы избежать ошибок "используйте кнопки меню"
 
-        await message.answer(response_text, parse_mode="HTML")
 
-    await state.clear()  # ✅ Очищаем состояние, чтобы избежать ошибок "используйте кнопки меню"
+def load_defect_products(session):
+    """Товары, по которым есть записи брака (customer is None): [(id, название)]"""
+    products = session.query(Product).join(Sale).filter(Sale.customer == None).distinct().all()
+    return [(p.id, p.name) for p in products]
 
 
 @dp.message(F.text == "Брак")
 async def start_defect_recording(message: types.Message, state: FSMContext):
     try:
-        with Session() as session:
-            # Выбираем только товары, по которым есть записи брака (customer is None)
-            products = session.query(Product).join(Sale).filter(Sale.customer == None).distinct().all()
-            if not products:
-                markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                    [types.InlineKeyboardButton(text="Добавить брак", callback_data="register_defect_new")]
-                ])
-                await message.answer("📭 Нет зарегистрированного брака за всё время.", reply_markup=markup)
-                return
-            product_buttons = [
-                [types.InlineKeyboardButton(text=p.name, callback_data=f"defect_product_{p.id}")]
-                for p in products
-            ]
-            # Добавляем дополнительную кнопку для регистрации брака и кнопку "🔙 Назад"
-            product_buttons.append([types.InlineKeyboardButton(text="Добавить брак", callback_data="register_defect_new")])
-            product_buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main_menu")])
-            markup = types.InlineKeyboardMarkup(inline_keyboard=product_buttons)
-            await message.answer("📋 Список товаров с зарегистрированным браком:", reply_markup=markup)
-            await state.set_state(RecordDefectState.select_product)
+        products = await run_db(load_defect_products)
+        if not products:
+            markup = types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text="Добавить брак", callback_data="register_defect_new")]
+            ])
+            await message.answer("📭 Нет зарегистрированного брака за всё время.", reply_markup=markup)
+            return
+        product_buttons = [
+            [types.InlineKeyboardButton(text=name, callback_data=f"defect_product_{product_id}")]
+            for product_id, name in products
+        ]
+        # Добавляем дополнительную кнопку для регистрации брака и кнопку "🔙 Назад"
+        product_buttons.append([types.InlineKeyboardButton(text="Добавить брак", callback_data="register_defect_new")])
+        product_buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main_menu")])
+        markup = types.InlineKeyboardMarkup(inline_keyboard=product_buttons)
+        await message.answer("📋 Список товаров с зарегистрированным браком:", reply_markup=markup)
+        await state.set_state(RecordDefectState.select_product)
     except Exception as e:
         logger.error(f"Ошибка при загрузке товаров для брака: {str(e)}")
         await message.answer("❌ Ошибка при загрузке товаров для брака")
 
 
+def build_defect_history_text(session, product_id):
+    product = session.get(Product, product_id)
+    defects = session.query(Sale).filter_by(product_id=product_id, customer=None).all()
+    if not defects:
+        defect_info = "Нет зарегистрированного брака."
+    else:
+        total_defect_qty = sum(defect.quantity for defect in defects)
+        total_loss = product.purchase_price * total_defect_qty
+        defect_info = (f"Общее количество брака: {total_defect_qty} шт.\n"
+                       f"Убыток: {total_loss:.2f} ₽")
+    return f"📌 Товар: {product.name}\n{defect_info}"
+
+
 @dp.callback_query(F.data.startswith("defect_product_"), RecordDefectState.select_product)
 async def show_defect_history(callback: types.CallbackQuery, state: FSMContext):
     product_id = int(callback.data.split("_")[-1])
     await state.update_data(product_id=product_id)
-    with Session() as session:
-        product = session.query(Product).get(product_id)
-        defects = session.query(Sale).filter_by(product_id=product_id, customer=None).all()
-        if not defects:
-            defect_info = "Нет зарегистрированного брака."
-        else:
-            total_defect_qty = sum(defect.quantity for defect in defects)
-            total_loss = product.purchase_price * total_defect_qty
-            defect_info = (f"Общее количество брака: {total_defect_qty} шт.\n"
-                           f"Убыток: {total_loss:.2f} ₽")
-        markup = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="Зарегистрировать новый брак", callback_data=f"register_defect_{product_id}")],
-            [types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_defect_list")]
-        ])
-        await callback.message.edit_text(f"📌 Товар: {product.name}\n{defect_info}", reply_markup=markup)
-        await state.set_state(RecordDefectState.select_product)
+    text = await run_db(build_defect_history_text, product_id)
+    markup = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="Зарегистрировать новый брак", callback_data=f"register_defect_{product_id}")],
+        [types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_defect_list")]
+    ])
+    await callback.message.edit_text(text, reply_markup=markup)
+    await state.set_state(RecordDefectState.select_product)
 
 @dp.callback_query(F.data == "back_to_defect_list", RecordDefectState.select_product)
 async def back_to_defect_list(callback: types.CallbackQuery, state: FSMContext):
@@ -393,35 +1908,22 @@ async def back_to_defect_list(callback: types.CallbackQuery, state: FSMContext):
 async def register_defect_start(callback: types.CallbackQuery, state: FSMContext):
     product_id = int(callback.data.split("_")[-1])
     await state.update_data(product_id=product_id)
-    with Session() as session:
-        product = session.query(Product).get(product_id)
-        if not product or not product.flavors:
-            await callback.answer("❌ Нет доступных вкусов для этого товара!", show_alert=True)
-            return
-        flavor_buttons = [
-            [types.InlineKeyboardButton(text=f"{flavor.name} ({flavor.quantity})", callback_data=f"defect_flavor_{flavor.id}")]
-            for flavor in product.flavors if flavor.quantity > 0
-        ]
-        flavor_buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_defect_list")])
-        markup = types.InlineKeyboardMarkup(inline_keyboard=flavor_buttons)
-        await callback.message.edit_text("Выберите вкус для регистрации брака:", reply_markup=markup)
-        await state.set_state(RecordDefectState.select_flavor)
+    markup = flavor_picker(await catalog.get(), "defect", product_id)
+    if markup is None:
+        await callback.answer("❌ Нет доступных вкусов для этого товара!", show_alert=True)
+        return
+    await callback.message.edit_text("Выберите вкус для регистрации брака:", reply_markup=markup)
+    await state.set_state(RecordDefectState.select_flavor)
 
 @dp.callback_query(F.data == "back_to_defect_products", RecordDefectState.select_flavor)
 async def back_to_defect_products(callback: types.CallbackQuery, state: FSMContext):
-    with Session() as session:
-        products = session.query(Product).all()
-        if not products:
-            await callback.message.answer("❌ Нет товаров для брака")
-            return
-        product_buttons = [
-            [types.InlineKeyboardButton(text=p.name, callback_data=f"defect_product_{p.id}")]
-            for p in products
-        ]
-        product_buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main_menu")])
-        markup = types.InlineKeyboardMarkup(inline_keyboard=product_buttons)
-        await callback.message.edit_text("Выберите товар для брака:", reply_markup=markup)
-        await state.set_state(RecordDefectState.select_product)
+    snapshot = await catalog.get()
+    if not snapshot.products:
+        await callback.message.answer("❌ Нет товаров для брака")
+        return
+    markup = product_picker(snapshot, "defect")
+    await callback.message.edit_text("Выберите товар для брака:", reply_markup=markup)
+    await state.set_state(RecordDefectState.select_product)
 
 @dp.callback_query(F.data.startswith("defect_flavor_"), RecordDefectState.select_flavor)
 async def select_defect_flavor(callback: types.CallbackQuery, state: FSMContext):
@@ -430,6 +1932,43 @@ async def select_defect_flavor(callback: types.CallbackQuery, state: FSMContext)
     await callback.message.edit_text("Введите количество бракованных единиц:")
     await state.set_state(RecordDefectState.enter_quantity)
 
+def register_defect(session, product_id, flavor_id, quantity):
+    """Списывает брак со склада и из дохода рабочего. Возвращает (успех, текст ответа)"""
+    product = session.get(Product, product_id)
+    flavor = session.get(Flavor, flavor_id)
+    # Вычитаем брак из остатка атомарно (UPDATE ... WHERE quantity >= n)
+    if flavor.quantity < quantity or not reserve_stock(session, {flavor.id: quantity}):
+        session.rollback()
+        return False, f"❌ Недостаточно товара на складе! Осталось: {flavor.quantity}"
+
+    # Регистрируем брак как запись в таблице продаж:
+    sale_record = Sale(
+        product=product,
+        flavor=flavor,
+        customer=None,  # для брака покупатель не нужен
+        quantity=quantity,
+        purchase_price=product.purchase_price,
+        sale_price=0
+    )
+    session.add(sale_record)
+    add_sale_to_rollup(session, sale_record)
+
+    # Вычисляем сумму брака и обновляем доход рабочего:
+    defective_amount = product.purchase_price * quantity
+    # Вычитается 30% убытка (рабочему вычтено 30%, магазин – 70%)
+    credit_worker_income(session, -defective_amount * 0.3)
+
+    text = (
+        f"✅ Брак зарегистрирован!\n"
+        f"📦 Товар: {product.name}\n"
+        f"🍏 Вкус: {flavor.name}\n"
+        f"🔢 Количество: {quantity} шт.\n"
+        f"💰 Убыток: {defective_amount:.2f} ₽ (из них рабочему вычтено: {defective_amount * 0.3:.2f} ₽)"
+    )
+    session.commit()
+    return True, text
+
+
 @dp.message(RecordDefectState.enter_quantity)
 async def enter_defect_quantity(message: types.Message, state: FSMContext):
     try:
@@ -438,52 +1977,10 @@ async def enter_defect_quantity(message: types.Message, state: FSMContext):
             await message.answer("❌ Количество должно быть положительным!")
             return
         data = await state.get_data()
-        with Session() as session:
-            product = session.query(Product).get(data["product_id"])
-            flavor = session.query(Flavor).get(data["flavor_id"])
-            if flavor.quantity < quantity:
-                await message.answer(f"❌ Недостаточно товара на складе! Осталось: {flavor.quantity}")
-                return
-            # Вычитаем брак из остатка
-            flavor.quantity -= quantity
-
-            # Регистрируем брак как запись в таблице продаж:
-            sale_record = Sale(
-                product=product,
-                flavor=flavor,
-                customer=None,  # для брака покупатель не нужен
-                quantity=quantity,
-                purchase_price=product.purchase_price,
-                sale_price=0
-            )
-            session.add(sale_record)
-
-            # Вычисляем сумму брака и обновляем доход рабочего:
-            defective_amount = product.purchase_price * quantity
-            today = datetime.datetime.now().date()
-            current_week_start = datetime.datetime.combine(
-                today - datetime.timedelta(days=today.weekday()),
-                datetime.time.min
-            )
-            income_record = session.query(WorkerIncome).filter(WorkerIncome.week_start == current_week_start).first()
-            if not income_record:
-                income_record = WorkerIncome(
-                    week_start=current_week_start,
-                    income=0.0,
-                    is_current=True
-                )
-                session.add(income_record)
-            # Вычитается 30% убытка (рабочему вычтено 30%, магазин – 70%)
-            income_record.income -= defective_amount * 0.3
-
-            session.commit()
-            await message.answer(
-                f"✅ Брак зарегистрирован!\n"
-                f"📦 Товар: {product.name}\n"
-                f"🍏 Вкус: {flavor.name}\n"
-                f"🔢 Количество: {quantity} шт.\n"
-                f"💰 Убыток: {defective_amount:.2f} ₽ (из них рабочему вычтено: {defective_amount * 0.3:.2f} ₽)"
-            )
+        ok, text = await run_db(register_defect, data["product_id"], data["flavor_id"], quantity)
+        await message.answer(text)
+        if not ok:
+            return
         await state.clear()
     except ValueError:
         await message.answer("❌ Введите корректное целое число!")
@@ -495,21 +1992,13 @@ async def enter_defect_quantity(message: types.Message, state: FSMContext):
 @dp.callback_query(F.data == "register_defect_new")
 
 async def register_defect_new(callback: types.CallbackQuery, state: FSMContext):
-    with Session() as session:
-        products = session.query(Product).all()
-        if not products:
-            await callback.message.answer("❌ Нет товаров для брака")
-            return
-        product_buttons = [
-            [types.InlineKeyboardButton(text=p.name, callback_data=f"defect_product_{p.id}")]
-            for p in products
-        ]
-        product_buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main_menu")])
-        markup = types.InlineKeyboardMarkup(inline_keyboard=product_buttons)
-        await callback.message.edit_text("Выберите товар для регистрации брака:", reply_markup=markup)
-        await state.set_state(RecordDefectState.select_product)
-
-
+    snapshot = await catalog.get()
+    if not snapshot.products:
+        await callback.message.answer("❌ Нет товаров для брака")
+        return
+    markup = product_picker(snapshot, "defect")
+    await callback.message.edit_text("Выберите товар для регистрации брака:", reply_markup=markup)
+    await state.set_state(RecordDefectState.select_product)
 
 
 
@@ -523,24 +2012,9 @@ async def back_to_customers_list(callback: types.CallbackQuery, state: FSMContex
 async def back_to_sales_list(callback: types.CallbackQuery, state: FSMContext):
     """Возврат к списку продаж покупателя"""
     data = await state.get_data()
-    customer_id = data.get('customer_id')
-
-    with Session() as session:
-        customer = session.get(Customer, customer_id)
-        sales = session.query(Sale).filter_by(customer_id=customer_id).all()
-
-        buttons = [
-            [InlineKeyboardButton(
-                text=f"{sale.product.name} - {sale.flavor.name} ({sale.quantity} шт.)",
-                callback_data=f"select_sale_{sale.id}"
-            )] for sale in sales
-        ]
-        buttons.append([InlineKeyboardButton(text="🗑️ Удалить все продажи", callback_data="delete_all_sales")])
-        buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_customers")])
-
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text(f"Продажи покупателя {customer.name}:", reply_markup=markup)
-        await state.set_state(EditSaleState.select_sale)
+    text, markup, _ = await run_db(build_customer_sales_menu, data.get('customer_id'))
+    await callback.message.edit_text(text, reply_markup=markup)
+    await state.set_state(EditSaleState.select_sale)
 
 
 
@@ -568,22 +2042,45 @@ async def ask_for_customer_name(callback: types.CallbackQuery, state: FSMContext
     await callback.message.edit_text("Добавить имя покупателя?", reply_markup=markup)
 
 
+def load_customers(session):
+    """Покупатели, новые первыми: [(id, имя)]"""
+    return [(customer.id, customer.name) for customer in session.query(Customer).order_by(Customer.id.desc())]
+
+
 @dp.message(F.text == "✏️ Редактировать продажи")
 async def start_edit_sale(message: types.Message, state: FSMContext):
     """Начало процесса редактирования продажи"""
-    with Session() as session:
-        customers = session.query(Customer).order_by(Customer.id.desc()).all()
-        if not customers:
-            await message.answer("❌ Нет покупателей для редактирования")
-            return
+    customers = await run_db(load_customers)
+    if not customers:
+        await message.answer("❌ Нет покупателей для редактирования")
+        return
+
+    buttons = [
+        [InlineKeyboardButton(text=f"👤 {name}", callback_data=f"edit_customer_{customer_id}")]
+        for customer_id, name in customers
+    ]
+    markup = InlineKeyboardMarkup(inline_keyboard=buttons)
+    await message.answer("Выберите покупателя:", reply_markup=markup)
+    await state.set_state(EditSaleState.select_customer)
 
-        buttons = [
-            [InlineKeyboardButton(text=f"👤 {customer.name}", callback_data=f"edit_customer_{customer.id}")]
-            for customer in customers
-        ]
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await message.answer("Выберите покупателя:", reply_markup=markup)
-        await state.set_state(EditSaleState.select_customer)
+
+def build_customer_sales_menu(session, customer_id):
+    """Список продаж покупателя: (текст, клавиатура, число продаж)"""
+    customer = session.get(Customer, customer_id)
+    sales = session.query(Sale).filter_by(customer_id=customer_id).all()
+
+    buttons = [
+        [InlineKeyboardButton(
+            text=f"{sale.product.name} - {sale.flavor.name} ({sale.quantity} шт.)",
+            callback_data=f"select_sale_{sale.id}"
+        )] for sale in sales
+    ]
+    # Добавляем кнопку "Удалить все продажи" и "Назад"
+    buttons.append([InlineKeyboardButton(text="🗑️ Удалить все продажи", callback_data="delete_all_sales")])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_customers")])
+
+    text = f"Продажи покупателя {customer.name}:" if customer else ""
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons), len(sales)
 
 
 @dp.callback_query(F.data.startswith("edit_customer_"), EditSaleState.select_customer)
@@ -592,32 +2089,14 @@ async def select_customer_sales(callback: types.CallbackQuery, state: FSMContext
     customer_id = int(callback.data.split("_")[-1])
     await state.update_data(customer_id=customer_id)
 
-    with Session() as session:
-        customer = session.get(Customer, customer_id)
-        sales = session.query(Sale).filter_by(customer_id=customer_id).all()
-
-        if not sales:
-            await callback.answer("❌ У этого покупателя нет продаж", show_alert=True)
-            await state.clear()
-            return
-
-        buttons = [
-            [InlineKeyboardButton(
-                text=f"{sale.product.name} - {sale.flavor.name} ({sale.quantity} шт.)",
-                callback_data=f"select_sale_{sale.id}"
-            )] for sale in sales
-        ]
-        # Добавляем кнопку "Удалить все продажи" и "Назад"
-        buttons.append([InlineKeyboardButton(text="🗑️ Удалить все продажи", callback_data="delete_all_sales")])
-        buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_customers")])
-
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
+    text, markup, sales_count = await run_db(build_customer_sales_menu, customer_id)
+    if not sales_count:
+        await callback.answer("❌ У этого покупателя нет продаж", show_alert=True)
+        await state.clear()
+        return
 
-        await callback.message.edit_text(
-            f"Продажи покупателя {customer.name}:",
-            reply_markup=markup
-        )
-        await state.set_state(EditSaleState.select_sale)
+    await callback.message.edit_text(text, reply_markup=markup)
+    await state.set_state(EditSaleState.select_sale)
 
 
 @dp.callback_query(F.data == "delete_all_sales", EditSaleState.select_sale)
@@ -633,35 +2112,45 @@ async def delete_all_sales_confirmation(callback: types.CallbackQuery, state: FS
     )
 
 
-@dp.callback_query(F.data == "confirm_delete_all_sales", EditSaleState.select_sale)
-async def confirm_delete_all_sales(callback: types.CallbackQuery, state: FSMContext):
-    """Удаление всех продаж покупателя с возвратом товаров на склад и удалением покупателя"""
-    data = await state.get_data()
-    customer_id = data.get('customer_id')
+def delete_customer_sales(session, customer_id):
+    """Удаляет все продажи покупателя и его самого, возвращая товары на склад.
+    Возвращает имя покупателя или None, если продаж нет"""
+    customer = session.get(Customer, customer_id)
+    sales = session.query(Sale).filter_by(customer_id=customer_id).all()
+    if not sales:
+        return None
 
-    with Session() as session:
-        customer = session.get(Customer, customer_id)
-        sales = session.query(Sale).filter_by(customer_id=customer_id).all()
+    # Возвращаем товары на склад и убираем продажи из итогов по дням
+    returned = {}
+    for sale in sales:
+        if sale.flavor_id is not None:
+            returned[sale.flavor_id] = returned.get(sale.flavor_id, 0) + sale.quantity
+        add_sale_to_rollup(session, sale, sign=-1)
+    add_stock(session, returned)
 
-        if not sales:
-            await callback.answer("❌ Нет продаж для удаления", show_alert=True)
-            return
+    # Удаляем все продажи покупателя
+    session.query(Sale).filter_by(customer_id=customer_id).delete()
 
-        # Возвращаем товары на склад
-        for sale in sales:
-            sale.flavor.quantity += sale.quantity
+    # Удаляем покупателя из списка
+    name = customer.name
+    session.delete(customer)
+    session.commit()
+    return name
 
-        # Удаляем все продажи покупателя
-        session.query(Sale).filter_by(customer_id=customer_id).delete()
 
-        # Удаляем покупателя из списка
-        session.delete(customer)
-        session.commit()
+@dp.callback_query(F.data == "confirm_delete_all_sales", EditSaleState.select_sale)
+async def confirm_delete_all_sales(callback: types.CallbackQuery, state: FSMContext):
+    """Удаление всех продаж покупателя с возвратом товаров на склад и удалением покупателя"""
+    data = await state.get_data()
 
-        await callback.message.edit_text(
-            f"✅ Все продажи покупателя {customer.name} удалены. Товары возвращены на склад. Покупатель удален из списка."
-        )
+    name = await run_db(delete_customer_sales, data.get('customer_id'))
+    if name is None:
+        await callback.answer("❌ Нет продаж для удаления", show_alert=True)
+        return
 
+    await callback.message.edit_text(
+        f"✅ Все продажи покупателя {name} удалены. Товары возвращены на склад. Покупатель удален из списка."
+    )
     await state.clear()
 
 
@@ -670,27 +2159,39 @@ async def confirm_delete_all_sales(callback: types.CallbackQuery, state: FSMCont
 async def cancel_delete_all_sales(callback: types.CallbackQuery, state: FSMContext):
     """Отмена удаления всех продаж"""
     data = await state.get_data()
-    customer_id = data.get('customer_id')
+    text, markup, _ = await run_db(build_customer_sales_menu, data.get('customer_id'))
+    await callback.message.edit_text(text, reply_markup=markup)
+    await state.set_state(EditSaleState.select_sale)
+
 
-    with Session() as session:
-        customer = session.get(Customer, customer_id)
-        sales = session.query(Sale).filter_by(customer_id=customer_id).all()
-
-        buttons = [
-            [InlineKeyboardButton(
-                text=f"{sale.product.name} - {sale.flavor.name} ({sale.quantity} шт.)",
-                callback_data=f"select_sale_{sale.id}"
-            )] for sale in sales
-        ]
-        buttons.append([InlineKeyboardButton(text="🗑️ Удалить все продажи", callback_data="delete_all_sales")])
-        buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_customers")])
 
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text(f"Продажи покупателя {customer.name}:", reply_markup=markup)
-        await state.set_state(EditSaleState.select_sale)
+def build_sale_text(session, sale_id, with_product=False):
+    """Описание продажи для меню действий или None, если продажи нет.
+    with_product добавляет цены и остатки товара"""
+    sale = session.get(Sale, sale_id)
+    if not sale:
+        return None
 
+    sale_info = (
+        f"📦 Товар: {sale.product.name}\n"
+        f"🍏 Вкус: {sale.flavor.name}\n"
+        f"🔢 Количество: {sale.quantity} шт.\n\n"
+        "Выберите действие:"
+    )
+    if not with_product:
+        return sale_info
 
+    product = sale.product
+    # Собираем информацию о товаре
+    product_info = f"📌 <b>{product.name.upper()}</b>\n"
+    product_info += f"Закуп: {int(product.purchase_price)}₽\n"
+    product_info += f"Продажа: {int(product.sale_price)}₽\n"
+    product_info += f"Акция (от 2 шт): {int(product.sale_price_2)}₽\n"
+    product_info += "Остатки по вкусам:\n"
+    for flavor in product.flavors:
+        product_info += f" - {flavor.name}: {flavor.quantity} шт.\n"
 
+    return product_info + "\nТекущая продажа:\n" + sale_info
 
 
 @dp.callback_query(F.data.startswith("select_sale_"), EditSaleState.select_sale)
@@ -699,56 +2200,27 @@ async def select_sale_action(callback: types.CallbackQuery, state: FSMContext):
     sale_id = int(callback.data.split("_")[-1])
     await state.update_data(sale_id=sale_id)
 
-    with Session() as session:
-        sale = session.get(Sale, sale_id)
-        if not sale:
-            await callback.answer("❌ Продажа не найдена", show_alert=True)
-            return
-
-        product = sale.product
-        # Собираем информацию о товаре
-        product_info = f"📌 <b>{product.name.upper()}</b>\n"
-        product_info += f"Закуп: {int(product.purchase_price)}₽\n"
-        product_info += f"Продажа: {int(product.sale_price)}₽\n"
-        product_info += f"Акция (от 2 шт): {int(product.sale_price_2)}₽\n"
-        product_info += "Остатки по вкусам:\n"
-        for flavor in product.flavors:
-            product_info += f" - {flavor.name}: {flavor.quantity} шт.\n"
-
-        # Информация о текущей продаже
-        sale_info = (
-            f"\nТекущая продажа:\n"
-            f"📦 Товар: {sale.product.name}\n"
-            f"🍏 Вкус: {sale.flavor.name}\n"
-            f"🔢 Количество: {sale.quantity} шт.\n\n"
-            "Выберите действие:"
-        )
-
-        full_text = product_info + sale_info
+    full_text = await run_db(build_sale_text, sale_id, True)
+    if full_text is None:
+        await callback.answer("❌ Продажа не найдена", show_alert=True)
+        return
 
-        markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✏️ Редактировать", callback_data="edit_sale")],
-            [InlineKeyboardButton(text="➕ Добавить товар", callback_data="add_product_to_sale")],
-            [InlineKeyboardButton(text="🗑️ Удалить", callback_data="delete_sale")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_sales_list")]
-        ])
-        await callback.message.edit_text(full_text, reply_markup=markup, parse_mode="HTML")
-        await state.set_state(EditSaleState.select_action)
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✏️ Редактировать", callback_data="edit_sale")],
+        [InlineKeyboardButton(text="➕ Добавить товар", callback_data="add_product_to_sale")],
+        [InlineKeyboardButton(text="🗑️ Удалить", callback_data="delete_sale")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_sales_list")]
+    ])
+    await callback.message.edit_text(full_text, reply_markup=markup, parse_mode="HTML")
+    await state.set_state(EditSaleState.select_action)
 
 
 @dp.callback_query(F.data == "add_product_to_sale", EditSaleState.select_action)
 async def add_product_to_sale(callback: types.CallbackQuery, state: FSMContext):
     """Добавление товара в продажу"""
-    with Session() as session:
-        products = session.query(Product).all()
-        buttons = [
-            [InlineKeyboardButton(text=product.name, callback_data=f"add_product_{product.id}")]
-            for product in products
-        ]
-        buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_sale_actions")])
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text("Выберите товар для добавления в продажу:", reply_markup=markup)
-        await state.set_state(EditSaleState.select_product)
+    markup = product_picker(await catalog.get(), "add_to_sale")
+    await callback.message.edit_text("Выберите товар для добавления в продажу:", reply_markup=markup)
+    await state.set_state(EditSaleState.select_product)
 
 @dp.callback_query(F.data.startswith("add_product_"), EditSaleState.select_product)
 async def select_product_to_add(callback: types.CallbackQuery, state: FSMContext):
@@ -756,24 +2228,20 @@ async def select_product_to_add(callback: types.CallbackQuery, state: FSMContext
     product_id = int(callback.data.split("_")[-1])
     await state.update_data(product_id=product_id)
 
-    with Session() as session:
-        product = session.get(Product, product_id)
-        flavors = [flavor for flavor in product.flavors if flavor.quantity > 0]  # Убираем закончившиеся вкусы
+    markup = flavor_picker(await catalog.get(), "add_to_sale", product_id)  # только вкусы в наличии
 
-        if not flavors:
-            await callback.answer("❌ Нет доступных вкусов для этого товара!", show_alert=True)
-            await add_product_to_sale(callback, state)
-            return
+    if markup is None:
+        await callback.answer("❌ Нет доступных вкусов для этого товара!", show_alert=True)
+        await add_product_to_sale(callback, state)
+        return
+
+    await callback.message.edit_text("Выберите вкус для добавления в продажу:", reply_markup=markup)
+    await state.set_state(EditSaleState.select_flavor)
 
-        buttons = [
-            [InlineKeyboardButton(text=f"{flavor.name} ({flavor.quantity} шт.)",
-                                  callback_data=f"add_flavor_{flavor.id}")]
-            for flavor in flavors
-        ]
-        buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_products_list")])
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text("Выберите вкус для добавления в продажу:", reply_markup=markup)
-        await state.set_state(EditSaleState.select_flavor)
+
+def flavor_quantity(session, flavor_id):
+    """Актуальный остаток вкуса на складе"""
+    return session.get(Flavor, flavor_id).quantity
 
 
 @dp.callback_query(F.data.startswith("add_flavor_"), EditSaleState.select_flavor)
@@ -782,17 +2250,50 @@ async def select_flavor_to_add(callback: types.CallbackQuery, state: FSMContext)
     flavor_id = int(callback.data.split("_")[-1])
     await state.update_data(flavor_id=flavor_id)
 
-    with Session() as session:
-        flavor = session.get(Flavor, flavor_id)
-        if flavor.quantity <= 0:
-            await callback.answer("❌ Этот вкус закончился! Выберите другой.", show_alert=True)
-            await select_product_to_add(callback, state)
-            return
+    if await run_db(flavor_quantity, flavor_id) <= 0:
+        await callback.answer("❌ Этот вкус закончился! Выберите другой.", show_alert=True)
+        await select_product_to_add(callback, state)
+        return
 
     await callback.message.edit_text("Введите количество для добавления:")
     await state.set_state(EditSaleState.enter_quantity)
 
 
+def add_sale_to_customer(session, customer_id, product_id, flavor_id, quantity):
+    """Добавляет покупателю продажу со списанием со склада. Возвращает (успех, текст ответа)"""
+    # Получаем данные о покупателе
+    customer = session.get(Customer, customer_id)
+
+    # Получаем новые данные
+    new_product = session.get(Product, product_id)
+    new_flavor = session.get(Flavor, flavor_id)
+
+    # Проверяем доступное количество и атомарно уменьшаем его на складе
+    if new_flavor.quantity < quantity or not reserve_stock(session, {new_flavor.id: quantity}):
+        session.rollback()
+        return False, f"❌ Недостаточно товара! Доступно: {new_flavor.quantity}"
+
+    # Создаем новую продажу
+    new_sale = Sale(
+        product_id=new_product.id,
+        flavor_id=new_flavor.id,
+        customer_id=customer.id,
+        quantity=quantity,
+        purchase_price=new_product.purchase_price,
+        sale_price=new_product.sale_price
+    )
+    session.add(new_sale)
+    add_sale_to_rollup(session, new_sale)
+    text = (
+        f"✅ Товар добавлен в продажу!\n"
+        f"📦 Товар: {new_product.name}\n"
+        f"🍏 Вкус: {new_flavor.name}\n"
+        f"🔢 Количество: {quantity}"
+    )
+    session.commit()
+    return True, text
+
+
 @dp.message(EditSaleState.enter_quantity)
 async def save_added_sale(message: types.Message, state: FSMContext):
     """Сохранение добавленного товара в продажу"""
@@ -802,42 +2303,10 @@ async def save_added_sale(message: types.Message, state: FSMContext):
             raise ValueError
 
         data = await state.get_data()
-
-        with Session() as session:
-            # Получаем данные о покупателе
-            customer = session.get(Customer, data['customer_id'])
-
-            # Получаем новые данные
-            new_product = session.get(Product, data['product_id'])
-            new_flavor = session.get(Flavor, data['flavor_id'])
-
-            # Проверяем доступное количество
-            if new_flavor.quantity < new_quantity:
-                await message.answer(f"❌ Недостаточно товара! Доступно: {new_flavor.quantity}")
-                return
-
-            # Создаем новую продажу
-            new_sale = Sale(
-                product_id=new_product.id,
-                flavor_id=new_flavor.id,
-                customer_id=customer.id,
-                quantity=new_quantity,
-                purchase_price=new_product.purchase_price,
-                sale_price=new_product.sale_price
-            )
-
-            # Уменьшаем количество на складе
-            new_flavor.quantity -= new_quantity
-
-            session.add(new_sale)
-            session.commit()
-
-            await message.answer(
-                f"✅ Товар добавлен в продажу!\n"
-                f"📦 Товар: {new_product.name}\n"
-                f"🍏 Вкус: {new_flavor.name}\n"
-                f"🔢 Количество: {new_quantity}"
-            )
+        _, text = await run_db(
+            add_sale_to_customer, data['customer_id'], data['product_id'], data['flavor_id'], new_quantity
+        )
+        await message.answer(text)
 
     except ValueError:
         await message.answer("❌ Введите корректное положительное число!")
@@ -849,45 +2318,29 @@ async def save_added_sale(message: types.Message, state: FSMContext):
 async def back_to_sale_actions(callback: types.CallbackQuery, state: FSMContext):
     """Возврат к действиям с продажей"""
     data = await state.get_data()
-    sale_id = data.get('sale_id')
-
-    with Session() as session:
-        sale = session.get(Sale, sale_id)
-        if not sale:
-            await callback.answer("❌ Продажа не найдена", show_alert=True)
-            return
 
-        # Отображаем выбранный товар и вкус
-        selected_text = (
-            f"📦 Товар: {sale.product.name}\n"
-            f"🍏 Вкус: {sale.flavor.name}\n"
-            f"🔢 Количество: {sale.quantity} шт.\n\n"
-            "Выберите действие:"
-        )
+    # Отображаем выбранный товар и вкус
+    selected_text = await run_db(build_sale_text, data.get('sale_id'))
+    if selected_text is None:
+        await callback.answer("❌ Продажа не найдена", show_alert=True)
+        return
 
-        markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✏️ Редактировать", callback_data="edit_sale")],
-            [InlineKeyboardButton(text="➕ Добавить товар", callback_data="add_product_to_sale")],
-            [InlineKeyboardButton(text="🗑️ Удалить", callback_data="delete_sale")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_sales_list")]
-        ])
-        await callback.message.edit_text(selected_text, reply_markup=markup)
-        await state.set_state(EditSaleState.select_action)
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✏️ Редактировать", callback_data="edit_sale")],
+        [InlineKeyboardButton(text="➕ Добавить товар", callback_data="add_product_to_sale")],
+        [InlineKeyboardButton(text="🗑️ Удалить", callback_data="delete_sale")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_sales_list")]
+    ])
+    await callback.message.edit_text(selected_text, reply_markup=markup)
+    await state.set_state(EditSaleState.select_action)
 
 
 @dp.callback_query(F.data == "edit_sale", EditSaleState.select_action)
 async def start_sale_editing(callback: types.CallbackQuery, state: FSMContext):
     """Начало редактирования продажи"""
-    with Session() as session:
-        products = session.query(Product).all()
-        buttons = [
-            [InlineKeyboardButton(text=product.name, callback_data=f"edit_product_{product.id}")]
-            for product in products
-        ]
-        buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_sale_actions")])
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text("Выберите новый товар:", reply_markup=markup)
-        await state.set_state(EditSaleState.select_product)
+    markup = product_picker(await catalog.get(), "edit_sale")
+    await callback.message.edit_text("Выберите новый товар:", reply_markup=markup)
+    await state.set_state(EditSaleState.select_product)
 
 
 @dp.callback_query(F.data.startswith("edit_product_"), EditSaleState.select_product)
@@ -896,23 +2349,15 @@ async def select_product_for_edit(callback: types.CallbackQuery, state: FSMConte
     product_id = int(callback.data.split("_")[-1])
     await state.update_data(product_id=product_id)
 
-    with Session() as session:
-        product = session.get(Product, product_id)
-        flavors = [flavor for flavor in product.flavors if flavor.quantity > 0]  # Убираем закончившиеся вкусы
+    markup = flavor_picker(await catalog.get(), "edit_sale", product_id)  # только вкусы в наличии
 
-        if not flavors:
-            await callback.answer("❌ Нет доступных вкусов для этого товара!", show_alert=True)
-            await start_sale_editing(callback, state)
-            return
+    if markup is None:
+        await callback.answer("❌ Нет доступных вкусов для этого товара!", show_alert=True)
+        await start_sale_editing(callback, state)
+        return
 
-        buttons = [
-            [InlineKeyboardButton(text=f"{flavor.name} ({flavor.quantity} шт.)", callback_data=f"edit_flavor_{flavor.id}")]
-            for flavor in flavors
-        ]
-        buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_products_list")])
-        markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text("Выберите новый вкус:", reply_markup=markup)
-        await state.set_state(EditSaleState.select_flavor)
+    await callback.message.edit_text("Выберите новый вкус:", reply_markup=markup)
+    await state.set_state(EditSaleState.select_flavor)
 
 
 @dp.callback_query(F.data.startswith("edit_flavor_"), EditSaleState.select_flavor)
@@ -921,17 +2366,51 @@ async def select_flavor_for_edit(callback: types.CallbackQuery, state: FSMContex
     flavor_id = int(callback.data.split("_")[-1])
     await state.update_data(flavor_id=flavor_id)
 
-    with Session() as session:
-        flavor = session.get(Flavor, flavor_id)
-        if flavor.quantity <= 0:
-            await callback.answer("❌ Этот вкус закончился! Выберите другой.", show_alert=True)
-            await select_product_for_edit(callback, state)
-            return
+    if await run_db(flavor_quantity, flavor_id) <= 0:
+        await callback.answer("❌ Этот вкус закончился! Выберите другой.", show_alert=True)
+        await select_product_for_edit(callback, state)
+        return
 
     await callback.message.edit_text("Введите новое количество:")
     await state.set_state(EditSaleState.enter_quantity)
 
 
+def replace_sale_item(session, sale_id, product_id, flavor_id, quantity):
+    """Меняет товар, вкус и количество продажи с пересчётом склада. Возвращает (успех, текст ответа)"""
+    # Получаем оригинальную продажу
+    original_sale = session.get(Sale, sale_id)
+
+    # Получаем новые данные
+    new_product = session.get(Product, product_id)
+    new_flavor = session.get(Flavor, flavor_id)
+
+    # Доступно с учётом возврата оригинального количества, если вкус тот же
+    available = new_flavor.quantity
+    if original_sale.flavor_id == new_flavor.id:
+        available += original_sale.quantity
+
+    # Возвращаем оригинальное количество и списываем новое атомарными UPDATE
+    add_stock(session, {original_sale.flavor_id: original_sale.quantity} if original_sale.flavor_id else {})
+    if available < quantity or not reserve_stock(session, {new_flavor.id: quantity}):
+        session.rollback()
+        return False, f"❌ Недостаточно товара! Доступно: {available}"
+
+    # Обновляем продажу и пересчитываем её вклад в итоги по дням
+    add_sale_to_rollup(session, original_sale, sign=-1)
+    original_sale.product = new_product
+    original_sale.flavor = new_flavor
+    original_sale.quantity = quantity
+    add_sale_to_rollup(session, original_sale)
+    text = (
+        f"✅ Продажа обновлена!\n"
+        f"📦 Новый товар: {new_product.name}\n"
+        f"🍏 Новый вкус: {new_flavor.name}\n"
+        f"🔢 Количество: {quantity}"
+    )
+    session.commit()
+    return True, text
+
+
 @dp.message(EditSaleState.enter_quantity)
 async def save_edited_sale(message: types.Message, state: FSMContext):
     """Сохранение изменений в продаже"""
@@ -941,37 +2420,10 @@ async def save_edited_sale(message: types.Message, state: FSMContext):
             raise ValueError
 
         data = await state.get_data()
-
-        with Session() as session:
-            # Получаем оригинальную продажу
-            original_sale = session.get(Sale, data['sale_id'])
-
-            # Возвращаем оригинальное количество
-            original_sale.flavor.quantity += original_sale.quantity
-
-            # Получаем новые данные
-            new_product = session.get(Product, data['product_id'])
-            new_flavor = session.get(Flavor, data['flavor_id'])
-
-            # Проверяем доступное количество
-            if new_flavor.quantity < new_quantity:
-                await message.answer(f"❌ Недостаточно товара! Доступно: {new_flavor.quantity}")
-                return
-
-            # Обновляем продажу
-            new_flavor.quantity -= new_quantity
-            original_sale.product_id = new_product.id
-            original_sale.flavor_id = new_flavor.id
-            original_sale.quantity = new_quantity
-
-            session.commit()
-
-            await message.answer(
-                f"✅ Продажа обновлена!\n"
-                f"📦 Новый товар: {new_product.name}\n"
-                f"🍏 Новый вкус: {new_flavor.name}\n"
-                f"🔢 Количество: {new_quantity}"
-            )
+        _, text = await run_db(
+            replace_sale_item, data['sale_id'], data['product_id'], data['flavor_id'], new_quantity
+        )
+        await message.answer(text)
 
     except ValueError:
         await message.answer("❌ Введите корректное положительное число!")
@@ -989,106 +2441,70 @@ async def back_to_flavors(callback: types.CallbackQuery, state: FSMContext):
         await state.clear()
         return
 
-    with Session() as session:
-        product = session.query(Product).get(product_id)
-
-        if not product or not product.flavors:
-            await callback.message.answer("❌ Ошибка: товар или вкусы не найдены. Попробуйте снова.")
-            await state.clear()
-            return
-
-        # Формируем клавиатуру для выбора вкуса
-        flavor_buttons = [
-            [InlineKeyboardButton(text=f"{flavor.name} ({flavor.quantity})", callback_data=f"flavor_{flavor.id}")]
-            for flavor in product.flavors
-        ]
-
-        # Добавляем кнопку "Назад" к списку вкусов
-        flavor_buttons.append([InlineKeyboardButton(text="🔙 Назад к товарам", callback_data="back_to_products")])
-
-        markup = InlineKeyboardMarkup(inline_keyboard=flavor_buttons)
-
-        # Редактируем текущее сообщение, заменяя его на выбор вкуса
-        await callback.message.edit_text("Выберите вкус:", reply_markup=markup)
-        await state.set_state(RecordSaleState.select_flavor)  # 🔄 Переключаем состояние назад
-
-
-@dp.message(F.text == "📥 Скачать отчет за месяц")
-async def download_month_report(message: types.Message):
-    with Session() as session:
-        try:
-            today = datetime.date.today()
-            first_day = datetime.date(today.year, today.month, 1)
-            last_day = datetime.date(
-                today.year + (today.month // 12),
-                (today.month % 12) + 1, 1
-            ) - datetime.timedelta(days=1)
-
-            date_range = pd.date_range(start=first_day, end=last_day)
-
-            report_data = []
-            for single_date in date_range:
-                sales = session.query(Sale).filter(
-                    func.date(Sale.date) == single_date.date()
-                ).all()
+    markup = flavor_picker(await catalog.get(), "sale", product_id)
 
-                total_sales = len(sales)
-                total_revenue = sum(s.sale_price * s.quantity for s in sales)
-                total_profit = sum((s.sale_price - s.purchase_price) * s.quantity for s in sales)
-                lena_income = total_profit * 0.3
-
-                report_data.append({
-                    "Дата": single_date.strftime("%d.%m.%Y"),
-                    "Продажи": total_sales,
-                    "Доход": total_revenue,
-                    "Прибыль": total_profit,
-                    "Доход Лёни": lena_income
-                })
+    if markup is None:
+        await callback.message.answer("❌ Ошибка: товар или вкусы не найдены. Попробуйте снова.")
+        await state.clear()
+        return
 
-            df = pd.DataFrame(report_data)
-            totals = pd.DataFrame([{
-                "Дата": "ИТОГО:",
-                "Продажи": df["Продажи"].sum(),
-                "Доход": df["Доход"].sum(),
-                "Прибыль": df["Прибыль"].sum(),
-                "Доход Лёни": df["Доход Лёни"].sum()
-            }])
+    # Редактируем текущее сообщение, заменяя его на выбор вкуса
+    await callback.message.edit_text("Выберите вкус:", reply_markup=markup)
+    await state.set_state(RecordSaleState.select_flavor)  # 🔄 Переключаем состояние назад
 
-            df = pd.concat([df, totals], ignore_index=True)
 
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                df.to_excel(writer, index=False, sheet_name='Отчет')
+# Сколько прошлых месяцев предлагать после отчёта за текущий
+REPORT_PAST_MONTHS = 5
 
-                workbook = writer.book
-                worksheet = writer.sheets['Отчет']
 
-                num_format = workbook.add_format({'num_format': '#,##0.00₽'})
-                date_format = workbook.add_format({'num_format': 'dd.mm.yyyy'})
+async def send_month_report(message: types.Message, first_day: datetime.date):
+    first_day, last_day = month_bounds(first_day)
+    key, persistent = await run_db(report_cache_key, "month_report", first_day)
 
-                worksheet.set_column('A:A', 12, date_format)
-                worksheet.set_column('B:E', 15, num_format)
+    # Статистика читается в пуле потоков БД, xlsx строится в пуле процессов;
+    # повторный запрос без новых продаж отдаётся из report_cache
+    await enqueue_report(
+        message,
+        lambda session: get_daily_sales_stats(session, first_day, last_day),
+        render_month_report_xlsx,
+        f"month_report_{first_day.strftime('%Y_%m')}.xlsx",
+        f"📊 Отчет за {first_day.strftime('%B %Y')}",
+        cache=(key, persistent)
+    )
 
-                totals_format = workbook.add_format({
-                    'bold': True,
-                    'bg_color': '#FFFF00',
-                    'num_format': '#,##0.00₽'
-                })
 
-                last_row = len(df)
-                for col in range(4):
-                    worksheet.write(last_row, col + 1, df.iloc[-1, col + 1], totals_format)
+@dp.message(F.text == "📥 Скачать отчет за месяц")
+async def download_month_report(message: types.Message):
+    try:
+        today = datetime.date.today()
+        await send_month_report(message, today)
+
+        # Отчёты за прошлые месяцы — по кнопкам
+        months = []
+        first_day = month_bounds(today)[0]
+        for _ in range(REPORT_PAST_MONTHS):
+            first_day = month_bounds(first_day - datetime.timedelta(days=1))[0]
+            months.append(first_day)
+        markup = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=month.strftime("%m.%Y"), callback_data=f"month_report:{month.strftime('%Y-%m')}")
+             for month in months]
+        ])
+        await message.answer("📅 Отчёт за прошлый месяц:", reply_markup=markup)
 
-            output.seek(0)
+    except Exception as e:
+        logger.error(f"Ошибка генерации отчета: {str(e)}")
+        await message.answer("❌ Ошибка при генерации отчета")
 
-            await message.answer_document(
-                types.BufferedInputFile(output.read(), filename="month_report.xlsx"),
-                caption=f"📊 Отчет за {today.strftime('%B %Y')}"
-            )
 
-        except Exception as e:
-            logger.error(f"Ошибка генерации отчета: {str(e)}")
-            await message.answer("❌ Ошибка при генерации отчета")
+@dp.callback_query(F.data.startswith("month_report:"))
+async def download_past_month_report(callback: types.CallbackQuery):
+    try:
+        first_day = datetime.datetime.strptime(callback.data.split(":", 1)[1], "%Y-%m").date()
+        await send_month_report(callback.message, first_day)
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка генерации отчета: {str(e)}")
+        await callback.answer("❌ Ошибка при генерации отчета", show_alert=True)
 
 
 
@@ -1114,15 +2530,19 @@ async def enter_customer_name(message: types.Message, state: FSMContext):
     # Переходим к сохранению продажи
     await save_sale(message, state)
 
+def next_customer_name(session):
+    """Стандартное имя для покупателя без имени"""
+    # Находим последнего покупателя
+    last_customer = session.query(Customer).order_by(Customer.id.desc()).first()
+    # Генерируем следующее имя
+    next_customer_id = (last_customer.id + 1) if last_customer else 1
+    return f"Покупатель {next_customer_id}"
+
+
 @dp.callback_query(F.data == "skip_customer_name")
 async def skip_customer_name(callback: types.CallbackQuery, state: FSMContext):
     """Если пользователь нажал 'Нет' при вводе имени покупателя – создаем стандартное имя."""
-    with Session() as session:
-        # Находим последнего покупателя
-        last_customer = session.query(Customer).order_by(Customer.id.desc()).first()
-        # Генерируем следующее имя
-        next_customer_id = (last_customer.id + 1) if last_customer else 1
-        customer_name = f"Покупатель {next_customer_id}"
+    customer_name = await run_db(next_customer_name)
 
     # Сохраняем имя покупателя в состоянии
     await state.update_data(customer_name=customer_name)
@@ -1138,52 +2558,97 @@ async def show_analytics(message: types.Message):
             [types.KeyboardButton(text="📊 Текущая статистика"),
              types.KeyboardButton(text="📜 Покупатели")],
             [types.KeyboardButton(text="📥 Скачать отчет за месяц"),
-             types.KeyboardButton(text="🔙 Назад")]
+             types.KeyboardButton(text="📥 Журнал продаж")],
+            [types.KeyboardButton(text="🔙 Назад")]
         ],
         resize_keyboard=True
     )
     await message.answer("📊 Выберите тип аналитики:", reply_markup=markup)
 
+
+@dp.message(F.text == "📥 Журнал продаж")
+async def choose_sales_journal_format(message: types.Message):
+    """Выбор формата выгрузки полного журнала продаж"""
+    formats = [f for f in EXPORT_FORMATS if f != "parquet" or PARQUET_AVAILABLE]
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=EXPORT_FORMATS[f], callback_data=f"export_journal:{f}") for f in formats]
+    ])
+    await message.answer(
+        "📜 Журнал всех продаж и брака. Выберите формат:\n"
+        "Файлы больше 50 МБ придут zip-архивом по частям.",
+        reply_markup=markup
+    )
+
+
+@dp.callback_query(F.data.startswith("export_journal:"))
+async def export_sales_journal(callback: types.CallbackQuery):
+    export_format = callback.data.split(":", 1)[1]
+    if export_format not in EXPORT_FORMATS or (export_format == "parquet" and not PARQUET_AVAILABLE):
+        await callback.answer("❌ Формат недоступен", show_alert=True)
+        return
+
+    await enqueue_export(
+        callback.message,
+        iter_sales_journal_rows,
+        export_writer(export_format, SALES_JOURNAL_COLUMNS),
+        export_file_name("sales_journal", export_format),
+        f"📜 Журнал продаж ({EXPORT_FORMATS[export_format]})",
+        empty_text="📭 Продаж пока нет."
+    )
+    await callback.answer()
+
+def build_today_customers_text(session, today: datetime.date):
+    """Текст со списком покупателей за день и их покупками или None, если покупателей нет"""
+    today_start, today_end = date_range_bounds(today)
+
+    # Получаем покупателей за сегодня
+    customers_today = session.query(Customer).filter(
+        Customer.date >= today_start,
+        Customer.date < today_end
+    ).order_by(Customer.id.desc()).all()
+
+    if not customers_today:
+        return None
+
+    response = ["👤 <b>Покупатели за сегодня:</b>"]
+    for customer in customers_today:
+        sales = session.query(Sale).filter(
+            Sale.customer_id == customer.id,
+            Sale.date >= today_start,
+            Sale.date < today_end
+        ).all()
+
+        sales_text = "\n".join(
+            f"📦 {s.product.name} - {s.flavor.name} - {s.quantity} шт."
+            for s in sales
+        )
+
+        response.append(
+            f"👤 <b>{customer.name}</b>\n"
+            f"{sales_text}\n"
+            f"— — — — —"
+        )
+    return "\n".join(response)
+
+
 @dp.message(F.text == "📜 Покупатели")
 async def show_customers(message: types.Message):
     """Вывод списка покупателей за сегодня и предложение скачать таблицу за месяц"""
     try:
-        with Session() as session:
-            today = datetime.datetime.now().date()
-
-            # Получаем покупателей за сегодня
-            customers_today = session.query(Customer).filter(
-                func.DATE(Customer.date) == today
-            ).order_by(Customer.id.desc()).all()
-
-            if not customers_today:
-                await message.answer("📭 Нет покупателей за сегодня.")
-            else:
-                response = ["👤 <b>Покупатели за сегодня:</b>"]
-                for customer in customers_today:
-                    sales = session.query(Sale).filter(
-                        Sale.customer_id == customer.id,
-                        func.DATE(Sale.date) == today
-                    ).all()
-
-                    sales_text = "\n".join(
-                        f"📦 {s.product.name} - {s.flavor.name} - {s.quantity} шт."
-                        for s in sales
-                    )
-
-                    response.append(
-                        f"👤 <b>{customer.name}</b>\n"
-                        f"{sales_text}\n"
-                        f"— — — — —"
-                    )
+        today = datetime.datetime.now().date()
+        response = await run_db(build_today_customers_text, today)
 
-                await message.answer("\n".join(response), parse_mode="HTML")
+        if response is None:
+            await message.answer("📭 Нет покупателей за сегодня.")
+        else:
+            await message.answer(response, parse_mode="HTML")
 
-            # Предложение скачать таблицу за месяц
-            markup = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📥 Скачать таблицу за месяц", callback_data="download_customers_month")]
-            ])
-            await message.answer("Хотите скачать таблицу покупателей за текущий месяц?", reply_markup=markup)
+        # Предложение скачать таблицу за месяц
+        markup = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📥 Скачать таблицу за месяц", callback_data="download_customers_month")],
+            [InlineKeyboardButton(text="📄 CSV за месяц", callback_data="download_customers_month_csv")]
+        ])
+        await message.answer("Хотите скачать таблицу покупателей за текущий месяц?", reply_markup=markup)
 
     except Exception as e:
         logger.error(f"Ошибка при загрузке покупателей: {str(e)}")
@@ -1196,77 +2661,56 @@ async def show_customers(message: types.Message):
 async def download_customers_month(callback: types.CallbackQuery):
     """Скачивание таблицы покупателей за текущий месяц"""
     try:
-        with Session() as session:
-            today = datetime.datetime.now().date()
-            first_day_of_month = datetime.date(today.year, today.month, 1)
-            last_day_of_month = datetime.date(
-                today.year + (today.month // 12),
-                (today.month % 12) + 1, 1
-            ) - datetime.timedelta(days=1)
-
-            # Получаем покупателей за текущий месяц
-            customers = session.query(Customer).filter(
-                Customer.date >= first_day_of_month,
-                Customer.date <= last_day_of_month
-            ).order_by(Customer.date).all()
-
-            if not customers:
-                await callback.answer("❌ Нет данных о покупателях за текущий месяц.", show_alert=True)
-                return
-
-            # Создаем DataFrame для таблицы
-            data = []
-            for customer in customers:
-                sales = session.query(Sale).filter(Sale.customer_id == customer.id).all()
-                for sale in sales:
-                    data.append({
-                        "Дата": customer.date.strftime("%d.%m.%Y"),
-                        "Покупатель": customer.name,
-                        "Товар": sale.product.name,
-                        "Вкус": sale.flavor.name,
-                        "Количество": sale.quantity,
-                        "Цена продажи": sale.sale_price,
-                        "Выручка": sale.quantity * sale.sale_price
-                    })
-
-            df = pd.DataFrame(data)
-
-            # Генерация Excel-файла
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                df.to_excel(writer, index=False, sheet_name='Покупатели')
-
-                workbook = writer.book
-                worksheet = writer.sheets['Покупатели']
-
-                # Форматирование колонок
-                worksheet.set_column('A:A', 12)  # Дата
-                worksheet.set_column('B:B', 25)  # Покупатель
-                worksheet.set_column('C:C', 20)  # Товар
-                worksheet.set_column('D:D', 20)  # Вкус
-                worksheet.set_column('E:E', 12)  # Количество
-                worksheet.set_column('F:F', 15)  # Цена продажи
-                worksheet.set_column('G:G', 15)  # Выручка
-
-            output.seek(0)
-
-            # Отправка файла пользователю
-            await callback.message.answer_document(
-                types.BufferedInputFile(output.read(), filename="customers_month.xlsx"),
-                caption=f"📊 Покупатели за {today.strftime('%B %Y')}"
-            )
-            await callback.answer()
+        today = datetime.datetime.now().date()
+        first_day_of_month, last_day_of_month = month_bounds(today)
+
+        # Строки читаются в пуле потоков БД и пачками уходят в пул процессов, где пишется xlsx
+        await enqueue_export(
+            callback.message,
+            lambda session: iter_customers_month_rows(session, first_day_of_month, last_day_of_month),
+            write_customers_month_xlsx,
+            "customers_month.xlsx",
+            f"📊 Покупатели за {today.strftime('%B %Y')}",
+            empty_text="❌ Нет данных о покупателях за текущий месяц."
+        )
+        await callback.answer()
 
     except Exception as e:
         logger.error(f"Ошибка при генерации таблицы: {str(e)}")
         await callback.answer("❌ Ошибка при создании таблицы.", show_alert=True)
 
+@dp.callback_query(F.data == "download_customers_month_csv")
+async def download_customers_month_csv(callback: types.CallbackQuery):
+    """Таблица покупателей за текущий месяц в CSV, строки пишутся в файл по мере чтения"""
+    today = datetime.datetime.now().date()
+    first_day_of_month, last_day_of_month = month_bounds(today)
+
+    await enqueue_export(
+        callback.message,
+        lambda session: iter_customers_month_rows(session, first_day_of_month, last_day_of_month),
+        export_writer("csv", CUSTOMERS_MONTH_COLUMNS),
+        "customers_month.csv",
+        f"📊 Покупатели за {today.strftime('%B %Y')}",
+        empty_text="❌ Нет данных о покупателях за текущий месяц."
+    )
+    await callback.answer()
+
+
 @dp.callback_query(F.data == "quantity_other", RecordSaleState.enter_quantity)
 async def select_other_quantity(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик для выбора 'Другое' в количестве товара"""
     await callback.message.answer("Введите количество вручную:")
     await state.set_state(RecordSaleState.enter_custom_quantity)  # Новое состояние для ручного ввода
 
+def load_cart_item(session, product_id, flavor_id):
+    """Названия и остаток для строки корзины или None, если вкус не найден"""
+    flavor = session.get(Flavor, flavor_id)
+    if not flavor:
+        return None
+    product = session.get(Product, product_id)
+    return {"product_name": product.name, "flavor_name": flavor.name, "stock": flavor.quantity}
+
+
 @dp.message(RecordSaleState.enter_custom_quantity)
 async def enter_custom_quantity(message: types.Message, state: FSMContext):
     """Обработчик для ручного ввода количества"""
@@ -1285,44 +2729,44 @@ async def enter_custom_quantity(message: types.Message, state: FSMContext):
             await state.clear()
             return
 
-        with Session() as session:
-            flavor = session.query(Flavor).get(data["flavor_id"])
-            if not flavor:
-                await message.answer("❌ Ошибка: вкус не найден. Попробуйте снова.")
-                await state.clear()
-                return
+        item = await run_db(load_cart_item, data["product_id"], data["flavor_id"])
+        if item is None:
+            await message.answer("❌ Ошибка: вкус не найден. Попробуйте снова.")
+            await state.clear()
+            return
 
-            # Проверяем, достаточно ли товара на складе
-            if flavor.quantity < quantity:
-                await message.answer(f"❌ Недостаточно товара! Осталось: {flavor.quantity}")
-                return
+        # Проверяем, достаточно ли товара на складе
+        if item["stock"] < quantity:
+            await message.answer(f"❌ Недостаточно товара! Осталось: {item['stock']}")
+            return
 
-            # Обновляем данные в состоянии
-            if "sales_list" not in data:
-                data["sales_list"] = []
+        # Обновляем данные в состоянии
+        if "sales_list" not in data:
+            data["sales_list"] = []
 
-            product = session.query(Product).get(data["product_id"])
-            data["sales_list"].append({
-                "product_name": product.name,
-                "flavor_name": flavor.name,
-                "quantity": quantity
-            })
+        data["sales_list"].append({
+            "product_id": data["product_id"],
+            "flavor_id": data["flavor_id"],
+            "product_name": item["product_name"],
+            "flavor_name": item["flavor_name"],
+            "quantity": quantity
+        })
 
-            await state.update_data(sales_list=data["sales_list"])
+        await state.update_data(sales_list=data["sales_list"])
 
-            # Спрашиваем, добавить ли еще товар
-            markup = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="➕ Добавить ещё товар", callback_data="add_more")],
-                [InlineKeyboardButton(text="✅ Завершить продажу", callback_data="finish_sale")]
-            ])
+        # Спрашиваем, добавить ли еще товар
+        markup = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="➕ Добавить ещё товар", callback_data="add_more")],
+            [InlineKeyboardButton(text="✅ Завершить продажу", callback_data="finish_sale")]
+        ])
 
-            await message.answer(
-                f"✅ Количество выбрано: {quantity} шт.\n"
-                f"➕ Хотите добавить еще один товар?",
-                reply_markup=markup
-            )
+        await message.answer(
+            f"✅ Количество выбрано: {quantity} шт.\n"
+            f"➕ Хотите добавить еще один товар?",
+            reply_markup=markup
+        )
 
-            await state.set_state(RecordSaleState.confirm_more_items)
+        await state.set_state(RecordSaleState.confirm_more_items)
 
     except ValueError:
         await message.answer("❌ Введите целое число!")
@@ -1330,77 +2774,318 @@ async def enter_custom_quantity(message: types.Message, state: FSMContext):
         logger.error(f"Ошибка при обработке количества: {str(e)}")
         await message.answer("❌ Ошибка при обработке. Попробуйте снова.")
 
+@dp.message(RecordSaleState.enter_quantity)
+async def enter_sale_quantity(message: types.Message, state: FSMContext):
+    """Количество, введённое текстом вместо кнопки, добавляется в корзину
+    так же, как ручной ввод; продажа оформляется через checkout_cart"""
+    await enter_custom_quantity(message, state)
+
 @dp.callback_query(F.data == "change_quantity")
 async def change_quantity(callback: types.CallbackQuery, state: FSMContext):
     """Изменение количества после отказа от подтверждения"""
     data = await state.get_data()
 
-    with Session() as session:
-        flavor = session.get(Flavor, data['flavor_id'])
+    stock = await run_db(flavor_quantity, data['flavor_id'])
 
-        # Определяем максимальное количество (макс 10)
-        max_quantity = min(flavor.quantity, 10)
+    # Определяем максимальное количество (макс 10)
+    max_quantity = min(stock, 10)
 
-        # Создаем кнопки 2 ряда (1–5, 6–10)
-        quantity_buttons = [
-            [InlineKeyboardButton(text=str(i), callback_data=f"quantity_{i}") for i in
-             range(1, min(6, max_quantity + 1))],
-            [InlineKeyboardButton(text=str(i), callback_data=f"quantity_{i}") for i in
-             range(6, max_quantity + 1)]
-        ]
+    # Создаем кнопки 2 ряда (1–5, 6–10)
+    quantity_buttons = [
+        [InlineKeyboardButton(text=str(i), callback_data=f"quantity_{i}") for i in
+         range(1, min(6, max_quantity + 1))],
+        [InlineKeyboardButton(text=str(i), callback_data=f"quantity_{i}") for i in
+         range(6, max_quantity + 1)]
+    ]
 
-        # Если количество больше 10, добавляем кнопку "Другое"
-        if flavor.quantity > 10:
-            quantity_buttons.append(
-                [InlineKeyboardButton(text="🔢 Другое", callback_data="quantity_other")])
+    # Если количество больше 10, добавляем кнопку "Другое"
+    if stock > 10:
+        quantity_buttons.append(
+            [InlineKeyboardButton(text="🔢 Другое", callback_data="quantity_other")])
 
-        # Добавляем кнопку "Назад"
-        quantity_buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_flavors")])
+    # Добавляем кнопку "Назад"
+    quantity_buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_flavors")])
 
-        markup = InlineKeyboardMarkup(inline_keyboard=quantity_buttons)
+    markup = InlineKeyboardMarkup(inline_keyboard=quantity_buttons)
+
+    await callback.message.edit_text("📦 Выберите новое количество:", reply_markup=markup)
+    await state.set_state(RecordSaleState.confirm_more_items)
+
+# Прайс для канала: по сообщению на группу товаров, не длиннее лимита Telegram.
+# Куски кэшируются по хэшу цен и наличия; при повторном показе правятся только
+# сообщения, текст которых изменился.
+price_list_cache = {"key": None, "chunks": []}
+price_list_messages = {}  # chat_id -> [(message_id, текст)] сообщений прайса после первого
+
+
+def price_list_key(products) -> str:
+    """Хэш всего, что видно в прайсе: названия, цены и закончившиеся вкусы"""
+    visible = [
+        (p.name, p.sale_price, tuple((f.name, f.quantity == 0) for f in p.flavors))
+        for p in products
+    ]
+    return hashlib.sha1(repr(visible).encode()).hexdigest()
+
+
+def format_channel_product(product: CatalogProduct) -> str:
+    """Товар в прайсе: цена и вкусы, закончившиеся зачёркнуты"""
+    lines = [f"• {product.name} {int(product.sale_price)}"]
+    for flavor in product.flavors:
+        if flavor.quantity == 0:
+            lines.append(f"<blockquote>- <s>{flavor.name}</s></blockquote>")
+        else:
+            lines.append(f"<blockquote>- {flavor.name}</blockquote>")
+    return "\n".join(lines)
+
+
+def render_price_list(snapshot: CatalogSnapshot):
+    """Куски прайса, разбитые по границам товаров"""
+    products = sorted(snapshot.products, key=lambda p: p.name)
+    key = price_list_key(products)
+    if price_list_cache["key"] != key:
+        blocks = [format_channel_product(product) for product in products]
+        price_list_cache["key"], price_list_cache["chunks"] = key, pack_text_blocks(blocks, separator="\n\n")
+    return price_list_cache["chunks"]
+
+
+async def sync_price_list_messages(message: types.Message, chunks):
+    """Досылает куски прайса после первого; правит только изменившиеся. Возвращает число запросов"""
+    chat_id = message.chat.id
+    previous = price_list_messages.get(chat_id, [])
+    current = []
+    requests_made = 0
+    for i, chunk in enumerate(chunks):
+        if i < len(previous):
+            message_id, text = previous[i]
+            if text == chunk:
+                current.append((message_id, text))
+                continue
+            try:
+                await bot.edit_message_text(chunk, chat_id=chat_id, message_id=message_id, parse_mode="HTML")
+                current.append((message_id, chunk))
+                requests_made += 1
+                continue
+            except TelegramBadRequest:
+                pass  # сообщение удалили из чата — отправим заново
+        sent = await message.answer(chunk, parse_mode="HTML")
+        current.append((sent.message_id, chunk))
+        requests_made += 1
+    for message_id, _ in previous[len(chunks):]:
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+            requests_made += 1
+        except TelegramBadRequest:
+            pass
+    price_list_messages[chat_id] = current
+    return requests_made
 
-        await callback.message.edit_text("📦 Выберите новое количество:", reply_markup=markup)
-        await state.set_state(RecordSaleState.confirm_more_items)
 
 @dp.callback_query(F.data == "channel_all")
 async def channel_all_products(callback: types.CallbackQuery):
-    session = Session()
     try:
-        products = session.query(Product).order_by(Product.name).all()
-        if not products:
+        snapshot = await catalog.get()
+        if not snapshot.products:
             await callback.message.edit_text("Нет товаров для отображения.")
             return
 
-        lines = []
-        for product in products:
-            product_line = f"• {product.name} {int(product.sale_price)}"
-            lines.append(product_line)
-            for flavor in product.flavors:
-                if flavor.quantity == 0:
-                    line = f"<blockquote>- <s>{flavor.name}</s></blockquote>"
-                else:
-                    line = f"<blockquote>- {flavor.name}</blockquote>"
-                lines.append(line)
-            lines.append("")
-        text = "\n".join(lines)
+        chunks = render_price_list(snapshot)
         # Кнопка "🔙 Назад" для возврата в меню актуального прайса
         markup = types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_actual_price")]
         ])
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=markup)
+        await callback.message.edit_text(chunks[0], parse_mode="HTML", reply_markup=markup)
+        await sync_price_list_messages(callback.message, chunks[1:])
         await callback.answer("Актуальный прайс обновлён: весь прайс.")
     except Exception as e:
         await callback.message.answer(f"Ошибка: {e}")
-    finally:
-        session.close()
+
+
+# ======================= ДОСКА ПРАЙСА В КАНАЛЕ ======================= #
+# В канале CHANNEL_ID держится по закреплённому сообщению на товар. После любого
+# изменения каталога доска сверяется не чаще раза в CHANNEL_DEBOUNCE секунд,
+# и правятся только сообщения товаров, у которых изменился видимый текст
+# (цена, закончившийся или снова появившийся вкус).
+# Доску ведёт один процесс бота — тот, что держит аренду в leader_leases и
+# продлевает её каждые CHANNEL_LEASE_TTL/3 секунд. Если он остановился, аренду
+# не позже чем через CHANNEL_LEASE_TTL секунд забирает другой процесс.
+CHANNEL_ID = os.getenv("CHANNEL_ID")
+CHANNEL_DEBOUNCE = float(os.getenv("CHANNEL_DEBOUNCE", "10"))
+CHANNEL_LEASE_TTL = float(os.getenv("CHANNEL_LEASE_TTL", "60"))
+CHANNEL_LEASE = "channel_board"
+
+
+def acquire_lease(session, name: str, owner: str, ttl: float) -> bool:
+    """Берёт или продлевает аренду name на ttl секунд; False — её держит другой процесс"""
+    now = datetime.datetime.now()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    taken = session.execute(
+        update(LeaderLease)
+        .where(LeaderLease.name == name, (LeaderLease.owner == owner) | (LeaderLease.expires_at < now))
+        .values(owner=owner, expires_at=expires_at)
+    ).rowcount
+    if not taken:
+        try:
+            session.execute(insert(LeaderLease).values(name=name, owner=owner, expires_at=expires_at))
+        except IntegrityError:
+            # Аренду держит другой процесс или только что взял её
+            session.rollback()
+            return False
+    session.commit()
+    return True
+
+
+def release_lease(session, name: str, owner: str):
+    session.query(LeaderLease).filter(LeaderLease.name == name, LeaderLease.owner == owner).delete()
+    session.commit()
+
+
+def load_channel_posts(session):
+    return {post.product_id: (post.message_id, post.text_hash) for post in session.query(ChannelPost)}
+
+
+def save_channel_posts(session, changed: dict, removed: list):
+    for product_id, (message_id, text_hash) in changed.items():
+        session.merge(ChannelPost(product_id=product_id, message_id=message_id, text_hash=text_hash))
+    if removed:
+        session.query(ChannelPost).filter(ChannelPost.product_id.in_(removed)).delete()
+    session.commit()
+
+
+class ChannelBoard:
+    def __init__(self, chat_id, debounce: float, lease_ttl: float = CHANNEL_LEASE_TTL):
+        self.chat_id = chat_id
+        self.debounce = debounce
+        self.lease_ttl = lease_ttl
+        self.owner = f"{os.getpid()}:{os.urandom(4).hex()}"
+        self.leader = False
+        self.synced_version = None  # версия каталога последней полной сверки
+        self.posts = {}
+        self.edits = 0
+        self._loop = None
+        self._changed = None
+        self._tasks = []
+
+    def notify(self):
+        """Каталог изменился; можно вызывать из любого потока"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._keep_lease()), asyncio.create_task(self._run())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.leader:
+            # Отдаём доску другому процессу сразу, не дожидаясь истечения аренды
+            self.leader = False
+            await run_db(release_lease, CHANNEL_LEASE, self.owner)
+
+    async def _keep_lease(self):
+        while True:
+            try:
+                leader = await run_db(acquire_lease, CHANNEL_LEASE, self.owner, self.lease_ttl)
+                if leader and not self.leader:
+                    logger.info("Доска в канале: этот процесс ведёт доску")
+                self.leader = leader
+                # Каталог могли изменить другие процессы бота, а прошлая сверка — не дойти до конца
+                if leader and (await catalog.get()).version != self.synced_version:
+                    self._changed.set()
+            except Exception as e:
+                self.leader = False
+                logger.error(f"Ошибка аренды доски в канале: {str(e)}")
+            await asyncio.sleep(self.lease_ttl / 3)
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            # Изменения за время паузы попадут в одну сверку
+            await asyncio.sleep(self.debounce)
+            self._changed.clear()
+            if not self.leader:
+                continue
+            try:
+                # Пока доску вёл другой процесс, её сообщения могли поменяться
+                self.posts = await run_db(load_channel_posts)
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Ошибка обновления доски в канале: {str(e)}")
+
+    async def _post(self, text: str) -> int:
+        message = await bot.send_message(self.chat_id, text, parse_mode="HTML", disable_notification=True)
+        await bot.pin_chat_message(self.chat_id, message.message_id, disable_notification=True)
+        return message.message_id
+
+    async def _repost(self, product_id: int, text: str, text_hash: str):
+        message_id = await self._post(text)
+        self.posts[product_id] = (message_id, text_hash)
+        # Сохраняем сразу: после сбоя дальше по списку и перезапуска пост не опубликуется повторно
+        await run_db(save_channel_posts, {product_id: self.posts[product_id]}, [])
+
+    async def sync(self):
+        """Публикует новые товары и правит только изменившиеся сообщения"""
+        snapshot = await catalog.get()
+        edited, removed = {}, []
+        for product in sorted(snapshot.products, key=lambda p: p.name):
+            text = format_channel_product(product)
+            text_hash = hashlib.sha1(text.encode()).hexdigest()
+            post = self.posts.get(product.id)
+            if post and post[1] == text_hash:
+                continue
+            if not post:
+                await self._repost(product.id, text, text_hash)
+                self.edits += 1
+                continue
+            try:
+                await bot.edit_message_text(text, chat_id=self.chat_id, message_id=post[0], parse_mode="HTML")
+            except TelegramBadRequest as e:
+                if "message to edit not found" in e.message:
+                    await self._repost(product.id, text, text_hash)  # сообщение удалили из канала
+                    self.edits += 1
+                    continue
+                if "message is not modified" not in e.message:
+                    # Остальные ошибки не повод публиковать дубль: повторим при следующей сверке
+                    logger.warning(f"Доска в канале: не удалось изменить сообщение {post[0]}: {e.message}")
+                    continue
+            edited[product.id] = self.posts[product.id] = (post[0], text_hash)
+            self.edits += 1
+        for product_id in set(self.posts) - set(snapshot.products_by_id):
+            message_id, _ = self.posts.pop(product_id)
+            removed.append(product_id)
+            try:
+                await bot.delete_message(self.chat_id, message_id)
+            except TelegramBadRequest:
+                pass
+        if edited or removed:
+            await run_db(save_channel_posts, edited, removed)
+            logger.info(f"Доска в канале: изменено {len(edited)}, удалено {len(removed)}")
+        self.synced_version = snapshot.version
+
+
+channel_board = ChannelBoard(CHANNEL_ID, CHANNEL_DEBOUNCE)
+catalog.listeners.append(channel_board.notify)
+
+
+@dp.startup()
+async def start_channel_board():
+    if CHANNEL_ID:
+        await channel_board.start()
+
+
+@dp.shutdown()
+async def stop_channel_board():
+    await channel_board.stop()
 
 
 @dp.callback_query(F.data.startswith("channel_prod_"))
 async def channel_product_details(callback: types.CallbackQuery):
     prod_id = int(callback.data.split("_")[-1])
-    session = Session()
     try:
-        product = session.query(Product).get(prod_id)
+        product = (await catalog.get()).product(prod_id)
         if not product:
             await callback.message.edit_text("Товар не найден.")
             return
@@ -1422,52 +3107,73 @@ async def channel_product_details(callback: types.CallbackQuery):
         await callback.answer("Прайс товара обновлён.")
     except Exception as e:
         await callback.message.edit_text(f"Ошибка: {e}")
-    finally:
-        session.close()
 
 
 
+def format_product_card(product: CatalogProduct) -> str:
+    """Карточка товара для списка «📦 Показать товары»"""
+    # Рассчитываем доход с 1 штуки
+    profit_per_unit = int(product.sale_price - product.purchase_price)
+
+    # Считаем общее количество товара (по всем вкусам)
+    total_quantity = sum(flavor.quantity for flavor in product.flavors)
+
+    # Функция для обрезки длинных названий вкусов
+    def shorten_text(text, max_length=28):
+        return text if len(text) <= max_length else text[:max_length - 3] + "..."
+
+    # Формируем список вкусов
+    flavors_info = [
+        f"<blockquote>{'<s>' if flavor.quantity == 0 else ''}{shorten_text(flavor.name)} - {flavor.quantity} шт "
+        f"{'🟢' if flavor.quantity > 1 else '🟡' if flavor.quantity == 1 else '🔴'}{'</s>' if flavor.quantity == 0 else ''}</blockquote>"
+        for flavor in product.flavors
+    ]
+
+    # Финальный текст товара с добавлением цены по акции
+    product_text = [
+        "- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - ",
+        f"📌 <b><u>{product.name.upper()}</u></b> | {total_quantity} шт",
+        f"Закуп: {int(product.purchase_price)}₽",
+        f"Продажа: {int(product.sale_price)}₽",
+        f"Акция (от 2 шт): {int(product.sale_price_2)}₽",
+        f"Доход с 1 шт: {profit_per_unit}₽",
+        "",
+        "🍏 <b>Вкусы:</b>"
+    ] + flavors_info + ["- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - "]
+    return "\n".join(product_text)
+
+
+# Страницы списка товаров: карточки рендерятся и упаковываются один раз на снимок
+# каталога, листание страниц берёт готовый текст
+product_pages = KeyboardCache()
+
+
+def products_menu_page(snapshot: CatalogSnapshot, page: int):
+    """Текст и клавиатура страницы списка товаров; карточки упакованы до лимита сообщения"""
+    pages = product_pages.get(snapshot, "products_menu", lambda: pack_text_blocks(
+        [format_product_card(product) for product in snapshot.products]
+    ))
+    page = min(max(page, 0), len(pages) - 1)
+    markup = None
+    if len(pages) > 1:
+        markup = types.InlineKeyboardMarkup(inline_keyboard=[[
+            types.InlineKeyboardButton(text="◀️", callback_data=f"products_page:{(page - 1) % len(pages)}"),
+            types.InlineKeyboardButton(text=f"{page + 1}/{len(pages)}", callback_data="picker_noop"),
+            types.InlineKeyboardButton(text="▶️", callback_data=f"products_page:{(page + 1) % len(pages)}"),
+        ]])
+    return pages[page], markup
+
+
 @dp.message(F.text == "📦 Показать товары")
 async def show_products_menu(message: types.Message):
-    with Session() as session:
-        products = session.query(Product).all()
-
-        if not products:
-            await message.answer("📭 Нет товаров в базе")
-            return
+    snapshot = await catalog.get()
+    if not snapshot.products:
+        await message.answer("📭 Нет товаров в базе")
+        return
 
-        for product in products:
-            # Рассчитываем доход с 1 штуки
-            profit_per_unit = int(product.sale_price - product.purchase_price)
-
-            # Считаем общее количество товара (по всем вкусам)
-            total_quantity = sum(flavor.quantity for flavor in product.flavors)
-
-            # Функция для обрезки длинных названий вкусов
-            def shorten_text(text, max_length=28):
-                return text if len(text) <= max_length else text[:max_length - 3] + "..."
-
-            # Формируем список вкусов
-            flavors_info = [
-                f"<blockquote>{'<s>' if flavor.quantity == 0 else ''}{shorten_text(flavor.name)} - {flavor.quantity} шт "
-                f"{'🟢' if flavor.quantity > 1 else '🟡' if flavor.quantity == 1 else '🔴'}{'</s>' if flavor.quantity == 0 else ''}</blockquote>"
-                for flavor in product.flavors
-            ]
-
-            # Финальный текст товара с добавлением цены по акции
-            product_text = [
-                "- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - ",
-                f"📌 <b><u>{product.name.upper()}</u></b> | {total_quantity} шт",
-                f"Закуп: {int(product.purchase_price)}₽",
-                f"Продажа: {int(product.sale_price)}₽",
-                f"Акция (от 2 шт): {int(product.sale_price_2)}₽",
-                f"Доход с 1 шт: {profit_per_unit}₽",
-                "",
-                "🍏 <b>Вкусы:</b>"
-            ] + flavors_info + ["- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - "]
-
-            # Отправляем сообщение
-            await message.answer("\n".join(product_text), parse_mode="HTML")
+    # Одно сообщение со страницей товаров вместо сообщения на каждый товар
+    text, page_markup = products_menu_page(snapshot, 0)
+    await message.answer(text, parse_mode="HTML", reply_markup=page_markup)
 
     # Меню действий – добавляем кнопку "Обновить канал"
     markup = types.ReplyKeyboardMarkup(
@@ -1482,6 +3188,12 @@ async def show_products_menu(message: types.Message):
     await message.answer("📦 <b>Выберите действие с таблицей:</b>", reply_markup=markup)
 
 
+@dp.callback_query(F.data.startswith("products_page:"))
+async def switch_products_page(callback: types.CallbackQuery):
+    """Листание списка товаров: страница строится по текущему кэшу каталога"""
+    text, markup = products_menu_page(await catalog.get(), int(callback.data.split(":")[1]))
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=markup)
+    await callback.answer()
 
 
 @dp.message(F.text == "Обновить канал")
@@ -1494,63 +3206,31 @@ async def update_channel_menu(message: types.Message):
 
 
 
-@dp.callback_query(F.data == "channel_all")
-async def channel_all_products(callback: types.CallbackQuery):
-    session = Session()
-    try:
-        products = session.query(Product).order_by(Product.name).all()
-        if not products:
-            await callback.message.edit_text("Нет товаров для отображения.")
-            return
-
-        lines = []
-        for product in products:
-            # Вывод товара: "• Название Цена"
-            product_line = f"• {product.name} {int(product.sale_price)}"
-            lines.append(product_line)
-            # Перебор вкусов
-            for flavor in product.flavors:
-                if flavor.quantity == 0:
-                    line = f"- <s>{flavor.name}</s> 🔴"
-                elif flavor.quantity == 1:
-                    line = f"- {flavor.name} 🟡"
-                else:
-                    line = f"- {flavor.name} 🟢"
-                lines.append(line)
-            lines.append("")  # пустая строка между товарами
-
-        text = "\n".join(lines)
-        await callback.message.edit_text(text, parse_mode="HTML")
-        await callback.answer("Канал обновлён: список всех товаров.")
-    except Exception as e:
-        await callback.message.answer(f"Ошибка: {e}")
-    finally:
-        session.close()
+def channel_product_picker(snapshot):
+    """Товары по алфавиту для прайса канала или None, если товаров нет"""
+    if not snapshot.products:
+        return None
+    buttons = [
+        [types.InlineKeyboardButton(text=product.name, callback_data=f"channel_prod_{product.id}")]
+        for product in sorted(snapshot.products, key=lambda product: product.name)
+    ]
+    # Добавляем кнопку "Назад" для возврата в меню актуального прайса
+    buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_actual_price")])
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
 @dp.callback_query(F.data == "channel_select")
 async def channel_select_product(callback: types.CallbackQuery):
-    session = Session()
     try:
-        products = session.query(Product).order_by(Product.name).all()
-        if not products:
+        markup = channel_product_picker(await catalog.get())
+        if markup is None:
             await callback.message.edit_text("Нет товаров для выбора.")
             return
 
-        buttons = []
-        for product in products:
-            buttons.append([types.InlineKeyboardButton(text=product.name, callback_data=f"channel_prod_{product.id}")])
-
-        # Добавляем кнопку "Назад" для возврата в меню актуального прайса
-        buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_actual_price")])
-
-        markup = types.InlineKeyboardMarkup(inline_keyboard=buttons)
         await callback.message.edit_text("Выберите товар:", reply_markup=markup)
         await callback.answer()
     except Exception as e:
         await callback.message.answer(f"Ошибка: {e}")
-    finally:
-        session.close()
 
 @dp.callback_query(F.data == "back_to_actual_price")
 async def back_to_actual_price(callback: types.CallbackQuery):
@@ -1565,39 +3245,6 @@ async def back_to_actual_price(callback: types.CallbackQuery):
 
 
 
-@dp.callback_query(F.data.startswith("channel_prod_"))
-async def channel_product_details(callback: types.CallbackQuery):
-    prod_id = int(callback.data.split("_")[-1])
-    session = Session()
-    try:
-        product = session.query(Product).get(prod_id)
-        if not product:
-            await callback.message.edit_text("Товар не найден.")
-            return
-
-        lines = [f"• {product.name} {int(product.sale_price)}"]
-        for flavor in product.flavors:
-            if flavor.quantity == 0:
-                line = f"- <s>{flavor.name}</s> 🔴"
-            elif flavor.quantity == 1:
-                line = f"- {flavor.name} 🟡"
-            else:
-                line = f"- {flavor.name} 🟢"
-            lines.append(line)
-        text = "\n".join(lines)
-        await callback.message.edit_text(text, parse_mode="HTML")
-        await callback.answer("Информация о товаре обновлена.")
-    except Exception as e:
-        await callback.message.edit_text(f"Ошибка: {e}")
-    finally:
-        session.close()
-
-
-
-
-
-
-
 @dp.callback_query(F.data == "cancel_sale")
 async def cancel_sale(callback: types.CallbackQuery, state: FSMContext):
     """Отмена продажи"""
@@ -1647,25 +3294,16 @@ async def actual_price_menu(message: types.Message):
 
 @dp.callback_query(F.data == "back_to_product_selection")
 async def back_to_product_selection(callback: types.CallbackQuery, state: FSMContext):
-    session = Session()
     try:
-        products = session.query(Product).order_by(Product.name).all()
-        if not products:
+        markup = channel_product_picker(await catalog.get())
+        if markup is None:
             await callback.message.edit_text("Нет товаров для выбора.")
             return
 
-        buttons = []
-        for product in products:
-            buttons.append([types.InlineKeyboardButton(text=product.name, callback_data=f"channel_prod_{product.id}")])
-        # Добавляем кнопку "🔙 Назад" для возврата в главное меню актуального прайса
-        buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_actual_price")])
-        markup = types.InlineKeyboardMarkup(inline_keyboard=buttons)
         await callback.message.edit_text("Выберите товар:", reply_markup=markup)
         await callback.answer()
     except Exception as e:
         await callback.message.edit_text(f"Ошибка: {e}")
-    finally:
-        session.close()
 
 
 
@@ -1678,6 +3316,10 @@ async def back_to_main_menu_callback(callback: types.CallbackQuery):
 
 
 
+def product_name_taken(session, name):
+    return session.query(Product.id).filter_by(name=name).first() is not None
+
+
 @dp.message(AddProductState.enter_name)
 async def enter_product_name(message: types.Message, state: FSMContext):
     if await check_navigation(message, state):
@@ -1689,11 +3331,9 @@ async def enter_product_name(message: types.Message, state: FSMContext):
         await message.answer("❌ Имя товара не может быть пустым! Введите название товара снова:")
         return
 
-    with Session() as session:
-        existing_product = session.query(Product).filter_by(name=name).first()
-        if existing_product:
-            await message.answer("❌ Товар с таким именем уже существует! Введите другое название:")
-            return  # Не меняем состояние, даем повторно ввести
+    if await run_db(product_name_taken, name):
+        await message.answer("❌ Товар с таким именем уже существует! Введите другое название:")
+        return  # Не меняем состояние, даем повторно ввести
 
     await state.update_data(name=name)
     await message.answer("Введите цены через пробел:\nФормат: <b>Закупочная Продажная Акция</b>\nПример: 100 200 150")
@@ -1728,60 +3368,55 @@ async def confirm_sale(message, quantity, state):
     """Подтверждение продажи"""
     data = await state.get_data()
 
-    with Session() as session:
-        flavor = session.get(Flavor, data['flavor_id'])
-        product = session.get(Product, data['product_id'])
-
-        if flavor.quantity < quantity:
-            await message.answer(f"❌ Недостаточно товара! Осталось: {flavor.quantity}")
-            return
+    item = await run_db(load_cart_item, data['product_id'], data['flavor_id'])
 
-        await state.update_data(quantity=quantity)
+    if item["stock"] < quantity:
+        await message.answer(f"❌ Недостаточно товара! Осталось: {item['stock']}")
+        return
 
-        # Создаем кнопки подтверждения
-        confirm_buttons = [
-            [InlineKeyboardButton(text="✅ Да, подтвердить", callback_data="confirm_sale")],
-            [InlineKeyboardButton(text="🔄 Изменить количество", callback_data="change_quantity")],
-            [InlineKeyboardButton(text="🔙 Выйти в меню", callback_data="cancel_sale")]
-        ]
-        markup = InlineKeyboardMarkup(inline_keyboard=confirm_buttons)
-
-        await message.edit_text(
-            f"Вы выбрали:\n"
-            f"📦 <b>Товар:</b> {product.name}\n"
-            f"🍏 <b>Вкус:</b> {flavor.name}\n"
-            f"📦 <b>Количество:</b> {quantity} шт.\n\n"
-            f"Все верно?",
-            reply_markup=markup,
-            parse_mode="HTML"
-        )
+    await state.update_data(quantity=quantity)
+
+    # Создаем кнопки подтверждения
+    confirm_buttons = [
+        [InlineKeyboardButton(text="✅ Да, подтвердить", callback_data="confirm_sale")],
+        [InlineKeyboardButton(text="🔄 Изменить количество", callback_data="change_quantity")],
+        [InlineKeyboardButton(text="🔙 Выйти в меню", callback_data="cancel_sale")]
+    ]
+    markup = InlineKeyboardMarkup(inline_keyboard=confirm_buttons)
+
+    await message.edit_text(
+        f"Вы выбрали:\n"
+        f"📦 <b>Товар:</b> {item['product_name']}\n"
+        f"🍏 <b>Вкус:</b> {item['flavor_name']}\n"
+        f"📦 <b>Количество:</b> {quantity} шт.\n\n"
+        f"Все верно?",
+        reply_markup=markup,
+        parse_mode="HTML"
+    )
 
 
 
 @dp.callback_query(F.data == "cancel_delete", EditProductState.confirm_delete)
 async def cancel_delete_product(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    product_id = data['product_id']
-
-    with Session() as session:
-        product = session.get(Product, product_id)
-        if product:
-            markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="✏️ Изменить цены", callback_data="edit_prices"),
-                 types.InlineKeyboardButton(text="➕ Добавить вкусы", callback_data="add_flavors")],
-                [types.InlineKeyboardButton(text="➖ Удалить вкусы", callback_data="remove_flavors"),
-                 types.InlineKeyboardButton(text="🗑️ Удалить товар", callback_data="delete_product")],
-                [types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_products")]
-            ])
-            await callback.message.edit_text(
-                f"❌ Удаление отменено. Товар: {product.name}",
-                reply_markup=markup
-            )
-            await state.set_state(EditProductState.select_action)
-        else:
-            await callback.answer("Товар не найден!")
-            await state.clear()
-            await cmd_start(callback.message)
+    product = (await catalog.get()).product(data['product_id'])
+    if product:
+        markup = types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text="✏️ Изменить цены", callback_data="edit_prices"),
+             types.InlineKeyboardButton(text="➕ Добавить вкусы", callback_data="add_flavors")],
+            [types.InlineKeyboardButton(text="➖ Удалить вкусы", callback_data="remove_flavors"),
+             types.InlineKeyboardButton(text="🗑️ Удалить товар", callback_data="delete_product")],
+            [types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_products")]
+        ])
+        await callback.message.edit_text(
+            f"❌ Удаление отменено. Товар: {product.name}",
+            reply_markup=markup
+        )
+        await state.set_state(EditProductState.select_action)
+    else:
+        await callback.answer("Товар не найден!")
+        await state.clear()
+        await cmd_start(callback.message)
 
 
 @dp.callback_query(F.data == "back_to_products_list", EditSaleState.select_flavor)
@@ -1802,123 +3437,6 @@ async def products_menu(message: types.Message):
     await message.answer("📦 <b>Меню управления товарами</b>", reply_markup=markup)
 
 
-@dp.callback_query(F.data == "channel_all")
-async def channel_all_products(callback: types.CallbackQuery):
-    session = Session()
-    try:
-        products = session.query(Product).order_by(Product.name).all()
-        if not products:
-            await callback.message.edit_text("Нет товаров для отображения.")
-            return
-
-        lines = []
-        for product in products:
-            # Отображаем товар как "• Название Цена"
-            product_line = f"• {product.name} {int(product.sale_price)}"
-            lines.append(product_line)
-            # Перебор вкусов: если количество равно 0 – оборачиваем название в <s>...</s>,
-            # иначе выводим просто название.
-            for flavor in product.flavors:
-                if flavor.quantity == 0:
-                    line = f"- <s>{flavor.name}</s>"
-                else:
-                    line = f"- {flavor.name}"
-                lines.append(line)
-            lines.append("")  # пустая строка между товарами
-
-        text = "\n".join(lines)
-        await callback.message.edit_text(text, parse_mode="HTML")
-        await callback.answer("Канал обновлён: список всех товаров.")
-    except Exception as e:
-        await callback.message.answer(f"Ошибка: {e}")
-    finally:
-        session.close()
-
-
-@dp.callback_query(F.data.startswith("channel_prod_"))
-async def channel_product_details(callback: types.CallbackQuery):
-    prod_id = int(callback.data.split("_")[-1])
-    session = Session()
-    try:
-        product = session.query(Product).get(prod_id)
-        if not product:
-            await callback.message.edit_text("Товар не найден.")
-            return
-
-        lines = [f"• {product.name} {int(product.sale_price)}"]
-        for flavor in product.flavors:
-            if flavor.quantity == 0:
-                line = f"- <s>{flavor.name}</s>"
-            else:
-                line = f"- {flavor.name}"
-            lines.append(line)
-        text = "\n".join(lines)
-        await callback.message.edit_text(text, parse_mode="HTML")
-        await callback.answer("Информация о товаре обновлена.")
-    except Exception as e:
-        await callback.message.edit_text(f"Ошибка: {e}")
-    finally:
-        session.close()
-
-
-
-@dp.message(F.text == "📦 Показать товары")
-async def show_products_menu(message: types.Message):
-    with Session() as session:
-        products = session.query(Product).all()
-
-        if not products:
-            await message.answer("📭 Нет товаров в базе")
-            return
-
-        for product in products:
-            # Рассчитываем доход с 1 штуки
-            profit_per_unit = int(product.sale_price - product.purchase_price)
-
-            # Считаем общее количество товара (по всем вкусам)
-            total_quantity = sum(flavor.quantity for flavor in product.flavors)
-
-            # Функция для обрезки длинных названий вкусов
-            def shorten_text(text, max_length=28):
-                return text if len(text) <= max_length else text[:max_length - 3] + "..."
-
-            # Формируем список вкусов
-            flavors_info = [
-                f"<blockquote>{'<s>' if flavor.quantity == 0 else ''}{shorten_text(flavor.name)} - {flavor.quantity} шт "
-                f"{'🟢' if flavor.quantity > 1 else '🟡' if flavor.quantity == 1 else '🔴'}{'</s>' if flavor.quantity == 0 else ''}</blockquote>"
-                for flavor in product.flavors
-            ]
-
-            # Финальный текст товара
-            product_text = [
-                "- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - ",
-                f"📌 <b><u>{product.name.upper()}</u></b> | {total_quantity} шт",  # Заголовок жирный и подчеркнутый
-                f"Закуп: {int(product.purchase_price)}₽",
-                f"Продажа: {int(product.sale_price)}₽",
-                f"Доход с 1 шт: {profit_per_unit}₽",
-                "",
-                "🍏 <b>Вкусы:</b>"
-            ] + flavors_info + ["- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - "]
-
-            # Отправляем сообщение
-            await message.answer("\n".join(product_text), parse_mode="HTML")
-
-    # Меню действий
-    markup = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="📥 Скачать таблицу"),
-             types.KeyboardButton(text="📤 Загрузить таблицу")],
-            [types.KeyboardButton(text="🔙 Назад")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("📦 <b>Выберите действие с таблицей:</b>", reply_markup=markup)
-
-
-
-
-
-
 @dp.message(F.text == "🔙 Назад")
 async def back_to_main(message: types.Message):
     await cmd_start(message)
@@ -1965,95 +3483,109 @@ async def enter_product_prices(message: types.Message, state: FSMContext):
         await state.set_state(AddProductState.enter_prices)
 
 
+def add_product_flavors(session, data, text):
+    """Создаёт товар из data, если его ещё нет, и разбирает строки вкусов из text.
+    Если нет ошибок и дубликатов, сразу добавляет новые вкусы.
+    Возвращает (id товара, название, дубликаты, новые вкусы, ошибки)"""
+    product = session.query(Product).filter_by(name=data['name']).first()
+    if not product:
+        product = Product(
+            name=data['name'],
+            purchase_price=data['purchase_price'],
+            sale_price=data['sale_price'],
+            sale_price_2=data['sale_price_2']
+        )
+        session.add(product)
+        session.commit()
+
+    dup_list = []   # Список для вкусов-дубликатов
+    new_list = []   # Список для новых вкусов
+    errors = []
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            flavor_name, qty = parse_flavor_line(line)
+            norm_name = flavor_name.lower().strip()
+            existing = session.query(Flavor).filter(
+                Flavor.product_id == product.id,
+                func.lower(func.trim(Flavor.name)) == norm_name
+            ).first()
+            if existing:
+                dup_list.append({"id": existing.id, "name": flavor_name, "quantity": qty})
+            else:
+                new_list.append({"name": flavor_name, "quantity": qty})
+        except ValueError as e:
+            errors.append(str(e))
+
+    product_id, name = product.id, product.name
+    if not errors and not dup_list and new_list:
+        for nf in new_list:
+            session.add(Flavor(name=nf["name"], quantity=nf["quantity"], product=product))
+        session.commit()
+    return product_id, name, dup_list, new_list, errors
+
+
 @dp.message(AddProductState.enter_flavors)
 async def enter_product_flavors(message: types.Message, state: FSMContext):
     if await check_navigation(message, state):
         return
 
     data = await state.get_data()
-    with Session() as session:
-        product = session.query(Product).filter_by(name=data['name']).first()
-        if not product:
-            product = Product(
-                name=data['name'],
-                purchase_price=data['purchase_price'],
-                sale_price=data['sale_price'],
-                sale_price_2=data['sale_price_2']
-            )
-            session.add(product)
-            session.commit()
-
-        dup_list = []   # Список для вкусов-дубликатов
-        new_list = []   # Список для новых вкусов
-        errors = []
-
-        for line in message.text.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                flavor_name, qty = parse_flavor_line(line)
-                norm_name = flavor_name.lower().strip()
-                existing = session.query(Flavor).filter(
-                    Flavor.product_id == product.id,
-                    func.lower(func.trim(Flavor.name)) == norm_name
-                ).first()
-                if existing:
-                    dup_list.append({"id": existing.id, "name": flavor_name, "quantity": qty})
-                else:
-                    new_list.append({"name": flavor_name, "quantity": qty})
-            except ValueError as e:
-                errors.append(str(e))
+    product_id, name, dup_list, new_list, errors = await run_db(add_product_flavors, data, message.text)
 
-        if errors:
-            await message.answer("Обнаружены ошибки:\n" + "\n".join(errors[:5]) +
-                                 "\nПожалуйста, введите данные вкусов снова:")
-            return
+    if errors:
+        await message.answer("Обнаружены ошибки:\n" + "\n".join(errors[:5]) +
+                             "\nПожалуйста, введите данные вкусов снова:")
+        return
 
-        if dup_list:
-            # Сохраняем данные о дубликатах и новых вкусах в состоянии
-            await state.update_data(duplicate_flavors=dup_list, new_flavors=new_list, product_id=product.id)
-            dup_names = ", ".join([dup["name"] for dup in dup_list])
-            markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="Да", callback_data="sum_duplicates_yes"),
-                 types.InlineKeyboardButton(text="Нет", callback_data="sum_duplicates_no")]
-            ])
-            await message.answer(f"Вкусы {dup_names} уже существуют. Суммировать их количества?", reply_markup=markup)
-            return
+    if dup_list:
+        # Сохраняем данные о дубликатах и новых вкусах в состоянии
+        await state.update_data(duplicate_flavors=dup_list, new_flavors=new_list, product_id=product_id)
+        dup_names = ", ".join([dup["name"] for dup in dup_list])
+        markup = types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text="Да", callback_data="sum_duplicates_yes"),
+             types.InlineKeyboardButton(text="Нет", callback_data="sum_duplicates_no")]
+        ])
+        await message.answer(f"Вкусы {dup_names} уже существуют. Суммировать их количества?", reply_markup=markup)
+        return
+    else:
+        if new_list:
+            await message.answer(f"✅ Товар <b>{name}</b> добавлен!\nНовых вкусов: {len(new_list)}")
+            await state.clear()
+            await cmd_start(message)
         else:
-            if new_list:
-                for nf in new_list:
-                    new_flavor = Flavor(name=nf["name"], quantity=nf["quantity"], product=product)
-                    session.add(new_flavor)
-                session.commit()
-                await message.answer(f"✅ Товар <b>{product.name}</b> добавлен!\nНовых вкусов: {len(new_list)}")
-                await state.clear()
-                await cmd_start(message)
-            else:
-                await message.answer("❌ Не добавлено ни одного вкуса! Повторите ввод:")
+            await message.answer("❌ Не добавлено ни одного вкуса! Повторите ввод:")
+
+def merge_product_flavors(session, product_id, dup_list, new_list):
+    """Суммирует остатки вкусов-дубликатов и добавляет новые вкусы. Возвращает название товара"""
+    product = session.get(Product, product_id)
+    # Обновляем количество для дубликатов
+    restocked = {}
+    for dup in dup_list:
+        restocked[dup["id"]] = restocked.get(dup["id"], 0) + dup["quantity"]
+    add_stock(session, restocked)
+    # Добавляем новые вкусы
+    for nf in new_list:
+        new_flavor = Flavor(name=nf["name"], quantity=nf["quantity"], product=product)
+        session.add(new_flavor)
+    name = product.name
+    session.commit()
+    return name
+
 
 @dp.callback_query(F.data == "sum_duplicates_yes")
 async def sum_duplicates_yes(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     dup_list = data.get("duplicate_flavors", [])
     new_list = data.get("new_flavors", [])
-    product_id = data.get("product_id")
-    with Session() as session:
-        product = session.get(Product, product_id)
-        # Обновляем количество для дубликатов
-        for dup in dup_list:
-            flavor = session.get(Flavor, dup["id"])
-            if flavor:
-                flavor.quantity += dup["quantity"]
-        # Добавляем новые вкусы
-        for nf in new_list:
-            new_flavor = Flavor(name=nf["name"], quantity=nf["quantity"], product=product)
-            session.add(new_flavor)
-        session.commit()
-        await callback.message.answer(
-            f"✅ Товар <b>{product.name}</b> обновлён!\n"
-            f"Количество для дубликатов суммировано, новых вкусов добавлено: {len(new_list)}"
-        )
+    name = await run_db(merge_product_flavors, data.get("product_id"), dup_list, new_list)
+    await callback.message.answer(
+        f"✅ Товар <b>{name}</b> обновлён!\n"
+        f"Количество для дубликатов суммировано, новых вкусов добавлено: {len(new_list)}"
+    )
     await state.clear()
     await cmd_start(callback.message)
 
@@ -2066,23 +3598,34 @@ async def sum_duplicates_no(callback: types.CallbackQuery, state: FSMContext):
 # Команда "✏️ Редактировать товар"
 @dp.message(F.text == "✏️ Редактировать товар")
 async def start_editing_product(message: types.Message, state: FSMContext):
-    with Session() as session:
-        products = session.query(Product).filter(Product.name.isnot(None)).all()
+    products = [product for product in (await catalog.get()).products if product.name is not None]
 
-        if not products:
-            await message.answer("❌ Нет товаров для редактирования")
-            return
+    if not products:
+        await message.answer("❌ Нет товаров для редактирования")
+        return
+
+    buttons = []
+    for product in products:
+        buttons.append([types.InlineKeyboardButton(
+            text=product.name,
+            callback_data=f"edit_{product.id}"
+        )])
+
+    markup = types.InlineKeyboardMarkup(inline_keyboard=buttons)
+    await message.answer("Выберите товар для редактирования:", reply_markup=markup)
+    await state.set_state(EditProductState.select_product)
 
-        buttons = []
-        for product in products:
-            buttons.append([types.InlineKeyboardButton(
-                text=product.name,
-                callback_data=f"edit_{product.id}"
-            )])
 
-        markup = types.InlineKeyboardMarkup(inline_keyboard=buttons)
-        await message.answer("Выберите товар для редактирования:", reply_markup=markup)
-        await state.set_state(EditProductState.select_product)
+def format_product_info(product):
+    """Цены и остатки по вкусам товара (Product или CatalogProduct)"""
+    product_info = f"📌 <b>{product.name.upper()}</b>\n"
+    product_info += f"Закуп: {int(product.purchase_price)}₽\n"
+    product_info += f"Продажа: {int(product.sale_price)}₽\n"
+    product_info += f"Акция (от 2 шт): {int(product.sale_price_2)}₽\n"
+    product_info += "Остатки по вкусам:\n"
+    for flavor in product.flavors:
+        product_info += f" - {flavor.name}: {flavor.quantity} шт.\n"
+    return product_info
 
 
 # Обработчик выбора товара из списка
@@ -2091,15 +3634,11 @@ async def select_product_to_edit(callback: types.CallbackQuery, state: FSMContex
     product_id = int(callback.data.split("_")[1])
     await state.update_data(product_id=product_id)
 
-    with Session() as session:
-        product = session.get(Product, product_id)
-        product_info = f"📌 <b>{product.name.upper()}</b>\n"
-        product_info += f"Закуп: {int(product.purchase_price)}₽\n"
-        product_info += f"Продажа: {int(product.sale_price)}₽\n"
-        product_info += f"Акция (от 2 шт): {int(product.sale_price_2)}₽\n"
-        product_info += "Остатки по вкусам:\n"
-        for flavor in product.flavors:
-            product_info += f" - {flavor.name}: {flavor.quantity} шт.\n"
+    product = (await catalog.get()).product(product_id)
+    if not product:
+        await callback.answer("Товар не найден!", show_alert=True)
+        return
+    product_info = format_product_info(product)
 
     markup = types.InlineKeyboardMarkup(inline_keyboard=[
         [types.InlineKeyboardButton(text="✏️ Изменить цены", callback_data="edit_prices"),
@@ -2122,25 +3661,24 @@ async def select_flavor_for_editing(callback: types.CallbackQuery, state: FSMCon
     data = await state.get_data()
     product_id = data.get("product_id")
 
-    with Session() as session:
-        product = session.get(Product, product_id)
-        if not product or not product.flavors:
-            await callback.message.answer("❌ Ошибка: товар или вкусы не найдены.")
-            return
+    product = (await catalog.get()).product(product_id)
+    if not product or not product.flavors:
+        await callback.message.answer("❌ Ошибка: товар или вкусы не найдены.")
+        return
 
-        # Создаем кнопки выбора вкусов
-        flavor_buttons = [
-            [types.InlineKeyboardButton(text=f"{flavor.name} ({flavor.quantity})", callback_data=f"edit_quantity_{flavor.id}")]
-            for flavor in product.flavors
-        ]
+    # Создаем кнопки выбора вкусов
+    flavor_buttons = [
+        [types.InlineKeyboardButton(text=f"{flavor.name} ({flavor.quantity})", callback_data=f"edit_quantity_{flavor.id}")]
+        for flavor in product.flavors
+    ]
 
-        # Добавляем кнопку "Назад"
-        flavor_buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_edit_product")])
+    # Добавляем кнопку "Назад"
+    flavor_buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_edit_product")])
 
-        markup = types.InlineKeyboardMarkup(inline_keyboard=flavor_buttons)
+    markup = types.InlineKeyboardMarkup(inline_keyboard=flavor_buttons)
 
-        await callback.message.edit_text("Выберите вкус для редактирования количества:", reply_markup=markup)
-        await state.set_state(EditProductState.select_action)
+    await callback.message.edit_text("Выберите вкус для редактирования количества:", reply_markup=markup)
+    await state.set_state(EditProductState.select_action)
 
 
 @dp.callback_query(F.data.startswith("edit_quantity_"), EditProductState.select_action)
@@ -2153,6 +3691,17 @@ async def request_new_quantity(callback: types.CallbackQuery, state: FSMContext)
     await state.set_state(EditProductState.update_flavor_quantity)
 
 
+def set_flavor_quantity(session, flavor_id, quantity):
+    """Задаёт остаток вкуса. Возвращает название вкуса или None, если его нет"""
+    flavor = session.get(Flavor, flavor_id)
+    if not flavor:
+        return None
+    flavor.quantity = quantity
+    name = flavor.name
+    session.commit()
+    return name
+
+
 @dp.message(EditProductState.update_flavor_quantity)
 async def update_flavor_quantity(message: types.Message, state: FSMContext):
     """Обновление количества вкуса в базе"""
@@ -2165,21 +3714,13 @@ async def update_flavor_quantity(message: types.Message, state: FSMContext):
         data = await state.get_data()
         flavor_id = data.get("flavor_id")
 
-        with Session() as session:
-            flavor = session.get(Flavor, flavor_id)
-            if not flavor:
-                await message.answer("❌ Ошибка: вкус не найден.")
-                return
-
-            # ✅ Обновляем количество
-            flavor.quantity = new_quantity
-            session.commit()
-
-            # ❗️ Теперь повторно получаем объект из БД
-            session.refresh(flavor)
+        name = await run_db(set_flavor_quantity, flavor_id, new_quantity)
+        if name is None:
+            await message.answer("❌ Ошибка: вкус не найден.")
+            return
 
-            await message.answer(f"✅ Количество для {flavor.name} обновлено: {new_quantity} шт.")
-            await state.clear()
+        await message.answer(f"✅ Количество для {name} обновлено: {new_quantity} шт.")
+        await state.clear()
 
     except ValueError:
         await message.answer("❌ Введите корректное число!")
@@ -2199,33 +3740,26 @@ async def back_to_edit_product(callback: types.CallbackQuery, state: FSMContext)
         await state.clear()
         return
 
-    with Session() as session:
-        product = session.query(Product).get(product_id)
-
-        if not product:
-            await callback.message.answer("❌ Ошибка: товар не найден. Попробуйте снова.")
-            await state.clear()
-            return
-
-        # Формируем клавиатуру для редактирования товара
-        markup = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="✏️ Изменить цены", callback_data="edit_prices"),
-             types.InlineKeyboardButton(text="➕ Добавить вкусы", callback_data="add_flavors")],
-            [types.InlineKeyboardButton(text="➖ Удалить вкусы", callback_data="remove_flavors"),
-             types.InlineKeyboardButton(text="🔄 Изменить количество вкуса", callback_data="edit_flavor_quantity")],
-            [types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_products")]
-        ])
-
-        # Редактируем предыдущее сообщение
-        await callback.message.edit_text(f"Выберите действие для товара <b>{product.name}</b>:",
-                                         reply_markup=markup, parse_mode="HTML")
-        await state.set_state(EditProductState.select_action)
-
-
-
+    product = (await catalog.get()).product(product_id)
 
+    if not product:
+        await callback.message.answer("❌ Ошибка: товар не найден. Попробуйте снова.")
+        await state.clear()
+        return
 
+    # Формируем клавиатуру для редактирования товара
+    markup = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="✏️ Изменить цены", callback_data="edit_prices"),
+         types.InlineKeyboardButton(text="➕ Добавить вкусы", callback_data="add_flavors")],
+        [types.InlineKeyboardButton(text="➖ Удалить вкусы", callback_data="remove_flavors"),
+         types.InlineKeyboardButton(text="🔄 Изменить количество вкуса", callback_data="edit_flavor_quantity")],
+        [types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_products")]
+    ])
 
+    # Редактируем предыдущее сообщение
+    await callback.message.edit_text(f"Выберите действие для товара <b>{product.name}</b>:",
+                                     reply_markup=markup, parse_mode="HTML")
+    await state.set_state(EditProductState.select_action)
 
 
 
@@ -2234,28 +3768,27 @@ async def delete_product_handler(callback: types.CallbackQuery, state: FSMContex
     data = await state.get_data()
     product_id = data.get('product_id')
 
-    with Session() as session:
-        product = session.get(Product, product_id)
-        if product:
-            markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"confirm_delete_{product_id}")],
-                [types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_delete")]
-            ])
-            await callback.message.edit_text(
-                f"❗ Вы уверены, что хотите удалить товар <b>{product.name}</b>?",
-                reply_markup=markup
-            )
-            await state.set_state(EditProductState.confirm_delete)
-        else:
-            await callback.answer("Товар не найден!", show_alert=True)
-            await state.clear()
-            await cmd_start(callback.message)
-
-
-
-@dp.callback_query(EditProductState.select_action)
-async def handle_edit_action(callback: types.CallbackQuery, state: FSMContext):
-    # Проверяем, не нажал ли пользователь кнопку "Назад" или из главного меню
+    product = (await catalog.get()).product(product_id)
+    if product:
+        markup = types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"confirm_delete_{product_id}")],
+            [types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_delete")]
+        ])
+        await callback.message.edit_text(
+            f"❗ Вы уверены, что хотите удалить товар <b>{product.name}</b>?",
+            reply_markup=markup
+        )
+        await state.set_state(EditProductState.confirm_delete)
+    else:
+        await callback.answer("Товар не найден!", show_alert=True)
+        await state.clear()
+        await cmd_start(callback.message)
+
+
+
+@dp.callback_query(EditProductState.select_action)
+async def handle_edit_action(callback: types.CallbackQuery, state: FSMContext):
+    # Проверяем, не нажал ли пользователь кнопку "Назад" или из главного меню
     if callback.data in ["📦 Управление товарами", "💵 Записать продажу", "📦 Показать товары", "📊 Аналитика", "🔙 Назад"]:
         await state.clear()  # Сбрасываем текущее состояние
         await cmd_start(callback.message)  # Возвращаем пользователя в главное меню
@@ -2274,14 +3807,21 @@ async def handle_edit_action(callback: types.CallbackQuery, state: FSMContext):
         await state.set_state(EditProductState.add_flavors)
 
     elif action == "remove_flavors":
-        with Session() as session:
-            product = session.query(Product).get(data['product_id'])
-            markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text=f.name, callback_data=f"remove_{f.id}")]
-                for f in product.flavors
-            ])
-            await callback.message.answer("Выберите вкусы для удаления:", reply_markup=markup)
-            await state.set_state(EditProductState.remove_flavors)
+        product = (await catalog.get()).product(data['product_id'])
+        markup = types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text=f.name, callback_data=f"remove_{f.id}")]
+            for f in product.flavors
+        ])
+        await callback.message.answer("Выберите вкусы для удаления:", reply_markup=markup)
+        await state.set_state(EditProductState.remove_flavors)
+
+
+def update_product_prices(session, product_id, purchase_price, sale_price, sale_price_2):
+    product = session.get(Product, product_id)
+    product.purchase_price = purchase_price
+    product.sale_price = sale_price
+    product.sale_price_2 = sale_price_2  # Обновляем новое поле
+    session.commit()
 
 
 @dp.message(EditProductState.update_prices)
@@ -2291,12 +3831,7 @@ async def update_prices(message: types.Message, state: FSMContext):
         purchase_price, sale_price, sale_price_2 = map(float, message.text.split())
         data = await state.get_data()
 
-        with Session() as session:
-            product = session.query(Product).get(data['product_id'])
-            product.purchase_price = purchase_price
-            product.sale_price = sale_price
-            product.sale_price_2 = sale_price_2  # Обновляем новое поле
-            session.commit()
+        await run_db(update_product_prices, data['product_id'], purchase_price, sale_price, sale_price_2)
 
         await message.answer("✅ Цены успешно обновлены!")
         await state.clear()
@@ -2305,154 +3840,177 @@ async def update_prices(message: types.Message, state: FSMContext):
         return
 
 
+def delete_product(session, product_id):
+    """Удаляет товар со вкусами. Возвращает его название или None, если товара нет"""
+    product = session.get(Product, product_id)
+    if not product:
+        return None
+    name = product.name
+    session.delete(product)
+    session.commit()
+    return name
+
+
+def delete_flavor(session, flavor_id):
+    """Удаляет вкус. Возвращает (вкус, товар) или None, если вкуса нет"""
+    flavor = session.get(Flavor, flavor_id)
+    if not flavor:
+        return None
+    names = (flavor.name, flavor.product.name)
+    session.delete(flavor)
+    session.commit()
+    return names
+
+
 @dp.callback_query(F.data.startswith("confirm_delete_"))
 async def confirm_delete_product(callback: types.CallbackQuery, state: FSMContext):
     product_id = int(callback.data.split("_")[-1])
 
-    with Session() as session:
-        product = session.get(Product, product_id)
-        if product:
-            session.delete(product)
-            session.commit()
-            await callback.message.edit_text(f"✅ Товар <b>{product.name}</b> удален!")
-            await state.clear()
-            await cmd_start(callback.message)
-        else:
-            await callback.answer("Товар не найден!", show_alert=True)
+    name = await run_db(delete_product, product_id)
+    if name is not None:
+        await callback.message.edit_text(f"✅ Товар <b>{name}</b> удален!")
+        await state.clear()
+        await cmd_start(callback.message)
+    else:
+        await callback.answer("Товар не найден!", show_alert=True)
 
-            @dp.callback_query(F.data == "cancel_delete", EditProductState.confirm_delete)
-            async def cancel_delete_product(callback: types.CallbackQuery, state: FSMContext):
+        @dp.callback_query(F.data == "cancel_delete", EditProductState.confirm_delete)
+        async def cancel_delete_product(callback: types.CallbackQuery, state: FSMContext):
+            data = await state.get_data()
+            product = (await catalog.get()).product(data['product_id'])
+            if product:
+                markup = types.InlineKeyboardMarkup(inline_keyboard=[
+                    [types.InlineKeyboardButton(text="✏️ Изменить цены", callback_data="edit_prices"),
+                     types.InlineKeyboardButton(text="➕ Добавить вкусы", callback_data="add_flavors")],
+                    [types.InlineKeyboardButton(text="➖ Удалить вкусы", callback_data="remove_flavors"),
+                     types.InlineKeyboardButton(text="🗑️ Удалить товар", callback_data="delete_product")]
+                ])
+
+                await callback.message.edit_text(
+                    f"❌ Удаление отменено. Товар: {product.name}",
+                    reply_markup=markup
+                )
+                await state.set_state(EditProductState.select_action)
+            else:
+                await callback.answer("Товар не найден!")
+                await state.clear()
+                await cmd_start(callback.message)
+
+            @dp.callback_query(F.data == "remove_flavors", EditProductState.select_action)
+            async def select_flavors_to_remove(callback: types.CallbackQuery, state: FSMContext):
                 data = await state.get_data()
-                product_id = data['product_id']
-
-                with Session() as session:
-                    product = session.get(Product, product_id)
-                    if product:
-                        markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                            [types.InlineKeyboardButton(text="✏️ Изменить цены", callback_data="edit_prices"),
-                             types.InlineKeyboardButton(text="➕ Добавить вкусы", callback_data="add_flavors")],
-                            [types.InlineKeyboardButton(text="➖ Удалить вкусы", callback_data="remove_flavors"),
-                             types.InlineKeyboardButton(text="🗑️ Удалить товар", callback_data="delete_product")]
-                        ])
-
-                        await callback.message.edit_text(
-                            f"❌ Удаление отменено. Товар: {product.name}",
-                            reply_markup=markup
-                        )
-                        await state.set_state(EditProductState.select_action)
-                    else:
-                        await callback.answer("Товар не найден!")
-                        await state.clear()
-                        await cmd_start(callback.message)
-
-                @dp.callback_query(F.data == "remove_flavors", EditProductState.select_action)
-                async def select_flavors_to_remove(callback: types.CallbackQuery, state: FSMContext):
-                    data = await state.get_data()
-                    product_id = data['product_id']
-
-                    with Session() as session:
-                        product = session.get(Product, product_id)
-                        if product and product.flavors:
-                            markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                                                                                    [types.InlineKeyboardButton(
-                                                                                        text=f"❌ {flavor.name}",
-                                                                                        callback_data=f"remove_{flavor.id}")]
-                                                                                    for flavor in product.flavors
-                                                                                ] + [
-                                                                                    [types.InlineKeyboardButton(
-                                                                                        text="🔙 Назад",
-                                                                                        callback_data="back_to_actions")]
-                                                                                ])
-
-                            await callback.message.edit_text(
-                                "Выберите вкусы для удаления:",
-                                reply_markup=markup
-                            )
-                            await state.set_state(EditProductState.remove_flavors)
-                        else:
-                            await callback.answer("Нет доступных вкусов!", show_alert=True)
-
-                @dp.callback_query(F.data.startswith("remove_"), EditProductState.remove_flavors)
-                async def remove_flavor_handler(callback: types.CallbackQuery, state: FSMContext):
-                    flavor_id = int(callback.data.split("_")[1])
-
-                    with Session() as session:
-                        flavor = session.get(Flavor, flavor_id)
-                        if flavor:
-                            product_name = flavor.product.name
-                            session.delete(flavor)
-                            session.commit()
-                            await callback.message.edit_text(
-                                f"✅ Вкус {flavor.name} удален из {product_name}"
-                            )
-                            await select_flavors_to_remove(callback, state)
-                        else:
-                            await callback.answer("Вкус не найден!", show_alert=True)
-
-                @dp.callback_query(F.data == "back_to_actions", EditProductState.remove_flavors)
-                async def back_to_actions_menu(callback: types.CallbackQuery, state: FSMContext):
-                    await select_product_to_edit(callback, state)
+                product = (await catalog.get()).product(data['product_id'])
+                if product and product.flavors:
+                    markup = types.InlineKeyboardMarkup(inline_keyboard=[
+                                                                            [types.InlineKeyboardButton(
+                                                                                text=f"❌ {flavor.name}",
+                                                                                callback_data=f"remove_{flavor.id}")]
+                                                                            for flavor in product.flavors
+                                                                        ] + [
+                                                                            [types.InlineKeyboardButton(
+                                                                                text="🔙 Назад",
+                                                                                callback_data="back_to_actions")]
+                                                                        ])
+
+                    await callback.message.edit_text(
+                        "Выберите вкусы для удаления:",
+                        reply_markup=markup
+                    )
+                    await state.set_state(EditProductState.remove_flavors)
+                else:
+                    await callback.answer("Нет доступных вкусов!", show_alert=True)
+
+            @dp.callback_query(F.data.startswith("remove_"), EditProductState.remove_flavors)
+            async def remove_flavor_handler(callback: types.CallbackQuery, state: FSMContext):
+                flavor_id = int(callback.data.split("_")[1])
+
+                names = await run_db(delete_flavor, flavor_id)
+                if names:
+                    await callback.message.edit_text(
+                        f"✅ Вкус {names[0]} удален из {names[1]}"
+                    )
+                    await select_flavors_to_remove(callback, state)
+                else:
+                    await callback.answer("Вкус не найден!", show_alert=True)
+
+            @dp.callback_query(F.data == "back_to_actions", EditProductState.remove_flavors)
+            async def back_to_actions_menu(callback: types.CallbackQuery, state: FSMContext):
+                await select_product_to_edit(callback, state)
+
+
+def restock_product_flavors(session, product_id, text):
+    """Суммирует остатки найденных вкусов товара и добавляет новые по строкам text.
+    Возвращает None, если товара нет, иначе (название, новых, обновлено, ошибки);
+    при ошибках ничего не записывается"""
+    product = session.get(Product, product_id)
+    if not product:
+        return None
+
+    updated_count = 0
+    new_count = 0
+    errors = []
+    restocked = {}
+
+    # Перебираем каждую строку ввода
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            # Разбираем строку, например "Яблоко 10"
+            name, quantity = parse_flavor_line(line)
+            norm_name = name.strip().lower()
+
+            # Ищем уже существующий вкус среди связанных с продуктом
+            found_flavor = None
+            for flavor in product.flavors:
+                if flavor.name.strip().lower() == norm_name:
+                    found_flavor = flavor
+                    break
+
+            if found_flavor:
+                # Если нашли – суммируем количество (одним UPDATE после разбора)
+                restocked[found_flavor.id] = restocked.get(found_flavor.id, 0) + quantity
+                updated_count += 1
+            else:
+                # Если нет – создаём новый вкус
+                new_flavor = Flavor(name=name.strip(), quantity=quantity, product=product)
+                session.add(new_flavor)
+                new_count += 1
+
+        except ValueError:
+            errors.append(f"❌ Ошибка в строке: {line}")
+
+    name = product.name
+    if errors:
+        session.rollback()
+    else:
+        add_stock(session, restocked)
+        session.commit()
+    return name, new_count, updated_count, errors
 
 
 @dp.message(EditProductState.add_flavors)
 async def add_flavors(message: types.Message, state: FSMContext):
     try:
         data = await state.get_data()
-        with Session() as session:
-            product = session.query(Product).get(data['product_id'])
-            if not product:
-                await message.answer("❌ Товар не найден!")
-                return
-
-            # Обновляем объект product, чтобы список вкусов был актуальным
-            session.refresh(product)
-
-            updated_count = 0
-            new_count = 0
-            errors = []
+        result = await run_db(restock_product_flavors, data['product_id'], message.text)
+        if result is None:
+            await message.answer("❌ Товар не найден!")
+            return
 
-            # Перебираем каждую строку ввода
-            for line in message.text.splitlines():
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    # Разбираем строку, например "Яблоко 10"
-                    name, quantity = parse_flavor_line(line)
-                    norm_name = name.strip().lower()
-
-                    # Ищем уже существующий вкус среди связанных с продуктом
-                    found_flavor = None
-                    for flavor in product.flavors:
-                        if flavor.name.strip().lower() == norm_name:
-                            found_flavor = flavor
-                            break
-
-                    if found_flavor:
-                        # Если нашли – суммируем количество
-                        found_flavor.quantity += quantity
-                        updated_count += 1
-                    else:
-                        # Если нет – создаём новый вкус
-                        new_flavor = Flavor(name=name.strip(), quantity=quantity, product=product)
-                        session.add(new_flavor)
-                        new_count += 1
-
-                except ValueError:
-                    errors.append(f"❌ Ошибка в строке: {line}")
-
-            if errors:
-                await message.answer("⚠️ Обнаружены ошибки:\n" + "\n".join(errors[:5]) +
-                                     "\n\n🔄 Введите данные снова (каждый с новой строки):")
-                return
+        name, new_count, updated_count, errors = result
+        if errors:
+            await message.answer("⚠️ Обнаружены ошибки:\n" + "\n".join(errors[:5]) +
+                                 "\n\n🔄 Введите данные снова (каждый с новой строки):")
+            return
 
-            session.commit()
-            await message.answer(
-                f"✅ Товар <b>{product.name}</b> обновлён!\n"
-                f"Новых вкусов добавлено: {new_count}\n"
-                f"Количество обновлено для: {updated_count} вкусов."
-            )
-            await state.clear()
+        await message.answer(
+            f"✅ Товар <b>{name}</b> обновлён!\n"
+            f"Новых вкусов добавлено: {new_count}\n"
+            f"Количество обновлено для: {updated_count} вкусов."
+        )
+        await state.clear()
 
     except Exception as e:
         logger.error(f"Ошибка при добавлении вкусов: {str(e)}")
@@ -2460,123 +4018,272 @@ async def add_flavors(message: types.Message, state: FSMContext):
 
 
 
-
-
 @dp.callback_query(F.data.startswith("remove_"), EditProductState.remove_flavors)
 async def remove_flavor(callback: types.CallbackQuery, state: FSMContext):
     flavor_id = int(callback.data.split("_")[1])
-    data = await state.get_data()
 
-    with Session() as session:
-        flavor = session.query(Flavor).get(flavor_id)
-        session.delete(flavor)
-        session.commit()
+    await run_db(delete_flavor, flavor_id)
 
     await callback.message.answer("✅ Вкус успешно удален!")
     await state.clear()
 # ======================= Работа с таблицей товара ======================= #
+def get_products_table_data(session):
+    """Строки таблицы товаров: (id товара, товар, закупочная цена, цена продажи, вкус, количество).
+
+    Один запрос по колонкам без загрузки объектов, построчно через yield_per;
+    товар без вкусов даёт одну строку с вкусом None. Строки одного товара идут подряд.
+    """
+    rows = session.query(
+        Product.id, Product.name, Product.purchase_price, Product.sale_price,
+        Flavor.name, Flavor.quantity
+    ).outerjoin(
+        Flavor, Flavor.product_id == Product.id
+    ).order_by(Product.name, Product.id, Flavor.id).yield_per(1000)
+    # Простые кортежи: дешевле сбрасывать в файл для процесса генерации
+    for row in rows:
+        yield tuple(row)
+
+
 @dp.message(F.text == "📥 Скачать таблицу")
 async def download_products_table(message: types.Message):
-    with Session() as session:
-        products = session.query(Product).order_by(Product.name).all()
-
-        # Создаем структуру данных
-        data = []
-        for product in products:
-            item = {
-                'Товар': product.name,
-                'Закупочная цена': product.purchase_price,
-                'Цена продажи': product.sale_price,
-                'Вкусы': [{'name': f.name, 'quantity': f.quantity} for f in product.flavors]
-            }
-            data.append(item)
-
-        # Создаем плоский DataFrame
-        rows = []
-        for item in data:
-            if not item['Вкусы']:
-                rows.append({
-                    'Товар': item['Товар'],
-                    'Закупочная цена': item['Закупочная цена'],
-                    'Цена продажи': item['Цена продажи'],
-                    'Вкус': 'Нет вкусов',
-                    'Количество': 0
-                })
-            else:
-                for i, flavor in enumerate(item['Вкусы']):
-                    rows.append({
-                        'Товар': item['Товар'] if i == 0 else '',  # Заполняем только для первой строки
-                        'Закупочная цена': item['Закупочная цена'] if i == 0 else '',
-                        'Цена продажи': item['Цена продажи'] if i == 0 else '',
-                        'Вкус': flavor['name'],
-                        'Количество': flavor['quantity']
-                    })
-
-        df = pd.DataFrame(rows)
-
-        # Генерация Excel
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Товары', startrow=0)
-
-            workbook = writer.book
-            worksheet = writer.sheets['Товары']
-
-            # Формат для объединенных ячеек
-            merge_format = workbook.add_format({
-                'valign': 'top',
-                'border': 1,
-                'text_wrap': True
-            })
+    # Строки сбрасываются на диск и пишутся в xlsx в пуле процессов,
+    # поэтому память не растёт с размером каталога
+    await enqueue_export(
+        message,
+        get_products_table_data,
+        write_products_table_xlsx,
+        "products.xlsx",
+        "📦 Таблица товаров",
+        # Версия catalog растёт после каждого изменения товаров и остатков
+        cache=await run_db(products_table_cache_key)
+    )
+
 
-            # Формат для последней строки товара (жирная линия)
-            border_format = workbook.add_format({
-                'bottom': 2,  # Жирная нижняя граница
-                'valign': 'top',
-                'border': 1,
-                'text_wrap': True
+# Telegram отдаёт ботам файлы не больше 20 МБ
+UPLOAD_MAX_SIZE = 20 * 1024 * 1024
+
+
+def apply_inventory_table(session, stream, filename):
+    """Сверяет загруженную таблицу товаров с базой и применяет разницу одной транзакцией.
+
+    Файл читается построчно, текущие товары и вкусы — двумя запросами; новые
+    и изменённые строки записываются пакетными INSERT/UPDATE. Если в строке есть
+    остаток при выгрузке, к остатку в базе прибавляется разница с «Количество»
+    (продажи после выгрузки сохраняются), иначе остаток заменяется количеством
+    из файла. Вкусы, которых нет в файле, не удаляются. Возвращает словарь со
+    сводкой изменений.
+    """
+    def norm(name):
+        return name.lower().strip()
+
+    products = {
+        norm(name): (product_id, purchase_price, sale_price)
+        for product_id, name, purchase_price, sale_price in session.query(
+            Product.id, Product.name, Product.purchase_price, Product.sale_price
+        )
+    }
+    flavors = {
+        (product_id, norm(name)): (flavor_id, quantity)
+        for flavor_id, product_id, name, quantity in session.query(
+            Flavor.id, Flavor.product_id, Flavor.name, Flavor.quantity
+        )
+    }
+
+    new_products = {}     # норм. имя товара -> строка для INSERT
+    product_updates = {}  # id товара -> новые цены
+    new_flavors = {}      # (норм. имя товара, норм. имя вкуса) -> строка для INSERT
+    flavor_updates = {}   # id вкуса -> новый остаток
+    flavor_deltas = {}    # id вкуса -> изменение остатка относительно выгрузки
+    changed_since_export = 0
+    rows = 0
+
+    for name, purchase_price, sale_price, flavor_name, quantity, exported in iter_products_table_rows(stream, filename):
+        rows += 1
+        product_key = norm(name)
+        if product_key in products:
+            product_id, old_purchase, old_sale = products[product_key]
+            if (old_purchase, old_sale) != (purchase_price, sale_price):
+                product_updates[product_id] = {
+                    "id": product_id, "purchase_price": purchase_price, "sale_price": sale_price
+                }
+        else:
+            product_id = None
+            new_products.setdefault(product_key, {
+                "name": name,
+                "purchase_price": purchase_price,
+                "sale_price": sale_price,
+                "sale_price_2": sale_price  # Цены за 2 шт. в таблице нет
             })
 
-            # Объединение ячеек для строк с несколькими вкусами
-            row_idx = 1
-            for product in data:
-                flavor_count = len(product['Вкусы']) or 1  # Количество вкусов или 1 (если их нет)
-
-                if flavor_count == 1:
-                    # Если один вкус, выделяем строку жирной линией
-                    worksheet.write(row_idx, 0, product['Товар'], border_format)
-                    worksheet.write(row_idx, 1, product['Закупочная цена'], border_format)
-                    worksheet.write(row_idx, 2, product['Цена продажи'], border_format)
-                    worksheet.write(row_idx, 3, product['Вкусы'][0]['name'] if product['Вкусы'] else 'Нет вкусов', border_format)
-                    worksheet.write(row_idx, 4, product['Вкусы'][0]['quantity'] if product['Вкусы'] else 0, border_format)
-                else:
-                    # Если несколько вкусов, объединяем ячейки для товара
-                    worksheet.merge_range(row_idx, 0, row_idx + flavor_count - 1, 0, product['Товар'], merge_format)
-                    worksheet.merge_range(row_idx, 1, row_idx + flavor_count - 1, 1, product['Закупочная цена'], merge_format)
-                    worksheet.merge_range(row_idx, 2, row_idx + flavor_count - 1, 2, product['Цена продажи'], merge_format)
-
-                    # Форматируем строки для вкусов
-                    for flavor_idx in range(flavor_count):
-                        current_row = row_idx + flavor_idx
-                        if flavor_idx == flavor_count - 1:  # Последняя строка товара
-                            worksheet.write(current_row, 3, product['Вкусы'][flavor_idx]['name'], border_format)
-                            worksheet.write(current_row, 4, product['Вкусы'][flavor_idx]['quantity'], border_format)
-                        else:  # Обычные строки вкусов без жирной линии
-                            worksheet.write(current_row, 3, product['Вкусы'][flavor_idx]['name'], merge_format)
-                            worksheet.write(current_row, 4, product['Вкусы'][flavor_idx]['quantity'], merge_format)
-
-                # Увеличиваем индекс строки
-                row_idx += flavor_count
-
-            # Автоподбор ширины колонок
-            for i, width in enumerate([25, 15, 15, 30, 15]):
-                worksheet.set_column(i, i, width)
-
-        output.seek(0)
-        await message.answer_document(
-            types.BufferedInputFile(output.read(), filename="products.xlsx"),
-            caption="📦 Таблица товаров"
+        if flavor_name is None:
+            continue
+        existing = flavors.get((product_id, norm(flavor_name)))
+        if existing:
+            flavor_id, old_quantity = existing
+            if exported is None:
+                if old_quantity != quantity:
+                    flavor_updates[flavor_id] = {"id": flavor_id, "quantity": quantity}
+                continue
+            if old_quantity != exported:
+                changed_since_export += 1
+            if quantity != exported:
+                flavor_deltas[flavor_id] = {"flavor_id": flavor_id, "delta": quantity - exported}
+        else:
+            new_flavors[(product_key, norm(flavor_name))] = {"name": flavor_name, "quantity": quantity}
+
+    product_ids = {key: value[0] for key, value in products.items()}
+    if new_products:
+        inserted = session.execute(
+            insert(Product).returning(Product.id, Product.name, sort_by_parameter_order=True),
+            list(new_products.values())
+        )
+        product_ids.update((norm(name), product_id) for product_id, name in inserted)
+    if product_updates:
+        session.execute(update(Product), list(product_updates.values()))
+    if flavor_updates:
+        session.execute(update(Flavor), list(flavor_updates.values()))
+    if flavor_deltas:
+        # Разница прибавляется в самом UPDATE: продажа, прошедшая между чтением
+        # вкусов и записью, тоже не потеряется. Остаток не уходит ниже нуля.
+        # executemany с WHERE доступен только для UPDATE таблицы, а не модели,
+        # поэтому изменение каталога отмечается явно
+        flavors_table = Flavor.__table__
+        new_quantity = flavors_table.c.quantity + bindparam("delta")
+        session.execute(
+            update(flavors_table)
+            .where(flavors_table.c.id == bindparam("flavor_id"))
+            .values(quantity=case((new_quantity < 0, 0), else_=new_quantity)),
+            list(flavor_deltas.values())
         )
+        session.info["catalog_changed"] = True
+    if new_flavors:
+        session.execute(insert(Flavor), [
+            dict(row, product_id=product_ids[product_key])
+            for (product_key, _), row in new_flavors.items()
+        ])
+    session.commit()
+
+    return {
+        "rows": rows,
+        "new_products": len(new_products),
+        "updated_products": len(product_updates),
+        "new_flavors": len(new_flavors),
+        "updated_flavors": len(flavor_updates) + len(flavor_deltas),
+        "changed_since_export": changed_since_export
+    }
+
+
+@dp.message(F.text == "📤 Загрузить таблицу")
+async def upload_products_table_start(message: types.Message, state: FSMContext):
+    await message.answer(
+        "📤 Отправьте файл <b>.xlsx</b> или <b>.csv</b> в формате «📥 Скачать таблицу».\n"
+        "Колонки: Товар, Закупочная цена, Цена продажи, Вкус, Количество, Остаток при выгрузке.\n"
+        "К остатку на складе прибавляется разница «Количество» − «Остаток при выгрузке», "
+        "поэтому продажи после скачивания таблицы не теряются. Без этой колонки количество "
+        "из файла заменяет остаток. Новые товары и вкусы будут добавлены.",
+        parse_mode="HTML"
+    )
+    await state.set_state(FileUploadState.waiting_file)
+
+
+@dp.message(FileUploadState.waiting_file, F.document)
+async def upload_products_table(message: types.Message, state: FSMContext):
+    document = message.document
+    if document.file_size and document.file_size > UPLOAD_MAX_SIZE:
+        await message.answer("❌ Файл больше 20 МБ, Telegram не даст его скачать.")
+        return
+
+    buffer = io.BytesIO()
+    await bot.download(document, destination=buffer)
+    buffer.seek(0)
+    try:
+        summary = await run_db(apply_inventory_table, buffer, document.file_name or "")
+    except ValueError as e:
+        await message.answer(f"❌ Ошибка в таблице: {e}\nИсправьте файл и отправьте снова.")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка загрузки таблицы: {str(e)}")
+        await message.answer("❌ Не удалось загрузить таблицу. Попробуйте снова.")
+        return
+
+    await state.clear()
+    await message.answer(
+        f"✅ <b>Таблица загружена</b> (строк: {summary['rows']})\n"
+        f"🆕 Новых товаров: {summary['new_products']}\n"
+        f"💰 Изменены цены: {summary['updated_products']}\n"
+        f"🍏 Новых вкусов: {summary['new_flavors']}\n"
+        f"📦 Изменены остатки: {summary['updated_flavors']}"
+        + (f"\n⚠️ Остаток изменился после скачивания таблицы: {summary['changed_since_export']} "
+           f"(к текущему остатку прибавлена разница из файла)"
+           if summary['changed_since_export'] else ""),
+        parse_mode="HTML"
+    )
+
+
+@dp.message(FileUploadState.waiting_file)
+async def upload_products_table_no_file(message: types.Message, state: FSMContext):
+    if await check_navigation(message, state):
+        return
+    await message.answer("📎 Отправьте таблицу файлом (.xlsx или .csv) или нажмите «🔙 Назад».")
+
+
+@dp.message(Command("cache_status"))
+async def show_cache_status(message: types.Message):
+    """Попадания и промахи кэша каталога"""
+    total = catalog.hits + catalog.misses
+    hit_rate = catalog.hits / total * 100 if total else 0.0
+    await message.answer(
+        "🗂 Кэш каталога\n"
+        f"Попаданий: {catalog.hits}, промахов: {catalog.misses} ({hit_rate:.0f}% из кэша)\n"
+        f"Версия каталога: {catalog.version}\n"
+        f"Клавиатуры: {len(keyboards.markups)} в кэше, попаданий {keyboards.hits}, промахов {keyboards.misses}"
+    )
+
+
+@dp.callback_query(F.data.startswith("picker_page:"))
+async def switch_picker_page(callback: types.CallbackQuery):
+    """Листает клавиатуру выбора товара, не меняя состояние FSM"""
+    _, screen, page = callback.data.split(":")
+    markup = product_picker(await catalog.get(), screen, int(page))
+    await callback.message.edit_reply_markup(reply_markup=markup)
+    await callback.answer()
+
+
+@dp.callback_query(F.data == "picker_noop")
+async def picker_noop(callback: types.CallbackQuery):
+    await callback.answer()
+
+
+@dp.message(Command("outbound_status"))
+async def show_outbound_status(message: types.Message):
+    """Исходящие сообщения: пропускная способность, ожидание в очереди, 429"""
+    stats = outbound.stats()
+    await message.answer(
+        "📤 Исходящие сообщения\n"
+        f"Отправлено: {stats['sent']} (за минуту: {stats['per_minute']})\n"
+        f"Ждут отправки: {stats['waiting']}\n"
+        f"Ожидание в очереди: среднее {stats['avg_wait_ms']:.0f} мс, максимум {stats['max_wait_ms']:.0f} мс\n"
+        f"Повторов после 429: {stats['retries']}, склеено правок: {stats['coalesced']}"
+    )
+
+
+@dp.message(Command("report_status"))
+async def show_report_status(message: types.Message):
+    """Состояние очереди отчётов: глубина очереди и время генерации"""
+    stats = report_jobs.stats()
+    cached = await asyncio.get_running_loop().run_in_executor(None, report_cache.stats)
+    await message.answer(
+        "📑 Очередь отчётов\n"
+        f"В очереди: {stats['queued']}\n"
+        f"Генерируется: {stats['in_progress']}\n"
+        f"Готово: {stats['completed']}, ошибок: {stats['failed']}\n"
+        f"Среднее время генерации: {stats['avg_render_ms']:.0f} мс\n"
+        f"Максимальное: {stats['max_render_ms']:.0f} мс\n"
+        f"Кэш файлов: попаданий {cached['hits']}, промахов {cached['misses']}, "
+        f"в памяти {cached['memory_items']}, на диске {cached['disk_files']} "
+        f"({cached['disk_bytes'] / 1024 / 1024:.1f} МБ)\n"
+        f"Документы: загружено {documents.uploads}, отправлено по file_id {documents.reused}"
+    )
 
 
 
@@ -2584,24 +4291,14 @@ async def download_products_table(message: types.Message):
 @dp.message(F.text == "💵 Записать продажу")
 async def start_sale_recording(message: types.Message, state: FSMContext):
     try:
-        with Session() as session:
-            products = session.query(Product).all()
-            if not products:
-                await message.answer("❌ Нет товаров для продажи")
-                return
-
-            # Создаем кнопки для товаров
-            product_buttons = [
-                [types.InlineKeyboardButton(text=f"{p.name}", callback_data=f"product_{p.id}")]
-                for p in products
-            ]
-
-            # Добавляем кнопку "Назад"
-            product_buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main_menu")])
+        snapshot = await catalog.get()
+        if not snapshot.products:
+            await message.answer("❌ Нет товаров для продажи")
+            return
 
-            markup = types.InlineKeyboardMarkup(inline_keyboard=product_buttons)
-            await message.answer("Выберите товар:", reply_markup=markup)
-            await state.set_state(RecordSaleState.select_product)
+        markup = product_picker(snapshot, "sale")
+        await message.answer("Выберите товар:", reply_markup=markup)
+        await state.set_state(RecordSaleState.select_product)
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}")
         await message.answer("❌ Ошибка при загрузке товаров")
@@ -2620,7 +4317,6 @@ async def back_to_main_menu(callback: types.CallbackQuery, state: FSMContext):
 
 
 
-
 # Разместить здесь ↓
 @dp.callback_query(F.data == "cancel_sale", RecordSaleState.select_product)
 async def cancel_sale(callback: types.CallbackQuery, state: FSMContext):
@@ -2634,36 +4330,25 @@ async def select_product(callback: types.CallbackQuery, state: FSMContext):
     product_id = int(callback.data.split("_")[1])
     await state.update_data(product_id=product_id)
 
-    with Session() as session:
-        product = session.query(Product).get(product_id)
-
-        # Получаем данные о текущей продаже
-        data = await state.get_data()
-        sales_list = data.get("sales_list", [])
-
-        # Получаем список уже добавленных вкусов для текущего товара
-        added_flavors = [sale["flavor_name"] for sale in sales_list if sale["product_name"] == product.name]
-
-        # Формируем список доступных вкусов, исключая уже добавленные
-        available_flavors = [f for f in product.flavors if f.name not in added_flavors]
+    snapshot = await catalog.get()
+    product = snapshot.product(product_id)
 
-        if not available_flavors:
-            await callback.answer("❌ Все доступные вкусы уже добавлены!", show_alert=True)
-            return
+    # Получаем данные о текущей продаже
+    data = await state.get_data()
+    sales_list = data.get("sales_list", [])
 
-        # Создаем кнопки для доступных вкусов
-        flavor_buttons = [
-            [types.InlineKeyboardButton(text=f"{flavor.name} ({flavor.quantity})", callback_data=f"flavor_{flavor.id}")]
-            for flavor in available_flavors
-        ]
+    # Получаем список уже добавленных вкусов для текущего товара
+    added_flavors = [sale["flavor_name"] for sale in sales_list if sale["product_name"] == product.name]
 
-        # Добавляем кнопку "Назад"
-        flavor_buttons.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_products")])
+    # Клавиатура доступных вкусов, исключая уже добавленные
+    markup = flavor_picker(snapshot, "sale", product_id, added_flavors)
 
-        markup = types.InlineKeyboardMarkup(inline_keyboard=flavor_buttons)
+    if markup is None:
+        await callback.answer("❌ Все доступные вкусы уже добавлены!", show_alert=True)
+        return
 
-        await callback.message.edit_text("Выберите вкус:", reply_markup=markup)
-        await state.set_state(RecordSaleState.select_flavor)
+    await callback.message.edit_text("Выберите вкус:", reply_markup=markup)
+    await state.set_state(RecordSaleState.select_flavor)
 
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -2673,26 +4358,16 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 async def back_to_products(callback: types.CallbackQuery, state: FSMContext):
     """Возврат к списку товаров"""
     try:
-        with Session() as session:
-            products = session.query(Product).all()
-            if not products:
-                await callback.message.answer("❌ Нет товаров для продажи")
-                return
-
-            # Создаем кнопки для товаров
-            product_buttons = [
-                [InlineKeyboardButton(text=f"{p.name}", callback_data=f"product_{p.id}")]
-                for p in products
-            ]
-
-            # Добавляем кнопку "Назад" к списку товаров
-            product_buttons.append([InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_main_menu")])
+        snapshot = await catalog.get()
+        if not snapshot.products:
+            await callback.message.answer("❌ Нет товаров для продажи")
+            return
 
-            markup = InlineKeyboardMarkup(inline_keyboard=product_buttons)
+        markup = product_picker(snapshot, "sale")
 
-            # Редактируем текущее сообщение, заменяя его на выбор товара
-            await callback.message.edit_text("Выберите товар:", reply_markup=markup)
-            await state.set_state(RecordSaleState.select_product)  # Возвращаемся к выбору товара
+        # Редактируем текущее сообщение, заменяя его на выбор товара
+        await callback.message.edit_text("Выберите товар:", reply_markup=markup)
+        await state.set_state(RecordSaleState.select_product)  # Возвращаемся к выбору товара
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}")
         await callback.message.answer("❌ Ошибка при загрузке товаров")
@@ -2704,47 +4379,47 @@ async def select_flavor(callback: types.CallbackQuery, state: FSMContext):
     flavor_id = int(callback.data.split("_")[1])
     await state.update_data(flavor_id=flavor_id)
 
-    with Session() as session:
-        flavor = session.get(Flavor, flavor_id)
-        if not flavor:
-            await callback.answer("❌ Ошибка: Вкус не найден!", show_alert=True)
-            return
-
-        # Получаем данные о текущей продаже
-        data = await state.get_data()
-        sales_list = data.get("sales_list", [])
+    snapshot = await catalog.get()
+    flavor = snapshot.flavor(flavor_id)
+    if not flavor:
+        await callback.answer("❌ Ошибка: Вкус не найден!", show_alert=True)
+        return
 
-        # Получаем список уже добавленных вкусов для текущего товара
-        added_flavors = [sale["flavor_name"] for sale in sales_list if sale["product_name"] == flavor.product.name]
+    # Получаем данные о текущей продаже
+    data = await state.get_data()
+    sales_list = data.get("sales_list", [])
 
-        # Формируем список доступных вкусов, исключая уже добавленные
-        available_flavors = [f for f in flavor.product.flavors if f.name not in added_flavors]
+    # Получаем список уже добавленных вкусов для текущего товара
+    product = snapshot.product(flavor.product_id)
+    added_flavors = [sale["flavor_name"] for sale in sales_list if sale["product_name"] == product.name]
 
-        if not available_flavors:
-            await callback.answer("❌ Все доступные вкусы уже добавлены!", show_alert=True)
-            return
+    # Формируем список доступных вкусов, исключая уже добавленные
+    available_flavors = [f for f in product.flavors if f.name not in added_flavors]
 
-        max_quantity = min(flavor.quantity, 10)  # Ограничение на 10
+    if not available_flavors:
+        await callback.answer("❌ Все доступные вкусы уже добавлены!", show_alert=True)
+        return
 
-        # Формируем кнопки выбора количества
-        quantity_buttons = [
-            [InlineKeyboardButton(text=str(i), callback_data=f"quantity_{i}") for i in range(1, min(6, max_quantity + 1))],
-            [InlineKeyboardButton(text=str(i), callback_data=f"quantity_{i}") for i in range(6, max_quantity + 1)]
-        ]
+    max_quantity = min(flavor.quantity, 10)  # Ограничение на 10
 
-        # Если больше 10, добавляем кнопку "Другое"
-        if flavor.quantity > 10:
-            quantity_buttons.append([InlineKeyboardButton(text="🔢 Другое", callback_data="quantity_other")])
+    # Формируем кнопки выбора количества
+    quantity_buttons = [
+        [InlineKeyboardButton(text=str(i), callback_data=f"quantity_{i}") for i in range(1, min(6, max_quantity + 1))],
+        [InlineKeyboardButton(text=str(i), callback_data=f"quantity_{i}") for i in range(6, max_quantity + 1)]
+    ]
 
-        # Добавляем кнопку "Назад"
-        quantity_buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_flavors")])
+    # Если больше 10, добавляем кнопку "Другое"
+    if flavor.quantity > 10:
+        quantity_buttons.append([InlineKeyboardButton(text="🔢 Другое", callback_data="quantity_other")])
 
-        markup = InlineKeyboardMarkup(inline_keyboard=quantity_buttons)
+    # Добавляем кнопку "Назад"
+    quantity_buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_flavors")])
 
-        await callback.message.edit_text(f"📦 Вкус: <b>{flavor.name}</b>\nВыберите количество:",
-                                        reply_markup=markup, parse_mode="HTML")
-        await state.set_state(RecordSaleState.enter_quantity)  # ✅ ОБЯЗАТЕЛЬНО ОБНОВЛЯЕМ СОСТОЯНИЕ
+    markup = InlineKeyboardMarkup(inline_keyboard=quantity_buttons)
 
+    await callback.message.edit_text(f"📦 Вкус: <b>{flavor.name}</b>\nВыберите количество:",
+                                    reply_markup=markup, parse_mode="HTML")
+    await state.set_state(RecordSaleState.enter_quantity)  # ✅ ОБЯЗАТЕЛЬНО ОБНОВЛЯЕМ СОСТОЯНИЕ
 
 
 
@@ -2764,13 +4439,15 @@ async def select_quantity(callback: types.CallbackQuery, state: FSMContext):
     if "sales_list" not in data:
         data["sales_list"] = []
 
-    # Получаем объект товара и вкуса из БД
-    with Session() as session:
-        product = session.query(Product).get(data["product_id"])
-        flavor = session.query(Flavor).get(data["flavor_id"])
+    # Получаем товар и вкус из каталога
+    snapshot = await catalog.get()
+    product = snapshot.product(data["product_id"])
+    flavor = snapshot.flavor(data["flavor_id"])
 
     # Добавляем новую запись о продаже в список
     data["sales_list"].append({
+        "product_id": product.id,
+        "flavor_id": flavor.id,
         "product_name": product.name,
         "flavor_name": flavor.name,
         "quantity": quantity
@@ -2798,305 +4475,58 @@ async def select_quantity(callback: types.CallbackQuery, state: FSMContext):
 
 
 
-
-
-
-
-
-
-@dp.message(RecordSaleState.enter_quantity)
-async def enter_sale_quantity(message: types.Message, state: FSMContext):
-    try:
-        quantity = int(message.text)
-        await process_sale(message, quantity, state)
-    except ValueError:
-        await message.answer("❌ Введите целое число!")
-
-
-async def process_sale(message, quantity, state):
-    """Функция для обработки продажи (общая для callback и message)"""
-    data = await state.get_data()
-
-    with Session() as session:
-        flavor = session.query(Flavor).get(data['flavor_id'])
-        product = session.query(Product).get(data['product_id'])
-
-        if flavor.quantity < quantity:
-            await message.answer(f"❌ Недостаточно! Осталось: {flavor.quantity}")
-            return
-
-        flavor.quantity -= quantity
-
-        sale = Sale(
-            product=product,
-            flavor=flavor,
-            quantity=quantity,
-            purchase_price=product.purchase_price,
-            sale_price=product.sale_price
-        )
-        session.add(sale)
-
-        profit = (sale.sale_price - sale.purchase_price) * quantity
-        lena_income = profit * 0.3
-
-        today = datetime.datetime.now().date()
-        current_week_start = datetime.datetime.combine(
-            today - datetime.timedelta(days=today.weekday()),
-            datetime.time.min
-        )
-        income_record = session.query(WorkerIncome).filter(
-            WorkerIncome.week_start == current_week_start
-        ).first()
-
-        if not income_record:
-            income_record = WorkerIncome(
-                week_start=current_week_start,
-                income=0.0,
-                is_current=True
-            )
-            session.add(income_record)
-
-        income_record.income += lena_income
-
-        session.query(WorkerIncome).filter(
-            WorkerIncome.week_start != current_week_start
-        ).update({WorkerIncome.is_current: False})
-
-        session.commit()
-
-        await message.answer(
-            f"✅ <b>Продажа оформлена!</b>\n"
-            f"📦 <b>Товар:</b> {product.name}\n"
-            f"🍏 <b>Вкус:</b> {flavor.name}\n"
-            f"📦 <b>Продано:</b> {quantity} шт.\n"
-            f"💰 <b>Выручка:</b> {quantity * product.sale_price} ₽\n"
-            f"👨💼 <b>Доход Лёни:</b> {lena_income:.2f} ₽",
-            parse_mode="HTML"
-        )
-    await state.clear()
-
-
-
-@dp.message(RecordSaleState.enter_quantity)
-async def enter_sale_quantity(message: types.Message, state: FSMContext):
-    try:
-        quantity = int(message.text)
-        await process_sale(message, quantity, state)
-    except ValueError:
-        await message.answer("❌ Введите целое число!")
-
-
-async def process_sale(event, quantity, state):
-    """Функция для обработки продажи (общая для callback и message)"""
-    data = await state.get_data()
-
-    with Session() as session:
-        flavor = session.query(Flavor).get(data['flavor_id'])
-        product = session.query(Product).get(data['product_id'])
-
-        if flavor.quantity < quantity:
-            await event.answer(f"❌ Недостаточно! Осталось: {flavor.quantity}")
-            return
-
-        flavor.quantity -= quantity
-
-        sale = Sale(
-            product=product,
-            flavor=flavor,
-            quantity=quantity,
-            purchase_price=product.purchase_price,
-            sale_price=product.sale_price
-        )
-        session.add(sale)
-
-        profit = (sale.sale_price - sale.purchase_price) * quantity
-        lena_income = profit * 0.3
-
-        today = datetime.datetime.now().date()
-        current_week_start = datetime.datetime.combine(
-            today - datetime.timedelta(days=today.weekday()),
-            datetime.time.min
-        )
-        income_record = session.query(WorkerIncome).filter(
-            WorkerIncome.week_start == current_week_start
-        ).first()
-
-        if not income_record:
-            income_record = WorkerIncome(
-                week_start=current_week_start,
-                income=0.0,
-                is_current=True
-            )
-            session.add(income_record)
-
-        income_record.income += lena_income
-
-        session.query(WorkerIncome).filter(
-            WorkerIncome.week_start != current_week_start
-        ).update({WorkerIncome.is_current: False})
-
-        session.commit()
-
-        await event.answer(
-            f"✅ Продажа оформлена!\n"
-            f"📦 Товар: {product.name}\n"
-            f"🍏 Вкус: {flavor.name}\n"
-            f"📦 Продано: {quantity} шт.\n"
-            f"💰 Выручка: {quantity * product.sale_price} ₽\n"
-            f"👨💼 Доход Лёни: {lena_income:.2f} ₽"
-        )
-    await state.clear()
-
-
-@dp.message(RecordSaleState.enter_quantity)
-async def enter_sale_quantity(message: types.Message, state: FSMContext):
-    try:
-        quantity = int(message.text)
-        data = await state.get_data()
-
-        with Session() as session:
-            flavor = session.query(Flavor).get(data['flavor_id'])
-            product = session.query(Product).get(data['product_id'])
-
-            if flavor.quantity < quantity:
-                await message.answer(f"❌ Недостаточно! Осталось: {flavor.quantity}")
-                return
-
-            flavor.quantity -= quantity
-
-            sale = Sale(
-                product=product,
-                flavor=flavor,
-                quantity=quantity,
-                purchase_price=product.purchase_price,
-                sale_price=product.sale_price
-            )
-            session.add(sale)
-
-            profit = (sale.sale_price - sale.purchase_price) * quantity
-            lena_income = profit * 0.3
-
-            today = datetime.datetime.now().date()
-            current_week_start = datetime.datetime.combine(
-                today - datetime.timedelta(days=today.weekday()),
-                datetime.time.min
-            )
-            income_record = session.query(WorkerIncome).filter(
-                WorkerIncome.week_start == current_week_start
-            ).first()
-
-            if not income_record:
-                income_record = WorkerIncome(
-                    week_start=current_week_start,
-                    income=0.0,
-                    is_current=True
-                )
-                session.add(income_record)
-
-            income_record.income += lena_income
-
-            session.query(WorkerIncome).filter(
-                WorkerIncome.week_start != current_week_start
-            ).update({WorkerIncome.is_current: False})
-
-            session.commit()
-
-            await message.answer(
-                f"✅ Продажа оформлена!\n"
-                f"📦 Товар: {product.name}\n"
-                f"🍏 Вкус: {flavor.name}\n"
-                f"📦 Продано: {quantity} шт.\n"
-                f"💰 Выручка: {quantity * product.sale_price} ₽\n"
-                f"👨💼 Доход Лёни: {lena_income:.2f} ₽"
-            )
-    except ValueError:
-        await message.answer("❌ Введите целое число!")
-    except Exception as e:
-        logger.error(f"Ошибка: {str(e)}")
-        await message.answer("❌ Ошибка при обработке")
-    finally:
-        await state.clear()
-
 # ======================= Аналитика ======================= #
-@dp.message(F.text == "📊 Аналитика")
-async def show_analytics(message: types.Message):
-    markup = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="📊 Текущая статистика"),
-             types.KeyboardButton(text="📥 Скачать отчет за месяц")],
-            [types.KeyboardButton(text="🔙 Назад")]
-        ],
-        resize_keyboard=True
+def build_current_stats_text(session, today: datetime.date):
+    """Текст текущей статистики: сегодня, текущий месяц, текущая и прошлая неделя"""
+    # Рассчет дат для текущей недели
+    current_week_start = datetime.datetime.combine(
+        today - datetime.timedelta(days=today.weekday()),
+        datetime.time.min
     )
-    await message.answer("📊 Выберите тип аналитики:", reply_markup=markup)
+    current_week_end = current_week_start + datetime.timedelta(days=6)
+    first_day, last_day = month_bounds(today)
+
+    # Все три периода считаются одним запросом с SUM по диапазонам дат
+    stats = get_period_sales_stats(session, {
+        "day": date_range_bounds(today),
+        "week": (current_week_start, current_week_start + datetime.timedelta(days=7)),
+        "month": date_range_bounds(first_day, last_day),
+    })
+    daily_revenue, daily_profit, daily_lena = stats["day"]
+    weekly_revenue, weekly_profit, weekly_lena = stats["week"]
+    monthly_revenue, monthly_profit, monthly_lena = stats["month"]
+
+    # Формируем ответ
+    response = [
+        "📊 <b>Аналитика продаж</b>",
+        f"\n🕒 <u>Сегодня ({today.strftime('%d.%m.%Y')}):</u>",
+        f"├ Выручка: {daily_revenue:.2f} ₽",
+        f"├ Прибыль: {daily_profit:.2f} ₽",
+        f"└ Доход Лёни: {daily_lena:.2f} ₽",
+
+        f"\n📅 <u>Текущий месяц:</u>",
+        f"├ Выручка: {monthly_revenue:.2f} ₽",
+        f"├ Прибыль: {monthly_profit:.2f} ₽",
+        f"└ Доход Лёни: {monthly_lena:.2f} ₽",
+
+        f"\n📆 <u>Текущая неделя ({current_week_start.strftime('%d.%m')}-{current_week_end.strftime('%d.%m')}):</u>",
+        f"├ Выручка: {weekly_revenue:.2f} ₽",
+        f"├ Прибыль: {weekly_profit:.2f} ₽",
+        f"└ Доход Лёни: {weekly_lena:.2f} ₽",
+    ]
+
+    # Добавляем данные за прошлую неделю
+    last_week_start = current_week_start - datetime.timedelta(weeks=1)
+    last_week_income = session.query(WorkerIncome).filter_by(week_start=last_week_start).first()
+    if last_week_income:
+        response.append(f"\n⏮ <u>Прошлая неделя:</u>\n└ Доход Лёни: {last_week_income.income:.2f} ₽")
+    return "\n".join(response)
 
 
 @dp.message(F.text == "📊 Текущая статистика")
 async def show_current_stats(message: types.Message):
     try:
-        with Session() as session:
-            today = datetime.date.today()
-
-            # Рассчет дат для текущей недели
-            current_week_start = datetime.datetime.combine(
-                today - datetime.timedelta(days=today.weekday()),
-                datetime.time.min
-            )
-            current_week_end = current_week_start + datetime.timedelta(days=6)
-
-            # Получаем данные за текущую неделю
-            current_week_sales = session.query(Sale).filter(
-                Sale.date >= current_week_start,
-                Sale.date <= current_week_end
-            ).all()
-
-            # Получаем данные за сегодня
-            daily_sales = session.query(Sale).filter(func.date(Sale.date) == today).all()
-
-            # Получаем данные за текущий месяц
-            monthly_sales = session.query(Sale).filter(
-                func.extract('month', Sale.date) == today.month,
-                func.extract('year', Sale.date) == today.year
-            ).all()
-
-            # Функция для расчета показателей
-            def calculate_stats(sales):
-                revenue = sum(s.sale_price * s.quantity for s in sales)
-                profit = sum((s.sale_price - s.purchase_price) * s.quantity for s in sales)
-                lena = profit * 0.3
-                return revenue, profit, lena
-
-            # Рассчитываем все показатели
-            daily_revenue, daily_profit, daily_lena = calculate_stats(daily_sales)
-            weekly_revenue, weekly_profit, weekly_lena = calculate_stats(current_week_sales)
-            monthly_revenue, monthly_profit, monthly_lena = calculate_stats(monthly_sales)
-
-            # Формируем ответ
-            response = [
-                "📊 <b>Аналитика продаж</b>",
-                f"\n🕒 <u>Сегодня ({today.strftime('%d.%m.%Y')}):</u>",
-                f"├ Выручка: {daily_revenue:.2f} ₽",
-                f"├ Прибыль: {daily_profit:.2f} ₽",
-                f"└ Доход Лёни: {daily_lena:.2f} ₽",
-
-                f"\n📅 <u>Текущий месяц:</u>",
-                f"├ Выручка: {monthly_revenue:.2f} ₽",
-                f"├ Прибыль: {monthly_profit:.2f} ₽",
-                f"└ Доход Лёни: {monthly_lena:.2f} ₽",
-
-                f"\n📆 <u>Текущая неделя ({current_week_start.strftime('%d.%m')}-{current_week_end.strftime('%d.%m')}):</u>",
-                f"├ Выручка: {weekly_revenue:.2f} ₽",
-                f"├ Прибыль: {weekly_profit:.2f} ₽",
-                f"└ Доход Лёни: {weekly_lena:.2f} ₽",
-            ]
-
-            # Добавляем данные за прошлую неделю
-            last_week_start = current_week_start - datetime.timedelta(weeks=1)
-            last_week_income = session.query(WorkerIncome).filter_by(week_start=last_week_start).first()
-            if last_week_income:
-                response.append(f"\n⏮ <u>Прошлая неделя:</u>\n└ Доход Лёни: {last_week_income.income:.2f} ₽")
-
-            await message.answer("\n".join(response))
+        await message.answer(await run_db(build_current_stats_text, datetime.date.today()))
 
     except Exception as e:
         logger.error(f"Ошибка аналитики: {str(e)}")
@@ -3104,7 +4534,6 @@ async def show_current_stats(message: types.Message):
 
 
 
-
 # ======================= ОБРАБОТКА ОШИБОК ======================= #
 @dp.message()
 async def handle_unknown(message: types.Message):
@@ -3116,11 +4545,231 @@ async def handle_unknown_callback(callback: types.CallbackQuery):
 
 
 
-
 # ======================= ЗАПУСК ======================= #
 
+# ======================= ОБНОВЛЕНИЯ, НАКОПИВШИЕСЯ ЗА ПРОСТОЙ ======================= #
+# Что делать с очередью обновлений, которую Telegram копит, пока бот выключен:
+#   none    — обработать всё как есть
+#   skip    — выбросить всю очередь при запуске
+#   last_n  — обработать только последние BACKLOG_LAST_N обновлений каждого чата
+#   max_age — отклонять сообщения старше BACKLOG_MAX_AGE секунд до вызова обработчиков,
+#             а пока разбирается накопленная очередь — и нажатия кнопок под ними
+# В режиме webhook skip выполняется через set_webhook(drop_pending_updates=True),
+# а last_n недоступен: getUpdates не работает, пока webhook установлен.
+STARTUP_BACKLOG_POLICY = os.getenv("STARTUP_BACKLOG_POLICY", "none")
+BACKLOG_LAST_N = int(os.getenv("BACKLOG_LAST_N", "1"))
+BACKLOG_MAX_AGE = int(os.getenv("BACKLOG_MAX_AGE", "300"))
+BACKLOG_DRAIN_SECONDS = 10  # столько после первого обновления считаем, что идёт очередь за простой
+
+
+def update_chat_id(update: types.Update):
+    """Чат (или пользователь), к которому относится обновление"""
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None and isinstance(getattr(event, "message", None), types.Message):
+        chat = event.message.chat
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user else None
+
+
+def update_date(update: types.Update):
+    """Время отправки для сообщений; у остальных обновлений его нет"""
+    date = getattr(update.event, "date", None)
+    return date if isinstance(date, datetime.datetime) else None
+
+
+async def drain_backlog_last_n(bot: Bot, last_n: int):
+    """Забирает накопленные обновления, подтверждает их и возвращает последние last_n на чат"""
+    await bot.delete_webhook(drop_pending_updates=False)  # getUpdates не работает при активном webhook
+    pending = []
+    offset = None
+    while True:
+        batch = await bot.get_updates(offset=offset, timeout=0, limit=100,
+                                      allowed_updates=dp.resolve_used_update_types())
+        if not batch:
+            break
+        pending.extend(batch)
+        offset = batch[-1].update_id + 1
+    if offset is not None:
+        await bot.get_updates(offset=offset, timeout=0, limit=1)  # подтверждаем всю пачку
+
+    kept_ids = set()
+    per_chat = collections.defaultdict(list)
+    for pending_update in pending:
+        per_chat[update_chat_id(pending_update)].append(pending_update.update_id)
+    for update_ids in per_chat.values():
+        kept_ids.update(update_ids[-last_n:])
+    return [pending_update for pending_update in pending if pending_update.update_id in kept_ids], len(pending)
+
+
+async def replay_updates(bot: Bot, updates):
+    for pending_update in updates:
+        await dp.feed_update(bot, pending_update)
+
+
+async def apply_backlog_policy(bot: Bot):
+    """Startup-обработчик режима polling: применяет skip или last_n к накопленной очереди"""
+    if STARTUP_BACKLOG_POLICY not in ("skip", "last_n"):
+        return
+    started = time.perf_counter()
+    if STARTUP_BACKLOG_POLICY == "skip":
+        dropped = (await bot.get_webhook_info()).pending_update_count
+        await bot.delete_webhook(drop_pending_updates=True)
+        kept = 0
+    else:
+        updates, total = await drain_backlog_last_n(bot, BACKLOG_LAST_N)
+        dropped, kept = total - len(updates), len(updates)
+        # Обрабатываем после запуска, чтобы не задерживать старт диспетчера
+        asyncio.create_task(replay_updates(bot, updates))
+    logger.info(f"Очередь при запуске ({STARTUP_BACKLOG_POLICY}): отброшено {dropped}, "
+                f"оставлено {kept} за {time.perf_counter() - started:.2f} с")
+
+
+class StaleUpdateFilter:
+    """Outer-middleware: отбрасывает сообщения старше max_age до хендлеров.
+
+    У нажатия кнопки нет времени отправки. Пока идёт очередь, накопленная за
+    простой (до первого свежего сообщения, но не дольше drain_seconds после
+    первого обновления), отбрасываются и нажатия кнопок под сообщениями старше
+    max_age. Потом они пропускаются: под старым меню можно нажать и сейчас.
+    """
+
+    def __init__(self, max_age: int, drain_seconds: float = BACKLOG_DRAIN_SECONDS):
+        self.max_age = datetime.timedelta(seconds=max_age)
+        self.drain_seconds = drain_seconds
+        self.drain_until = None  # время monotonic, до которого идёт очередь
+        self.dropped = 0
+        self.first_drop = None
+
+    def _too_old(self, date) -> bool:
+        return datetime.datetime.now(date.tzinfo) - date > self.max_age
+
+    def is_stale(self, update: types.Update) -> bool:
+        now = time.monotonic()
+        if self.drain_until is None:
+            self.drain_until = now + self.drain_seconds
+        date = update_date(update)
+        if date is not None:
+            if self._too_old(date):
+                return True
+            self.drain_until = now  # пришло свежее сообщение — очередь разобрана
+            return False
+        callback = update.callback_query
+        if callback is None or now >= self.drain_until:
+            return False
+        # Сообщение, недоступное боту (старше 48 часов), приходит без даты
+        message_date = getattr(callback.message, "date", None)
+        return not isinstance(message_date, datetime.datetime) or self._too_old(message_date)
+
+    async def __call__(self, handler, update: types.Update, data: dict):
+        if self.is_stale(update):
+            if not self.dropped:
+                self.first_drop = time.perf_counter()
+            self.dropped += 1
+            return None
+        if self.dropped:
+            logger.info(f"Отброшено устаревших обновлений: {self.dropped} "
+                        f"за {time.perf_counter() - self.first_drop:.2f} с")
+            self.dropped = 0
+        return await handler(update, data)
+
+
+if STARTUP_BACKLOG_POLICY == "max_age":
+    dp.update.outer_middleware(StaleUpdateFilter(BACKLOG_MAX_AGE))
+
+
+# ======================= ЗАПУСК ЧЕРЕЗ WEBHOOK ======================= #
+# Вместо long polling Telegram сам присылает обновления на HTTP-сервер бота.
+# Несколько процессов можно поставить за локальный reverse proxy на разных портах.
+BOT_MODE = os.getenv("BOT_MODE", "polling")                     # polling | webhook
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")            # адрес, который слушает сервер
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")                 # публичный https-адрес прокси
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+
+async def register_webhook(bot: Bot):
+    """Сообщает Telegram адрес webhook при старте; при STARTUP_BACKLOG_POLICY=skip
+    заодно сбрасывает накопленную очередь. Webhook никогда не удаляется."""
+    if not WEBHOOK_BASE_URL:
+        logger.warning("WEBHOOK_BASE_URL не задан, адрес webhook в Telegram не обновлён")
+        return
+    drop_pending = STARTUP_BACKLOG_POLICY == "skip"
+    dropped = (await bot.get_webhook_info()).pending_update_count if drop_pending else 0
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=drop_pending
+    )
+    logger.info(f"Webhook установлен: {WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}")
+    if drop_pending:
+        logger.info(f"Очередь при запуске (skip): отброшено {dropped}")
+
+
+def build_webhook_app() -> web.Application:
+    """aiohttp-приложение, принимающее обновления на WEBHOOK_PATH.
+
+    Запросы без верного X-Telegram-Bot-Api-Secret-Token отклоняются с 401.
+    При остановке приложения выполняются shutdown-обработчики диспетчера.
+    """
+    if not WEBHOOK_SECRET:
+        raise ValueError("Для режима webhook укажите WEBHOOK_SECRET.")
+    if STARTUP_BACKLOG_POLICY == "last_n":
+        raise ValueError("STARTUP_BACKLOG_POLICY=last_n работает только в режиме polling.")
+    if STARTUP_BACKLOG_POLICY == "skip" and not WEBHOOK_BASE_URL:
+        raise ValueError("Для STARTUP_BACKLOG_POLICY=skip в режиме webhook укажите WEBHOOK_BASE_URL.")
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def run_webhook():
+    dp.startup.register(register_webhook)
+    # run_app сам завершает работу по SIGINT/SIGTERM, дожидаясь обработки запросов
+    web.run_app(build_webhook_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT, print=None)
+
+
+def run_polling():
+    # delete_webhook/getUpdates в политиках очереди допустимы только в режиме polling
+    dp.startup.register(apply_backlog_policy)
+    asyncio.run(dp.start_polling(bot))
+
+
+def print_startup_profile():
+    """Отчёт --profile-startup: этапы запуска и самые долгие импорты"""
+    startup_stages.append(("всего до запуска диспетчера", time.perf_counter() - STARTUP_BEGAN))
+    stage_started = time.perf_counter()
+    warm_up()
+    startup_stages.append(("pandas (при первом отчёте, в пуле процессов)", time.perf_counter() - stage_started))
+
+    print("Этапы запуска:")
+    for stage, seconds in startup_stages:
+        print(f"  {seconds * 1000:8.1f} мс  {stage}")
+    print("Импорты (с вложенными модулями):")
+    for name, seconds in sorted(import_times.items(), key=lambda item: -item[1])[:25]:
+        print(f"  {seconds * 1000:8.1f} мс  {name}")
+
+
 if __name__ == "__main__":
-    import asyncio
+    if PROFILE_STARTUP:
+        print_startup_profile()
+        sys.exit(0)
+
+    with Session() as session:
+        if "--rebuild-rollup" in sys.argv:
+            logger.info(f"daily_sales_rollup пересобрана: {rebuild_daily_rollup(session)} строк")
+            sys.exit(0)
+        # Первичное заполнение итогов по дням для базы, где таблица только что появилась
+        if session.query(DailySalesRollup).first() is None and session.query(Sale).first() is not None:
+            logger.info(f"daily_sales_rollup заполнена из истории: {rebuild_daily_rollup(session)} строк")
 
     logger.info("Бот запущен")
-    asyncio.run(dp.start_polling(bot))
\ No newline at end of file
+    if BOT_MODE == "webhook" or "--webhook" in sys.argv:
+        run_webhook()
+    else:
+        run_polling()
\ No newline at end of file
@@ -0,0 +1,7 @@
+"""Общая подготовка бенчмарков: бот на временной SQLite-базе и подсчёт SQL-запросов из tests/support.py"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.support import bot_module, clear_database, count_statements  # noqa: E402,F401
@@ -0,0 +1,58 @@
+"""Регрессионный бенчмарк выгрузки покупателей за месяц: число SQL-запросов
+не должно зависеть от числа покупателей и продаж.
+
+    python benchmarks/customers_month_queries.py
+
+Завершается с кодом 1, если выборка строк делает больше одного запроса.
+"""
+import datetime
+import sys
+import time
+
+from common import bot_module as app, clear_database, count_statements
+
+SIZES = (100, 1000, 5000)  # покупателей, по 3 продажи у каждого
+MAX_STATEMENTS = 1
+
+
+def seed(customers: int):
+    clear_database()
+    with app.Session() as session:
+        product = app.Product(name="Товар", purchase_price=100, sale_price=200, sale_price_2=150)
+        session.add(product)
+        session.flush()
+        flavor = app.Flavor(name="Манго", quantity=0, product_id=product.id)
+        session.add(flavor)
+        session.flush()
+        now = datetime.datetime.now()
+        customer_ids = session.execute(
+            app.insert(app.Customer).returning(app.Customer.id),
+            [{"name": f"Покупатель {number}", "date": now} for number in range(customers)]
+        ).scalars().all()
+        session.execute(app.insert(app.Sale), [
+            {"product_id": product.id, "flavor_id": flavor.id, "customer_id": customer_id,
+             "quantity": 1, "purchase_price": 100, "sale_price": 150, "date": now}
+            for customer_id in customer_ids for _ in range(3)
+        ])
+        session.commit()
+
+
+def main():
+    first_day, last_day = app.month_bounds(datetime.date.today())
+    failed = False
+    print(f"{'покупателей':>12} {'строк':>8} {'запросов':>9} {'время, мс':>10}")
+    for customers in SIZES:
+        seed(customers)
+        with app.Session() as session, count_statements() as counter:
+            started = time.perf_counter()
+            rows = sum(1 for _ in app.iter_customers_month_rows(session, first_day, last_day))
+            elapsed = time.perf_counter() - started
+        print(f"{customers:>12} {rows:>8} {counter['count']:>9} {elapsed * 1000:>10.1f}")
+        failed |= counter["count"] > MAX_STATEMENTS
+    if failed:
+        print(f"Ошибка: больше {MAX_STATEMENTS} запроса на выгрузку")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
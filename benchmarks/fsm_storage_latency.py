@@ -0,0 +1,60 @@
+"""Бенчмарк FSM-хранилища: задержка set_state/update_data и get_state/get_data
+в DatabaseStorage против MemoryStorage.
+
+    python benchmarks/fsm_storage_latency.py
+
+DatabaseStorage пишет каждое изменение сразу (write-through) и читает из БД,
+поэтому медленнее MemoryStorage; бенчмарк показывает, во сколько обходится
+одно обновление пользователя. Завершается с кодом 1, если запись или чтение
+в DatabaseStorage дольше MAX_DB_MS миллисекунд в среднем.
+"""
+import asyncio
+import sys
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from common import bot_module as app, clear_database
+
+OPERATIONS = 1000
+USERS = 50
+MAX_DB_MS = 20
+
+
+async def measure(storage):
+    """Средние задержки записи и чтения одного обновления, мс"""
+    keys = [StorageKey(bot_id=1, chat_id=number % USERS, user_id=number % USERS) for number in range(OPERATIONS)]
+
+    started = time.perf_counter()
+    for number, key in enumerate(keys):
+        await storage.set_state(key, app.RecordSaleState.enter_quantity)
+        await storage.update_data(key, {"sales_list": [{"product_id": 1, "flavor_id": 2, "quantity": number}]})
+    write_ms = (time.perf_counter() - started) / OPERATIONS * 1000
+
+    started = time.perf_counter()
+    for key in keys:
+        await storage.get_state(key)
+        await storage.get_data(key)
+    read_ms = (time.perf_counter() - started) / OPERATIONS * 1000
+
+    await storage.close()
+    return write_ms, read_ms
+
+
+def main():
+    clear_database()
+    results = {
+        "MemoryStorage": asyncio.run(measure(MemoryStorage())),
+        "DatabaseStorage": asyncio.run(measure(app.DatabaseStorage(app.FSM_STATE_TTL))),
+    }
+    print(f"{'хранилище':>16} {'запись, мс':>11} {'чтение, мс':>11}")
+    for name, (write_ms, read_ms) in results.items():
+        print(f"{name:>16} {write_ms:>11.3f} {read_ms:>11.3f}")
+    if max(results["DatabaseStorage"]) > MAX_DB_MS:
+        print(f"Ошибка: операция DatabaseStorage дольше {MAX_DB_MS} мс")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
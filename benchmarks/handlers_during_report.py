@@ -0,0 +1,107 @@
+"""Бенчмарк обработчиков во время долгого отчёта: изменения товаров от других
+пользователей не должны ждать, пока отчёт держит поток пула БД.
+
+    python benchmarks/handlers_during_report.py
+
+Отчёт имитируется задачей run_db, которая занимает поток пула на REPORT_SECONDS.
+Завершается с кодом 1, если обновление во время отчёта ждало дольше
+MAX_LATENCY_SHARE от его длительности.
+"""
+import asyncio
+import sys
+import time
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from common import bot_module as app, clear_database
+
+UPDATES = 20
+REPORT_SECONDS = 2.0
+MAX_LATENCY_SHARE = 0.25
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def answer(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def seed():
+    clear_database()
+    with app.Session() as session:
+        product = app.Product(name="Товар", purchase_price=100, sale_price=200, sale_price_2=150)
+        session.add(product)
+        session.flush()
+        flavors = [app.Flavor(name=f"Вкус {number}", quantity=10, product_id=product.id) for number in range(UPDATES)]
+        session.add_all(flavors)
+        session.commit()
+        return [flavor.id for flavor in flavors]
+
+
+def long_report(session):
+    # Долгий запрос отчёта: поток пула БД занят, цикл событий свободен
+    session.query(app.Sale).count()
+    time.sleep(REPORT_SECONDS)
+
+
+async def update_quantity(storage, user_id, flavor_id):
+    """Одно обновление остатка через обработчик; возвращает задержку ответа"""
+    state = FSMContext(storage=storage, key=StorageKey(bot_id=1, chat_id=user_id, user_id=user_id))
+    await state.update_data(flavor_id=flavor_id)
+    message = FakeMessage(str(user_id))
+    started = time.perf_counter()
+    await app.update_flavor_quantity(message, state)
+    assert message.replies and message.replies[0].startswith("✅"), message.replies
+    return time.perf_counter() - started
+
+
+async def run_updates(flavor_ids):
+    storage = MemoryStorage()
+    return await asyncio.gather(*(
+        update_quantity(storage, user_id, flavor_id) for user_id, flavor_id in enumerate(flavor_ids, 1)
+    ))
+
+
+async def loop_lag(lags, interval=0.01):
+    """Максимальное опоздание тиков цикла событий: обработчик с запросом
+    прямо в цикле задерживает их на время запроса"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def measure(flavor_ids):
+    idle = await run_updates(flavor_ids)
+
+    lags = []
+    ticker = asyncio.ensure_future(loop_lag(lags))
+    report = asyncio.ensure_future(app.run_db(long_report))
+    await asyncio.sleep(0.1)  # отчёт уже занял поток пула
+    during = await run_updates(flavor_ids)
+    finished_before_report = not report.done()
+    await report
+    ticker.cancel()
+    return idle, during, max(lags), finished_before_report
+
+
+def main():
+    flavor_ids = seed()
+    idle, during, max_lag, finished_before_report = asyncio.run(measure(flavor_ids))
+    print(f"Пул БД: {app.DB_POOL_SIZE} потоков, обновлений: {UPDATES}, отчёт: {REPORT_SECONDS:.1f} с")
+    print(f"Без отчёта:   макс. {max(idle) * 1000:7.1f} мс, сред. {sum(idle) / len(idle) * 1000:7.1f} мс")
+    print(f"Во время:     макс. {max(during) * 1000:7.1f} мс, сред. {sum(during) / len(during) * 1000:7.1f} мс")
+    print(f"Макс. задержка цикла событий: {max_lag * 1000:.1f} мс")
+    print(f"Обновления завершились до конца отчёта: {'да' if finished_before_report else 'нет'}")
+    if not finished_before_report or max(during) > REPORT_SECONDS * MAX_LATENCY_SHARE:
+        print("Ошибка: обновления ждут окончания отчёта")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Бенчмарк «📥 Скачать таблицу»: время и пик памяти выборки и построения xlsx
+на 5 000 и 50 000 вкусов, прежняя реализация против текущей.
+
+    python benchmarks/products_table_memory.py
+
+Прежняя реализация собирала все строки в список, передавала его в процесс
+генерации целиком (pickle) и строила файл в памяти. Текущая сбрасывает строки
+на диск пачками (spool_rows) и пишет xlsx в файл (write_spooled). Пик памяти
+Python-объектов считается через tracemalloc. Завершается с кодом 1, если пик
+текущей реализации растёт с размером каталога больше чем в MAX_GROWTH раз.
+"""
+import io
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from common import bot_module as app, clear_database
+
+from reports import spool_rows, write_spooled
+
+SIZES = (50, 500)  # товаров, по FLAVORS_PER_PRODUCT вкусов у каждого
+FLAVORS_PER_PRODUCT = 100
+MAX_GROWTH = 2
+
+
+def seed(products: int):
+    clear_database()
+    with app.Session() as session:
+        product_ids = session.execute(
+            app.insert(app.Product).returning(app.Product.id),
+            [{"name": f"Товар {number:03d}", "purchase_price": 100, "sale_price": 200, "sale_price_2": 150}
+             for number in range(products)]
+        ).scalars().all()
+        session.execute(app.insert(app.Flavor), [
+            {"name": f"Вкус {number:03d}", "quantity": number, "product_id": product_id}
+            for product_id in product_ids for number in range(FLAVORS_PER_PRODUCT)
+        ])
+        session.commit()
+
+
+def export_old(directory):
+    with app.Session() as session:
+        rows = list(app.get_products_table_data(session))
+    rows = pickle.loads(pickle.dumps(rows))  # передача в процесс пула
+    output = io.BytesIO()
+    app.write_products_table_xlsx(rows, output)
+    return len(output.getvalue())
+
+
+def export_new(directory):
+    spool_path = os.path.join(directory, "rows.spool")
+    path = os.path.join(directory, "products.xlsx")
+    with app.Session() as session:
+        spool_rows(app.get_products_table_data(session), spool_path)
+    write_spooled(app.write_products_table_xlsx, spool_path, path)
+    return os.path.getsize(path)
+
+
+def measure(export):
+    with tempfile.TemporaryDirectory() as directory:
+        # Время — без tracemalloc: он замедляет построение xlsx в разы
+        started = time.perf_counter()
+        size = export(directory)
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        export(directory)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    return elapsed, peak_mb, size
+
+
+def main():
+    peaks = {}
+    print(f"{'вкусов':>8} {'реализация':>11} {'время, мс':>10} {'пик, МБ':>8} {'файл, МБ':>9}")
+    for products in SIZES:
+        seed(products)
+        for name, export in (("прежняя", export_old), ("текущая", export_new)):
+            elapsed, peak_mb, size = measure(export)
+            peaks[name, products] = peak_mb
+            print(f"{products * FLAVORS_PER_PRODUCT:>8} {name:>11} {elapsed * 1000:>10.0f} "
+                  f"{peak_mb:>8.1f} {size / 1024 / 1024:>9.1f}")
+
+    growth = peaks["текущая", SIZES[-1]] / peaks["текущая", SIZES[0]]
+    print(f"Рост пика текущей реализации: ×{growth:.1f} "
+          f"(прежней: ×{peaks['прежняя', SIZES[-1]] / peaks['прежняя', SIZES[0]]:.1f})")
+    if growth > MAX_GROWTH:
+        print(f"Ошибка: пик памяти растёт с размером каталога больше чем в {MAX_GROWTH} раза")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
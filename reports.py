@@ -0,0 +1,547 @@
+# ======================= ГЕНЕРАЦИЯ XLSX-ОТЧЕТОВ ======================= #
+# Функции получают уже выбранные из БД данные (простые списки/словари) и
+# возвращают байты файла. Модуль не импортирует бота и БД, поэтому его можно
+# выполнять в отдельных процессах пула генерации отчётов.
+# pandas и xlsxwriter импортируются внутри функций: бот импортирует этот модуль
+# при запуске, а сами библиотеки нужны только при первой генерации отчёта.
+import codecs
+import csv
+import importlib.util
+import io
+import itertools
+import multiprocessing
+import os
+import pickle
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree.ElementTree import iterparse
+
+# Колонки таблицы товаров («📥 Скачать таблицу» / «📤 Загрузить таблицу»)
+PRODUCTS_TABLE_COLUMNS = ("Товар", "Закупочная цена", "Цена продажи", "Вкус", "Количество")
+# Остаток на момент выгрузки: при загрузке к текущему остатку прибавляется
+# разница «Количество» − эта колонка, поэтому продажи после выгрузки не теряются
+EXPORTED_QUANTITY_COLUMN = "Остаток при выгрузке"
+NO_FLAVORS = "Нет вкусов"
+
+
+def render_month_report_xlsx(daily_stats):
+    """Строит xlsx-отчёт за месяц из результата get_daily_sales_stats, возвращает байты файла"""
+    import pandas as pd
+
+    report_data = [
+        {
+            "Дата": day["date"].strftime("%d.%m.%Y"),
+            "Продажи": day["count"],
+            "Доход": day["revenue"],
+            "Прибыль": day["profit"],
+            "Доход Лёни": day["lena_income"]
+        }
+        for day in daily_stats
+    ]
+
+    df = pd.DataFrame(report_data)
+    totals = pd.DataFrame([{
+        "Дата": "ИТОГО:",
+        "Продажи": df["Продажи"].sum(),
+        "Доход": df["Доход"].sum(),
+        "Прибыль": df["Прибыль"].sum(),
+        "Доход Лёни": df["Доход Лёни"].sum()
+    }])
+
+    df = pd.concat([df, totals], ignore_index=True)
+
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False, sheet_name='Отчет')
+
+        workbook = writer.book
+        worksheet = writer.sheets['Отчет']
+
+        num_format = workbook.add_format({'num_format': '#,##0.00₽'})
+        date_format = workbook.add_format({'num_format': 'dd.mm.yyyy'})
+
+        worksheet.set_column('A:A', 12, date_format)
+        worksheet.set_column('B:E', 15, num_format)
+
+        totals_format = workbook.add_format({
+            'bold': True,
+            'bg_color': '#FFFF00',
+            'num_format': '#,##0.00₽'
+        })
+
+        last_row = len(df)
+        for col in range(4):
+            worksheet.write(last_row, col + 1, df.iloc[-1, col + 1], totals_format)
+
+    return output.getvalue()
+
+
+def write_customers_month_xlsx(rows, path):
+    """Пишет строки продаж покупателей (колонки CUSTOMERS_MONTH_COLUMNS) в xlsx
+    в режиме constant_memory, возвращает число строк"""
+    import xlsxwriter
+
+    headers = ["Дата", "Покупатель", "Товар", "Вкус", "Количество", "Цена продажи", "Выручка"]
+    widths = [12, 25, 20, 20, 12, 15, 15]
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Покупатели')
+    header_format = workbook.add_format({'bold': True, 'border': 1})
+
+    for col, (header, width) in enumerate(zip(headers, widths)):
+        worksheet.set_column(col, col, width)
+        worksheet.write(0, col, header, header_format)
+
+    row_idx = 0
+    for row in rows:
+        row_idx += 1
+        worksheet.write_row(row_idx, 0, row)
+
+    workbook.close()
+    return row_idx
+
+
+def _write_product_block(worksheet, row_idx, group, merge_format, border_format):
+    """Пишет строки одного товара начиная с row_idx, возвращает номер следующей строки"""
+    product_cells = group[0][1:4]
+    flavors = [(row[4], row[5]) for row in group if row[4] is not None] or [(NO_FLAVORS, 0)]
+
+    if len(flavors) == 1:
+        # Если один вкус, выделяем строку жирной линией
+        worksheet.write_row(row_idx, 0, [*product_cells, *flavors[0], flavors[0][1]], border_format)
+        return row_idx + 1
+
+    # Объединение ячеек товара. В режиме constant_memory строки, которые уже
+    # записаны, изменить нельзя, поэтому merge_range вызывается без формата (он
+    # не заполняет нижние строки) до перехода к ним, а формат задаётся явно
+    last_row = row_idx + len(flavors) - 1
+    for col, value in enumerate(product_cells):
+        worksheet.merge_range(row_idx, col, last_row, col, value, None)
+        worksheet.write(row_idx, col, value, merge_format)
+
+    for offset, (flavor_name, quantity) in enumerate(flavors):
+        current_row = row_idx + offset
+        if offset:
+            for col in range(len(product_cells)):
+                worksheet.write_blank(current_row, col, None, merge_format)
+        # Последняя строка товара — с жирной нижней границей
+        cell_format = border_format if current_row == last_row else merge_format
+        worksheet.write(current_row, 3, flavor_name, cell_format)
+        worksheet.write(current_row, 4, quantity, cell_format)
+        worksheet.write(current_row, 5, quantity, cell_format)
+    return last_row + 1
+
+
+def write_products_table_xlsx(rows, path):
+    """Пишет xlsx-таблицу товаров в path за один проход, возвращает число строк листа без заголовка.
+
+    rows — строки get_products_table_data: (id товара, товар, закупочная цена,
+    цена продажи, вкус или None, количество), сгруппированные по товару. Лист
+    пишется в режиме constant_memory, в памяти держатся только вкусы текущего товара.
+    """
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Товары')
+
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    # Формат для объединенных ячеек
+    merge_format = workbook.add_format({
+        'valign': 'top',
+        'border': 1,
+        'text_wrap': True
+    })
+    # Формат для последней строки товара (жирная линия)
+    border_format = workbook.add_format({
+        'bottom': 2,  # Жирная нижняя граница
+        'valign': 'top',
+        'border': 1,
+        'text_wrap': True
+    })
+
+    for i, width in enumerate([25, 15, 15, 30, 15, 22]):
+        worksheet.set_column(i, i, width)
+    worksheet.write_row(0, 0, (*PRODUCTS_TABLE_COLUMNS, EXPORTED_QUANTITY_COLUMN), header_format)
+
+    row_idx = 1
+    for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+        row_idx = _write_product_block(worksheet, row_idx, list(group), merge_format, border_format)
+        # xlsxwriter помнит каждую ячейку объединений до закрытия книги, чтобы
+        # проверять пересечения; блоки товаров не пересекаются, поэтому проверка
+        # нужна только внутри текущего товара, а память не растёт с каталогом
+        worksheet.merged_cells.clear()
+
+    workbook.close()
+    return row_idx - 1
+
+
+def warm_up():
+    """Пустая задача: заранее поднимает процесс пула и загружает pandas"""
+    import pandas as pd
+
+    return pd.__version__
+
+
+def start_report_pool(workers: int) -> ProcessPoolExecutor:
+    """Создаёт пул процессов spawn и сразу поднимает все его процессы.
+
+    Процесс spawn при старте импортирует главный модуль родителя. Если им
+    остаётся AshkiCharm.py, каждый процесс заново выполняет весь бот: открывает
+    bot.log, создаёт Bot, движок БД, Dispatcher. Поэтому на время запуска
+    процессов главным модулем подставляется этот модуль — он не импортирует
+    ни бота, ни БД.
+    """
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    main_module = sys.modules["__main__"]
+    sys.modules["__main__"] = sys.modules[__name__]
+    try:
+        # submit запускает процессы синхронно, пока подставлен этот модуль
+        for _ in range(workers):
+            executor.submit(warm_up)
+    finally:
+        sys.modules["__main__"] = main_module
+    return executor
+
+
+# ======================= ВЫГРУЗКИ В ФАЙЛ ======================= #
+# Большие выгрузки (журнал продаж) пишутся построчно из итератора прямо в файлы
+# во временной папке, без списка строк в памяти. Поток БД только сбрасывает
+# строки пачками в промежуточный файл (spool_rows), а CSV/xlsx/Parquet из него
+# пишет процесс пула (write_spooled). Parquet доступен, если установлен pyarrow.
+EXPORT_FORMATS = {"csv": "CSV", "xlsx": "Excel (xlsx)", "parquet": "Parquet"}
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+XLSX_MAX_ROWS = 1048576
+PARQUET_BATCH_ROWS = 50000
+SPOOL_BATCH_ROWS = 1000
+
+
+def spool_rows(rows, path):
+    """Сбрасывает строки в файл path пачками по SPOOL_BATCH_ROWS (pickle), возвращает число строк"""
+    rows = iter(rows)
+    count = 0
+    with open(path, "wb") as output:
+        while True:
+            batch = list(itertools.islice(rows, SPOOL_BATCH_ROWS))
+            if not batch:
+                break
+            pickle.dump(batch, output, pickle.HIGHEST_PROTOCOL)
+            count += len(batch)
+    return count
+
+
+def iter_spooled_rows(path):
+    """Читает строки, сброшенные spool_rows, по одной пачке за раз"""
+    with open(path, "rb") as source:
+        while True:
+            try:
+                batch = pickle.load(source)
+            except EOFError:
+                return
+            yield from batch
+
+
+def write_spooled(writer, spool_path, path):
+    """Выполняется в пуле процессов: writer(rows, path) пишет файл из строк spool_path.
+    Промежуточный файл удаляется, возвращается число строк."""
+    try:
+        return writer(iter_spooled_rows(spool_path), path)
+    finally:
+        os.remove(spool_path)
+
+
+def write_rows_csv(rows, path, columns):
+    """Пишет строки в CSV (UTF-8 с BOM и «;» — так файл сразу открывается в Excel), возвращает число строк"""
+    count = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as output:
+        writer = csv.writer(output, delimiter=";")
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_rows_xlsx(rows, path, columns, sheet_name="Данные"):
+    """Пишет строки в xlsx в режиме constant_memory, возвращает число строк.
+
+    Строки сверх предела листа Excel переносятся на следующие листы.
+    """
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'default_date_format': 'dd.mm.yyyy hh:mm'})
+    header_format = workbook.add_format({'bold': True, 'border': 1})
+    worksheet = None
+    row_idx = XLSX_MAX_ROWS
+    count = 0
+    for row in rows:
+        if row_idx == XLSX_MAX_ROWS:
+            sheet_number = count // (XLSX_MAX_ROWS - 1) + 1
+            worksheet = workbook.add_worksheet(sheet_name if sheet_number == 1 else f"{sheet_name} {sheet_number}")
+            worksheet.set_column(0, len(columns) - 1, 16)
+            worksheet.write_row(0, 0, columns, header_format)
+            row_idx = 1
+        worksheet.write_row(row_idx, 0, row)
+        row_idx += 1
+        count += 1
+    if worksheet is None:
+        workbook.add_worksheet(sheet_name).write_row(0, 0, columns, header_format)
+    workbook.close()
+    return count
+
+
+def write_rows_parquet(rows, directory, columns, date_column=0):
+    """Пишет строки в Parquet с разбиением по месяцам: directory/month=ГГГГ-ММ/part-0.parquet.
+
+    Строки должны быть упорядочены по колонке даты date_column. В памяти
+    держится не больше PARQUET_BATCH_ROWS строк. Возвращает число строк.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    count = 0
+    for month, month_rows in itertools.groupby(rows, key=lambda row: row[date_column].strftime("%Y-%m")):
+        partition = os.path.join(directory, f"month={month}")
+        os.makedirs(partition, exist_ok=True)
+        writer = None
+        try:
+            while True:
+                batch = list(itertools.islice(month_rows, PARQUET_BATCH_ROWS))
+                if not batch:
+                    break
+                table = pa.Table.from_pylist([dict(zip(columns, row)) for row in batch])
+                if writer is None:
+                    writer = pq.ParquetWriter(os.path.join(partition, "part-0.parquet"), table.schema)
+                writer.write_table(table.cast(writer.schema))
+                count += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+    return count
+
+
+def pack_export(path, part_size):
+    """Готовит выгрузку к отправке: возвращает список файлов не больше part_size байт.
+
+    Файл, который помещается целиком, отправляется как есть. Папка (Parquet)
+    или слишком большой файл упаковываются в zip; zip больше part_size
+    режется на части .zip.001, .zip.002, … (собираются 7-Zip или cat).
+    """
+    if os.path.isfile(path) and os.path.getsize(path) <= part_size:
+        return [path]
+
+    archive_path = path.rstrip(os.sep) + ".zip"
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    full_path = os.path.join(root, name)
+                    archive.write(full_path, os.path.relpath(full_path, os.path.dirname(path)))
+        else:
+            archive.write(path, os.path.basename(path))
+
+    if os.path.getsize(archive_path) <= part_size:
+        return [archive_path]
+
+    parts = []
+    with open(archive_path, "rb") as archive:
+        while True:
+            part_path = f"{archive_path}.{len(parts) + 1:03d}"
+            written = 0
+            with open(part_path, "wb") as part:
+                while written < part_size:
+                    chunk = archive.read(min(1024 * 1024, part_size - written))
+                    if not chunk:
+                        break
+                    part.write(chunk)
+                    written += len(chunk)
+            if not written:
+                os.remove(part_path)
+                break
+            parts.append(part_path)
+    os.remove(archive_path)
+    return parts
+
+
+# ======================= ЧТЕНИЕ ТАБЛИЦЫ ТОВАРОВ ======================= #
+# Обратная операция к write_products_table_xlsx: файл читается построчно
+# (xlsx — потоковым разбором XML листа, CSV — csv.reader), без DataFrame.
+
+_XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_XLSX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_PACKAGE_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+
+def _xlsx_column(ref):
+    """Номер колонки (с 0) по адресу ячейки вида D12"""
+    index = 0
+    for char in ref:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - ord("A") + 1
+    return index - 1
+
+
+def _first_sheet_path(archive):
+    """Путь к первому листу книги: порядок листов задаёт xl/workbook.xml, файл — его rels"""
+    with archive.open("xl/workbook.xml") as workbook:
+        sheet = next(
+            (elem for _, elem in iterparse(workbook) if elem.tag == _XLSX_NS + "sheet"),
+            None
+        )
+    if sheet is None:
+        raise ValueError("В книге нет листов")
+    rel_id = sheet.get(_XLSX_REL_NS + "id")
+
+    with archive.open("xl/_rels/workbook.xml.rels") as rels:
+        for _, elem in iterparse(rels):
+            if elem.tag == _PACKAGE_REL_NS + "Relationship" and elem.get("Id") == rel_id:
+                target = elem.get("Target")
+                # Target задаётся относительно xl/ или абсолютным путём от корня архива
+                return target.lstrip("/") if target.startswith("/") else "xl/" + target
+    raise ValueError("Не найден первый лист книги")
+
+
+def _row_number(ref):
+    """Номер строки (с 1) по адресу ячейки вида D12 или None"""
+    digits = ref.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+    return int(digits) if digits.isdigit() else None
+
+
+def _iter_xlsx_rows(stream):
+    """Строки первого листа xlsx: (номер строки в листе, список значений).
+
+    Пустые строки в xlsx не записываются, поэтому номер берётся из атрибута r.
+    """
+    with zipfile.ZipFile(stream) as archive:
+        names = set(archive.namelist())
+        shared = []
+        if "xl/sharedStrings.xml" in names:
+            with archive.open("xl/sharedStrings.xml") as strings:
+                for _, elem in iterparse(strings):
+                    if elem.tag == _XLSX_NS + "si":
+                        shared.append("".join(t.text or "" for t in elem.iter(_XLSX_NS + "t")))
+                        elem.clear()
+
+        row_number = 0
+        with archive.open(_first_sheet_path(archive)) as rows:
+            for _, elem in iterparse(rows):
+                if elem.tag != _XLSX_NS + "row":
+                    continue
+                row_number = int(elem.get("r") or row_number + 1)
+                values = []
+                for cell in elem.iter(_XLSX_NS + "c"):
+                    column = _xlsx_column(cell.get("r", ""))
+                    if elem.get("r") is None and _row_number(cell.get("r", "")):
+                        row_number = _row_number(cell.get("r", ""))
+                    if column < 0:
+                        column = len(values)
+                    kind = cell.get("t")
+                    if kind == "inlineStr":
+                        value = "".join(t.text or "" for t in cell.iter(_XLSX_NS + "t"))
+                    else:
+                        raw = cell.find(_XLSX_NS + "v")
+                        value = raw.text if raw is not None else None
+                        if kind == "s" and value is not None:
+                            value = shared[int(value)]
+                    values.extend([None] * (column + 1 - len(values)))
+                    values[column] = value
+                elem.clear()
+                yield row_number, values
+
+
+def _csv_encoding(stream):
+    """utf-8-sig, если весь файл читается как UTF-8, иначе cp1251 (CSV из Excel
+    в русской Windows)"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "cp1251"
+    finally:
+        stream.seek(0)
+
+
+def _iter_csv_rows(stream):
+    """Строки CSV: (номер строки, список значений); кодировка и разделитель
+    (",", ";" или табуляция) определяются по файлу"""
+    text = io.TextIOWrapper(stream, encoding=_csv_encoding(stream), newline="")
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    yield from enumerate(csv.reader(text, dialect), start=1)
+
+
+def _number(value, row_number, column):
+    try:
+        return float(str(value).replace(",", ".").replace(" ", ""))
+    except ValueError:
+        raise ValueError(f"Строка {row_number}: «{column}» должно быть числом, а не «{value}»")
+
+
+def _quantity(value, row_number, column):
+    quantity = _number(value, row_number, column)
+    if quantity < 0 or quantity != int(quantity):
+        raise ValueError(f"Строка {row_number}: «{column}» должно быть целым числом ≥ 0")
+    return int(quantity)
+
+
+def iter_products_table_rows(stream, filename):
+    """Построчно читает таблицу товаров в формате «📥 Скачать таблицу».
+
+    Возвращает генератор кортежей (товар, закупочная цена, цена продажи,
+    вкус или None, количество, остаток при выгрузке или None). Пустые ячейки
+    товара и цен (объединённые ячейки в xlsx) берутся из предыдущей строки.
+    Колонка остатка при выгрузке необязательна. Ошибки формата — ValueError.
+    """
+    if filename.lower().endswith(".xlsx"):
+        rows = _iter_xlsx_rows(stream)
+    elif filename.lower().endswith((".csv", ".txt")):
+        rows = _iter_csv_rows(stream)
+    else:
+        raise ValueError("Поддерживаются только файлы .xlsx и .csv")
+
+    _, header = next(rows, (None, None))
+    header = [str(cell or "").strip() for cell in header or []]
+    missing = [column for column in PRODUCTS_TABLE_COLUMNS if column not in header]
+    if missing:
+        raise ValueError("В таблице нет колонок: " + ", ".join(missing))
+    positions = [header.index(column) for column in PRODUCTS_TABLE_COLUMNS]
+    exported_position = header.index(EXPORTED_QUANTITY_COLUMN) if EXPORTED_QUANTITY_COLUMN in header else None
+
+    product = purchase_price = sale_price = None
+    for row_number, row in rows:
+        cells = [
+            str(row[pos]).strip() if pos < len(row) and row[pos] is not None else ""
+            for pos in positions
+        ]
+        if not any(cells):
+            continue
+        name, purchase, sale, flavor, quantity = cells
+        if name:
+            product, purchase_price, sale_price = name, purchase, sale
+        elif product is None:
+            raise ValueError(f"Строка {row_number}: не указан товар")
+
+        if flavor == NO_FLAVORS:
+            flavor = ""
+        quantity = _quantity(quantity or 0, row_number, "Количество")
+        exported = None
+        if exported_position is not None and exported_position < len(row) and row[exported_position] is not None:
+            exported = str(row[exported_position]).strip() or None
+        if exported is not None:
+            exported = _quantity(exported, row_number, EXPORTED_QUANTITY_COLUMN)
+        yield (
+            product,
+            _number(purchase_price, row_number, "Закупочная цена"),
+            _number(sale_price, row_number, "Цена продажи"),
+            flavor or None,
+            quantity,
+            exported
+        )
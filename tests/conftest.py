@@ -0,0 +1,23 @@
+import pytest
+
+from tests.support import bot_module, clear_database
+
+
+@pytest.fixture
+def app():
+    """Модуль бота с пустой базой"""
+    clear_database()
+    return bot_module
+
+
+@pytest.fixture
+def product(app):
+    """Товар с вкусами F0…F29 по 100 шт.: (id товара, [id вкусов])"""
+    with app.Session() as session:
+        product = app.Product(name="Товар", purchase_price=100, sale_price=200, sale_price_2=150)
+        session.add(product)
+        session.flush()
+        flavors = [app.Flavor(name=f"F{i}", quantity=100, product_id=product.id) for i in range(30)]
+        session.add_all(flavors)
+        session.commit()
+        return product.id, [flavor.id for flavor in flavors]
@@ -0,0 +1,44 @@
+"""Бот на временной SQLite-базе для тестов и бенчмарков.
+
+Бот читает настройки при импорте, поэтому окружение задаётся до него.
+bot.log и кэш отчётов пишутся во временную папку, а не в репозиторий.
+"""
+import contextlib
+import os
+import sys
+import tempfile
+
+WORK_DIR = tempfile.mkdtemp(prefix="ashkicharm_")
+os.environ["BOT_TOKEN"] = "123456:TEST"
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORK_DIR, 'test.db')}"
+os.environ["FSM_STORAGE"] = "memory"
+os.environ["REPORT_CACHE_DIR"] = os.path.join(WORK_DIR, "report_cache")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(WORK_DIR)
+
+import AshkiCharm as bot_module  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+
+def clear_database():
+    """Удаляет все строки, кроме версии схемы, и сбрасывает кэш каталога"""
+    with bot_module.Session() as session:
+        for table in reversed(bot_module.Base.metadata.sorted_tables):
+            if table.name != "schema_info":
+                session.execute(table.delete())
+        session.commit()
+    bot_module.catalog.invalidate()
+
+
+@contextlib.contextmanager
+def count_statements():
+    """Считает SQL-запросы, отправленные в БД внутри блока: with count_statements() as counter"""
+    counter = {"count": 0}
+
+    def count(*args):
+        counter["count"] += 1
+    event.listen(bot_module.engine, "before_cursor_execute", count)
+    try:
+        yield counter
+    finally:
+        event.remove(bot_module.engine, "before_cursor_execute", count)
@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+from aiogram import types
+
+CHAT = {"id": 1, "type": "private"}
+USER = {"id": 1, "is_bot": False, "first_name": "U"}
+
+
+def message(age):
+    return {"message_id": 1, "date": int(time.time() - age), "chat": CHAT, "text": "x"}
+
+
+def message_update(age):
+    return types.Update.model_validate({"update_id": 1, "message": {**message(age), "from": USER}})
+
+
+def callback_update(message_age):
+    return types.Update.model_validate({"update_id": 2, "callback_query": {
+        "id": "1", "from": USER, "chat_instance": "1", "data": "x", "message": message(message_age)
+    }})
+
+
+def passed(stale_filter, updates):
+    handled = []
+
+    async def handler(update, data):
+        handled.append(update)
+
+    async def feed():
+        for update in updates:
+            await stale_filter(handler, update, {})
+    asyncio.run(feed())
+    return [number for number, update in enumerate(updates) if any(update is seen for seen in handled)]
+
+
+def test_old_messages_are_dropped(app):
+    stale_filter = app.StaleUpdateFilter(300)
+    assert passed(stale_filter, [message_update(600), message_update(10)]) == [1]
+
+
+def test_callbacks_under_old_messages_are_dropped_only_while_draining(app):
+    stale_filter = app.StaleUpdateFilter(300)
+    updates = [callback_update(600), callback_update(10), message_update(10), callback_update(600)]
+    # После первого свежего сообщения очередь разобрана: старое меню снова работает
+    assert passed(stale_filter, updates) == [1, 2, 3]
+
+
+def test_drain_ends_after_drain_seconds(app):
+    stale_filter = app.StaleUpdateFilter(300, drain_seconds=0)
+    assert passed(stale_filter, [callback_update(600)]) == [0]
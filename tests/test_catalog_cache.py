@@ -0,0 +1,49 @@
+import asyncio
+
+
+def change_in_other_process(app, flavor_id, quantity, bump_version=True):
+    """Изменение остатка мимо Session этого процесса, как из соседнего процесса бота"""
+    with app.engine.begin() as connection:
+        connection.execute(app.update(app.Flavor).where(app.Flavor.id == flavor_id).values(quantity=quantity))
+        if bump_version:
+            connection.execute(
+                app.update(app.DataVersion)
+                .where(app.DataVersion.name == app.CATALOG_VERSION)
+                .values(version=app.DataVersion.version + 1)
+            )
+
+
+def stock(app, flavor_id):
+    return asyncio.run(app.catalog.get()).flavor(flavor_id).quantity
+
+
+def test_catalog_follows_data_version_of_other_processes(app, product):
+    _, flavor_ids = product
+    notified = []
+    app.catalog.listeners.append(lambda: notified.append(True))
+    try:
+        assert stock(app, flavor_ids[0]) == 100
+        hits = app.catalog.hits
+        assert stock(app, flavor_ids[0]) == 100
+        assert app.catalog.hits == hits + 1
+
+        # Без новой версии снимок остаётся прежним
+        change_in_other_process(app, flavor_ids[0], 40, bump_version=False)
+        assert stock(app, flavor_ids[0]) == 100
+
+        change_in_other_process(app, flavor_ids[0], 30)
+        assert stock(app, flavor_ids[0]) == 30
+        assert notified == [True]
+    finally:
+        app.catalog.listeners.pop()
+
+
+def test_local_commit_bumps_catalog_version(app, product):
+    _, flavor_ids = product
+    before = asyncio.run(app.catalog.get()).version
+    with app.Session() as session:
+        session.get(app.Flavor, flavor_ids[1]).quantity = 7
+        session.commit()
+    snapshot = asyncio.run(app.catalog.get())
+    assert snapshot.version == before + 1
+    assert snapshot.flavor(flavor_ids[1]).quantity == 7
@@ -0,0 +1,129 @@
+import asyncio
+
+from aiogram.exceptions import TelegramBadRequest
+
+CHANNEL = "-100123"
+
+
+class FakeBot:
+    """Методы бота, которыми пользуется доска; запоминает вызовы"""
+
+    def __init__(self):
+        self.calls = []
+        self.deleted = set()
+        self.next_id = 500
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.next_id += 1
+        self.calls.append(("send", self.next_id, text.split("\n")[0]))
+        return type("SentMessage", (), {"message_id": self.next_id})()
+
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        self.calls.append(("pin", message_id))
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        if message_id in self.deleted:
+            raise TelegramBadRequest(None, "Bad Request: message to edit not found")
+        self.calls.append(("edit", message_id))
+
+    async def delete_message(self, chat_id, message_id):
+        self.calls.append(("delete", message_id))
+
+
+def sync(app, fake_bot):
+    """Сверка доски, загруженной из БД, как после перезапуска; вызовы бота за сверку"""
+    async def run():
+        board = app.ChannelBoard(CHANNEL, 0)
+        board.posts = await app.run_db(app.load_channel_posts)
+        await board.sync()
+    fake_bot.calls.clear()
+    asyncio.run(run())
+    return fake_bot.calls
+
+
+def test_only_missing_or_changed_posts_are_reposted(app, product, monkeypatch):
+    product_id, flavor_ids = product
+    with app.Session() as session:
+        other = app.Product(name="Другой", purchase_price=1, sale_price=2, sale_price_2=2)
+        session.add(other)
+        session.flush()
+        session.add(app.Flavor(name="X", quantity=1, product_id=other.id))
+        session.commit()
+        other_id = other.id
+    fake_bot = FakeBot()
+    monkeypatch.setattr(app, "bot", fake_bot)
+
+    calls = sync(app, fake_bot)
+    assert [call[0] for call in calls] == ["send", "pin", "send", "pin"]
+    with app.Session() as session:
+        posts = dict(session.query(app.ChannelPost.product_id, app.ChannelPost.message_id))
+    assert set(posts) == {product_id, other_id}
+
+    # Ничего не изменилось — ни одного запроса
+    assert sync(app, fake_bot) == []
+
+    # Остаток изменился, но вкус не закончился — текст в канале тот же
+    with app.Session() as session:
+        session.get(app.Flavor, flavor_ids[0]).quantity = 50
+        session.commit()
+    assert sync(app, fake_bot) == []
+
+    # Вкус закончился — правится только сообщение этого товара
+    with app.Session() as session:
+        session.get(app.Flavor, flavor_ids[0]).quantity = 0
+        session.commit()
+    assert sync(app, fake_bot) == [("edit", posts[product_id])]
+
+    # Сообщение удалили из канала — публикуется заново только оно
+    fake_bot.deleted.add(posts[other_id])
+    with app.Session() as session:
+        session.get(app.Product, other_id).sale_price = 3
+        session.commit()
+    calls = sync(app, fake_bot)
+    assert [call[0] for call in calls] == ["send", "pin"]
+    assert calls[0][2] == "• Другой 3"
+
+    # Товар удалён — его сообщение убирается
+    with app.Session() as session:
+        message_id = session.get(app.ChannelPost, other_id).message_id
+        session.delete(session.get(app.Product, other_id))
+        session.commit()
+    assert sync(app, fake_bot) == [("delete", message_id)]
+    assert sync(app, fake_bot) == []
+
+
+def test_lease_is_held_by_one_owner(app):
+    with app.Session() as session:
+        assert app.acquire_lease(session, "job", "first", 60)
+        assert not app.acquire_lease(session, "job", "second", 60)
+        assert app.acquire_lease(session, "job", "first", 60)  # продление
+        app.release_lease(session, "job", "first")
+        assert app.acquire_lease(session, "job", "second", -1)
+        # Аренда second истекла — её забирает first
+        assert app.acquire_lease(session, "job", "first", 60)
+
+
+def test_only_one_process_runs_the_board(app, product, monkeypatch):
+    fake_bot = FakeBot()
+    monkeypatch.setattr(app, "bot", fake_bot)
+
+    async def run():
+        boards = [app.ChannelBoard(CHANNEL, 0, lease_ttl=0.3) for _ in range(2)]
+        for board in boards:
+            await board.start()
+        await asyncio.sleep(0.3)
+        leaders = [board for board in boards if board.leader]
+        assert len(leaders) == 1
+        sends_before_handover = [call for call in fake_bot.calls if call[0] == "send"]
+
+        # Ведущий остановился — доску подхватывает второй, не публикуя её заново
+        await leaders[0].stop()
+        follower = next(board for board in boards if board is not leaders[0])
+        await asyncio.sleep(0.3)
+        assert follower.leader
+        await follower.stop()
+        return sends_before_handover
+
+    sends = asyncio.run(run())
+    assert len(sends) == 1
+    assert [call for call in fake_bot.calls if call[0] == "send"] == sends
@@ -0,0 +1,89 @@
+import datetime
+import threading
+
+from tests.support import count_statements
+
+
+def cart(product_id, flavor_ids, quantity=1):
+    return [
+        {"product_id": product_id, "flavor_id": flavor_id, "product_name": "Товар",
+         "flavor_name": f"F{number}", "quantity": quantity}
+        for number, flavor_id in enumerate(flavor_ids)
+    ]
+
+
+def test_checkout_statement_count_does_not_grow_with_cart(app, product):
+    product_id, flavor_ids = product
+
+    # Первая продажа заводит покупателя и неделю дохода рабочего
+    with app.Session() as session:
+        assert app.checkout_cart(session, cart(product_id, flavor_ids[:1]), "Первый")[0]
+
+    counts = {}
+    for lines in (5, 30):
+        with app.Session() as session, count_statements() as counter:
+            ok, _ = app.checkout_cart(session, cart(product_id, flavor_ids[:lines]), f"Покупатель {lines}")
+        assert ok
+        counts[lines] = counter["count"]
+
+    assert counts[5] == counts[30] <= 10
+    with app.Session() as session:
+        assert session.query(app.Sale).filter(app.Sale.customer_id.isnot(None)).count() == 1 + 5 + 30
+        assert session.query(app.func.sum(app.DailySalesRollup.sales_count)).scalar() == 1 + 5 + 30
+
+
+def test_concurrent_checkouts_never_oversell(app, product):
+    product_id, flavor_ids = product
+    with app.Session() as session:
+        session.query(app.Flavor).filter(app.Flavor.id.in_(flavor_ids[:2])).update(
+            {app.Flavor.quantity: 5}, synchronize_session=False
+        )
+        session.commit()
+
+    buyers = 20
+    barrier = threading.Barrier(buyers)
+    results = []
+
+    def buy(number):
+        barrier.wait()
+        with app.Session() as session:
+            ok, _ = app.checkout_cart(session, cart(product_id, flavor_ids[:2]), f"Покупатель {number}")
+        results.append(ok)
+
+    threads = [threading.Thread(target=buy, args=(number,)) for number in range(buyers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.Session() as session:
+        stock = [session.get(app.Flavor, flavor_id).quantity for flavor_id in flavor_ids[:2]]
+        sold = session.query(app.func.coalesce(app.func.sum(app.Sale.quantity), 0)).filter(
+            app.Sale.flavor_id == flavor_ids[0]
+        ).scalar()
+    assert len(results) == buyers
+    assert results.count(True) == 5
+    assert stock == [0, 0]
+    assert sold == 5
+
+
+def test_checkout_credits_worker_income_for_the_week(app, product):
+    product_id, flavor_ids = product
+    last_week = datetime.datetime.now() - datetime.timedelta(days=7)
+    with app.Session() as session:
+        session.add(app.WorkerIncome(week_start=last_week, income=500.0, is_current=True))
+        session.commit()
+
+    with app.Session() as session:
+        # 1 шт. по 200 ₽ при закупке 100 ₽: прибыль 100 ₽, рабочему 30%
+        assert app.checkout_cart(session, cart(product_id, flavor_ids[:1]), "Первый")[0]
+        # 2 шт. товара — цена 150 ₽ за штуку: прибыль 2 × 50 ₽
+        ok, text = app.checkout_cart(session, cart(product_id, flavor_ids[1:3]), "Второй")
+    assert ok
+    assert "Доход Лёни:</b> 30.00 ₽" in text
+
+    with app.Session() as session:
+        weeks = session.query(app.WorkerIncome).order_by(app.WorkerIncome.week_start).all()
+    assert [(week.income, week.is_current) for week in weeks] == [(500.0, False), (60.0, True)]
+    today = datetime.date.today()
+    assert weeks[1].week_start.date() == today - datetime.timedelta(days=today.weekday())
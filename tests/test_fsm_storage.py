@@ -0,0 +1,38 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+
+def test_state_is_visible_to_another_worker_immediately(app):
+    key = StorageKey(bot_id=1, chat_id=7, user_id=7)
+
+    async def scenario():
+        # Два процесса бота с общей БД: обновления одного пользователя
+        # попадают то в один, то в другой
+        first, second = app.DatabaseStorage(app.FSM_STATE_TTL), app.DatabaseStorage(app.FSM_STATE_TTL)
+        await first.set_state(key, app.RecordSaleState.enter_quantity)
+        await first.update_data(key, {"sales_list": [{"flavor_id": 1, "quantity": 2}]})
+        seen = await second.get_state(key), await second.get_data(key)
+
+        await second.update_data(key, {"customer_name": "Покупатель"})
+        await second.set_state(key, None)
+        return seen, (await first.get_state(key), await first.get_data(key))
+
+    seen, back = asyncio.run(scenario())
+    assert seen == ("RecordSaleState:enter_quantity", {"sales_list": [{"flavor_id": 1, "quantity": 2}]})
+    assert back == (None, {"sales_list": [{"flavor_id": 1, "quantity": 2}], "customer_name": "Покупатель"})
+
+
+def test_expired_state_reads_as_empty(app):
+    key = StorageKey(bot_id=1, chat_id=8, user_id=8)
+    storage = app.DatabaseStorage(app.FSM_STATE_TTL)
+
+    async def scenario():
+        await storage.set_state(key, app.RecordSaleState.enter_quantity)
+        await storage.set_data(key, {"x": 1})
+        with app.Session() as session:
+            session.query(app.FsmRecord).update({app.FsmRecord.updated_at: app.datetime.datetime(2000, 1, 1)})
+            session.commit()
+        return await storage.get_state(key), await storage.get_data(key)
+
+    assert asyncio.run(scenario()) == (None, {})
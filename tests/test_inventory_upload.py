@@ -0,0 +1,60 @@
+import io
+
+from reports import EXPORTED_QUANTITY_COLUMN
+
+HEADER = "Товар;Закупочная цена;Цена продажи;Вкус;Количество"
+
+
+def upload(app, lines, encoding="utf-8-sig"):
+    content = "\n".join(lines).encode(encoding)
+    with app.Session() as session:
+        return app.apply_inventory_table(session, io.BytesIO(content), "products.csv")
+
+
+def quantities(app, flavor_ids):
+    with app.Session() as session:
+        return [session.get(app.Flavor, flavor_id).quantity for flavor_id in flavor_ids]
+
+
+def test_upload_keeps_sales_made_after_download(app, product):
+    product_id, flavor_ids = product
+    output = io.BytesIO()
+    with app.Session() as session:
+        app.write_products_table_xlsx(app.get_products_table_data(session), output)
+    exported = list(app.iter_products_table_rows(io.BytesIO(output.getvalue()), "products.xlsx"))
+    assert exported[0] == ("Товар", 100.0, 200.0, "F0", 100, 100)
+
+    # Пока таблицу правили, F0 и F1 продали
+    with app.Session() as session:
+        session.get(app.Flavor, flavor_ids[0]).quantity = 95
+        session.get(app.Flavor, flavor_ids[1]).quantity = 2
+        session.commit()
+
+    summary = upload(app, [
+        f"{HEADER};{EXPORTED_QUANTITY_COLUMN}",
+        "Товар;100;200;F0;120;100",  # приход 20 шт.
+        "Товар;100;200;F1;0;100",    # списание всего остатка на момент выгрузки
+        "Товар;100;200;F2;100;100",
+    ])
+    assert quantities(app, flavor_ids[:3]) == [115, 0, 100]
+    assert summary["updated_flavors"] == 2
+    assert summary["changed_since_export"] == 2
+
+
+def test_upload_without_exported_column_replaces_quantity(app, product):
+    _, flavor_ids = product
+    with app.Session() as session:
+        session.get(app.Flavor, flavor_ids[0]).quantity = 95
+        session.commit()
+    summary = upload(app, [HEADER, "Товар;100;200;F0;120"])
+    assert quantities(app, flavor_ids[:1]) == [120]
+    assert summary["changed_since_export"] == 0
+
+
+def test_cp1251_csv_is_decoded(app, product):
+    _, flavor_ids = product
+    summary = upload(app, [HEADER, "Товар;100;200;F0;7", "Товар;100;200;Ягода;3"], encoding="cp1251")
+    assert quantities(app, flavor_ids[:1]) == [7]
+    assert summary["new_flavors"] == 1
+    with app.Session() as session:
+        assert session.query(app.Flavor).filter(app.Flavor.name == "Ягода").one().quantity == 3
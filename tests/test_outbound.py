@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from aiogram.methods import EditMessageText, SendMessage
+
+CHAT_ID = 1
+
+
+class FakeSender:
+    """make_request бота: запоминает отправленные тексты, отвечает с задержкой"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+
+    async def __call__(self, bot, method):
+        self.sent.append(method.text)
+        await asyncio.sleep(self.delay)
+        return method.text
+
+
+def scheduler(app, monkeypatch, rate, burst):
+    monkeypatch.setattr(app, "OUTBOUND_CHAT_RATE", rate)
+    monkeypatch.setattr(app, "OUTBOUND_CHAT_BURST", burst)
+    return app.OutboundScheduler()
+
+
+def edit(text):
+    return EditMessageText(chat_id=CHAT_ID, message_id=10, text=text)
+
+
+def test_chat_rate_limit(app, monkeypatch):
+    outbound = scheduler(app, monkeypatch, rate=20, burst=2)
+    sender = FakeSender()
+
+    async def send_all():
+        started = time.monotonic()
+        await asyncio.gather(*(
+            outbound(sender, None, SendMessage(chat_id=CHAT_ID, text=str(number))) for number in range(6)
+        ))
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(send_all())
+    assert sender.sent == [str(number) for number in range(6)]
+    # Первые два сообщения — из запаса, остальные четыре по одному в 1/20 с
+    assert elapsed >= 4 / 20 * 0.9
+
+
+def test_queued_edits_are_coalesced(app, monkeypatch):
+    outbound = scheduler(app, monkeypatch, rate=20, burst=1)
+    sender = FakeSender(delay=0.01)
+
+    async def edit_all():
+        await outbound(sender, None, edit("first"))  # забирает запас чата
+        return await asyncio.gather(*(outbound(sender, None, edit(f"e{number}")) for number in range(5)))
+
+    results = asyncio.run(edit_all())
+    # К моменту получения токена все, кроме e4, уже устарели
+    assert sender.sent == ["first", "e4"]
+    assert results == ["e4"] * 5
+    assert outbound.coalesced == 4
+    assert outbound.latest_edits == {}
+
+
+def test_cancelled_newest_edit_does_not_hang_older_ones(app, monkeypatch):
+    outbound = scheduler(app, monkeypatch, rate=20, burst=1)
+    sender = FakeSender()
+
+    async def cancel_newest():
+        await outbound(sender, None, edit("e0"))  # забирает запас чата
+        older = asyncio.ensure_future(outbound(sender, None, edit("e1")))
+        newest = asyncio.ensure_future(outbound(sender, None, edit("e2")))
+        await asyncio.sleep(0)
+        newest.cancel()
+        result = await asyncio.wait_for(older, timeout=1)
+        return result, newest.cancelled()
+
+    result, cancelled = asyncio.run(cancel_newest())
+    assert cancelled
+    # Отмена вызвавшего не прерывает отправку: старое изменение получает её результат
+    assert result == "e2"
+    assert sender.sent == ["e0", "e2"]
+    assert outbound.latest_edits == {}
@@ -0,0 +1,29 @@
+import asyncio
+
+
+def test_product_cards_are_rendered_once_per_catalog_snapshot(app, monkeypatch):
+    with app.Session() as session:
+        for number in range(60):
+            product = app.Product(name=f"Товар {number}", purchase_price=1, sale_price=2, sale_price_2=2)
+            session.add(product)
+            session.flush()
+            session.add_all([app.Flavor(name=f"Вкус {i}", quantity=i, product_id=product.id) for i in range(10)])
+        session.commit()
+    rendered = []
+    format_product_card = app.format_product_card
+    monkeypatch.setattr(app, "format_product_card", lambda product: rendered.append(product.id)
+                        or format_product_card(product))
+
+    snapshot = asyncio.run(app.catalog.get())
+    first, markup = app.products_menu_page(snapshot, 0)
+    pages = int(markup.inline_keyboard[0][1].text.split("/")[1])
+    assert pages > 1
+    texts = [app.products_menu_page(snapshot, page)[0] for page in range(pages)]
+    assert texts[0] == first
+    assert len(rendered) == 60
+
+    with app.Session() as session:
+        session.query(app.Flavor).filter(app.Flavor.name == "Вкус 0").update({app.Flavor.quantity: 5})
+        session.commit()
+    app.products_menu_page(asyncio.run(app.catalog.get()), 1)
+    assert len(rendered) == 120
@@ -0,0 +1,37 @@
+from tests.test_checkout import cart
+
+
+def rollup_snapshot(app, session):
+    return sorted(
+        (str(row.day), row.product_id, row.sales_count, row.quantity, round(row.revenue, 2), round(row.profit, 2))
+        for row in session.query(app.DailySalesRollup).all()
+    )
+
+
+def test_deleting_sale_of_deleted_product_keeps_rollup_consistent(app, product):
+    product_id, flavor_ids = product
+    with app.Session() as session:
+        assert app.checkout_cart(session, cart(product_id, flavor_ids[:3]), "Покупатель")[0]
+
+    with app.Session() as session:
+        session.delete(session.get(app.Product, product_id))
+        session.commit()
+
+    with app.Session() as session:
+        sales = session.query(app.Sale).filter(app.Sale.customer_id.isnot(None)).order_by(app.Sale.id).all()
+        assert len(sales) == 3
+        assert all(sale.product_id is None for sale in sales)
+        assert {row.product_id for row in session.query(app.DailySalesRollup)} == {app.NO_PRODUCT_ID}
+
+        app.add_sale_to_rollup(session, sales[0], sign=-1)
+        session.delete(sales[0])
+        session.commit()
+
+    with app.Session() as session:
+        incremental = rollup_snapshot(app, session)
+        assert [row[2] for row in incremental] == [2]
+        app.rebuild_daily_rollup(session)
+        session.commit()
+
+    with app.Session() as session:
+        assert rollup_snapshot(app, session) == incremental
@@ -0,0 +1,48 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+SECRET = "s3cret"
+UPDATE = {
+    "update_id": 1,
+    "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "/start"},
+}
+
+
+def post_updates(app, monkeypatch, headers):
+    """Отправляет UPDATE в webhook-приложение; (статусы ответов, обновления, дошедшие до диспетчера)"""
+    monkeypatch.setattr(app, "WEBHOOK_SECRET", SECRET)
+    monkeypatch.setattr(app, "STARTUP_BACKLOG_POLICY", "none")
+    received = []
+
+    async def feed_update(bot, update, **kwargs):
+        received.append(update)
+    monkeypatch.setattr(app.dp, "feed_update", feed_update)
+
+    async def run():
+        statuses = []
+        async with TestClient(TestServer(app.build_webhook_app())) as client:
+            for header in headers:
+                response = await client.post(app.WEBHOOK_PATH, json=UPDATE, headers=header)
+                statuses.append(response.status)
+            # Обновление обрабатывается в фоне после ответа Telegram
+            for _ in range(100):
+                if received:
+                    break
+                await asyncio.sleep(0.01)
+        return statuses
+
+    return asyncio.run(run()), received
+
+
+def test_update_reaches_dispatcher(app, monkeypatch):
+    statuses, received = post_updates(app, monkeypatch, [{"X-Telegram-Bot-Api-Secret-Token": SECRET}])
+    assert statuses == [200]
+    assert [update.update_id for update in received] == [1]
+    assert received[0].message.text == "/start"
+
+
+def test_wrong_secret_is_rejected(app, monkeypatch):
+    statuses, received = post_updates(app, monkeypatch, [{}, {"X-Telegram-Bot-Api-Secret-Token": "wrong"}])
+    assert statuses == [401, 401]
+    assert received == []